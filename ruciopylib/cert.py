@@ -22,6 +22,7 @@ class cert:
 
         Args:
             executor    If None use default, otherwise use something else to run the command
+                        (for example, an `async_runner`).
             log_func    A function that takes a string as an argument - which is the output from the reg process.
 
         Returns:
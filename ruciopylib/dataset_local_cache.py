@@ -3,13 +3,286 @@
 # - What datasets we have
 #
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from ruciopylib.rucio import RucioFile
-from typing import List, Optional
+from ruciopylib.file_table import rucio_file_table
+from ruciopylib.file_watch import directory_watch
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Iterable, List, Optional, Sequence
 import filelock
+import hashlib
+import mmap
 import os
+import shutil
+import socket
+import stat
 import tempfile
+import threading
+import time
 import pickle
+import uuid
+import zlib
+
+# How well the in-memory listing cache is doing.
+ListingCacheStats = namedtuple('ListingCacheStats', 'hits misses entries bytes')
+
+# How much disk a downloaded dataset uses, and when it was last used (a timestamp, None if never).
+DatasetUsage = namedtuple('DatasetUsage', 'name size last_access')
+
+# What was in a dataset directory when it was last scanned: the directory's mtime, and a
+# (name, size, mtime_ns) tuple for each file.
+DatasetManifest = namedtuple('DatasetManifest', 'dir_mtime_ns files')
+
+
+class DatasetVerification(namedtuple('DatasetVerification', 'missing wrong_size wrong_checksum')):
+    '''
+    Result of checking a downloaded dataset against its listing: the `RucioFile`s that are not on disk,
+    that have the wrong size, and that have the wrong adler32 checksum (only filled when checksums are
+    checked).
+    '''
+    @property
+    def ok(self) -> bool:
+        'True if nothing was wrong'
+        return len(self.missing) == 0 and len(self.wrong_size) == 0 and len(self.wrong_checksum) == 0
+
+
+# How to pick the datasets to remove when the cache is over quota:
+#   lru                 Least recently used first
+#   lru_size_weighted   Largest (time since last use) * size first, so big old datasets go before small ones
+EvictionPolicy = Enum('EvictionPolicy', 'lru, lru_size_weighted')
+
+# Directories in the cache that hold bookkeeping rather than datasets
+_bookkeeping_directories = {'cache', 'download_lock', 'done_downloading', 'pins', 'store', 'manifest'}
+
+# On-disk layout versions. Caches without a `layout_version` file are flat.
+#   1   Every listing, done mark and pin directory directly in `cache/`, `done_downloading/` and `pins/`.
+#   2   Those are spread over sub-directories named from a hash of the dataset name (`cache/ab/cd/<name>.pickle`).
+#       Lock files stay flat, so processes using either layout lock each other out. Lock files only exist
+#       while a download is running, so there are never very many of them.
+_layout_flat = 1
+_layout_sharded = 2
+_sharded_directories = {'cache', 'done_downloading', 'pins', 'manifest'}
+
+
+def _shard(name: str) -> str:
+    'The sub-directory a dataset lives in, in the sharded layout'
+    h = hashlib.sha1(name.encode()).hexdigest()
+    return "{0}/{1}".format(h[0:2], h[2:4])
+
+
+def file_adler32(path: str, chunk_size: int = 64 * 1024 * 1024) -> str:
+    '''
+    Calculate the adler32 checksum of a file, the way rucio prints it (8 hex digits). The file is
+    memory mapped and fed to zlib in large chunks (zlib releases the GIL, so this runs in parallel
+    on several threads).
+    '''
+    value = 1
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return '{0:08x}'.format(value)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                for start in range(0, len(view), chunk_size):
+                    value = zlib.adler32(view[start:start + chunk_size], value)
+            finally:
+                view.release()
+    return '{0:08x}'.format(value)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _pin_is_live(pin_file: str) -> bool:
+    '''
+    A pin is live if its lease has not expired, and (if it was made on this host) the process that made
+    it is still running. A pin with host `-` is not tied to any process (see `fetch_from_shared`).
+    '''
+    try:
+        with open(pin_file, 'r') as f:
+            expires, host, pid = f.read().split()
+    except (FileNotFoundError, ValueError):
+        return False
+    if float(expires) < datetime.now().timestamp():
+        return False
+    if host == socket.gethostname() and not _process_alive(int(pid)):
+        return False
+    return True
+
+
+def _write_lock_holder(lock_file: str) -> None:
+    '''
+    Write the pid and host of this process into a lock file we hold. Newer versions of `filelock` already
+    write the same two lines into a `SoftFileLock`, in which case it is left alone.
+    '''
+    if os.path.getsize(lock_file) == 0:
+        with open(lock_file, 'w') as f:
+            f.write("{0}\n{1}\n".format(os.getpid(), socket.gethostname()))
+
+
+def _lock_holder_is_dead(lock_file: str) -> Optional[bool]:
+    '''
+    Read the pid and host a lock file holds. True if that process was on this host and is gone, False if it
+    is alive (or we can't tell - another host, or the file is still being written), None if there is no file.
+    '''
+    try:
+        with open(lock_file, 'r') as f:
+            lines = f.read().split('\n')
+    except FileNotFoundError:
+        return None
+    try:
+        pid, host = int(lines[0]), lines[1]
+    except (ValueError, IndexError):
+        return False
+    return host == socket.gethostname() and not _process_alive(pid)
+
+
+def _reclaim_stale_lock(lock_file: str) -> bool:
+    '''
+    Remove a lock file left behind by a process on this host that has died.
+
+    The lock file is first renamed to a name only we use (an atomic step), and checked again there. If
+    someone else reclaimed it and took the lock in the meantime, it is the new holder's file we have, and it
+    is linked back into place.
+
+    A holder that died after creating the lock file, but before writing its pid and host into it, leaves an
+    empty lock file that can't be reclaimed. It has to be removed by hand.
+
+    Returns:
+        True        The lock file is gone (it was stale, or was released while we looked)
+        False       The lock is held, or we can't tell who holds it (e.g. another host, or it is still
+                    being written).
+    '''
+    dead = _lock_holder_is_dead(lock_file)
+    if dead is None:
+        return True
+    if not dead:
+        return False
+    f_reclaim = "{0}.{1}.{2}.reclaim".format(lock_file, os.getpid(), uuid.uuid4().hex)
+    try:
+        os.rename(lock_file, f_reclaim)
+    except FileNotFoundError:
+        return True
+    if _lock_holder_is_dead(f_reclaim):
+        os.unlink(f_reclaim)
+        return True
+    # We took a live lock - put it back.
+    try:
+        os.link(f_reclaim, lock_file)
+    except FileExistsError:
+        pass
+    os.unlink(f_reclaim)
+    return False
+
+
+class _download_lock:
+    r'''
+    A dataset download lock. Wraps a `filelock` lock, and, for locks that are held just by the lock file
+    existing (`SoftFileLock`), records the pid and host of the holder in the lock file so a lock left behind
+    by a process that died can be reclaimed.
+
+    Use it in a with statement. Raises `filelock.Timeout` if someone else holds the lock.
+    '''
+    def __init__(self, lock_class, lock_file: str):
+        self.lock_file = lock_file
+        self._lock = lock_class(lock_file, 0)
+        self.reclaimable = issubclass(lock_class, filelock.SoftFileLock)
+
+    def acquire(self) -> None:
+        try:
+            self._lock.acquire()
+        except filelock.Timeout:
+            if not (self.reclaimable and _reclaim_stale_lock(self.lock_file)):
+                raise
+            self._lock.acquire()
+        if self.reclaimable:
+            _write_lock_holder(self.lock_file)
+
+    def release(self) -> None:
+        self._lock.release()
+
+    @property
+    def is_locked(self) -> bool:
+        return self._lock.is_locked
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class dataset_pin:
+    r'''
+    Marks a dataset as in use, so it will not be evicted from the cache. Works across processes: each pin
+    is a lease file in the cache that holds an expiry time, and the host and pid of the process that owns
+    it. Pins whose lease has expired, or whose process has died, are ignored (and cleaned up).
+
+    Use it in a `with` statement, or call `release` when done. Call `renew` to extend the lease when
+    reading for longer than the lease.
+    '''
+    def __init__(self, pin_dir: str, name: str, lease: timedelta):
+        self.name = name
+        self.files = None
+        self._lease = lease
+        self._pin_file = "{0}/{1}-{2}-{3}.pin".format(pin_dir, socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.renew()
+
+    def renew(self, lease: Optional[timedelta] = None) -> None:
+        'Extend the lease to `lease` (defaults to the original lease) from now'
+        if lease is not None:
+            self._lease = lease
+        expires = (datetime.now() + self._lease).timestamp()
+        f_temp = self._pin_file + '.tmp'
+        with open(f_temp, 'w') as f:
+            f.write("{0} {1} {2}\n".format(expires, socket.gethostname(), os.getpid()))
+        os.replace(f_temp, self._pin_file)
+
+    def release(self) -> None:
+        'Remove the pin. Safe to call more than once'
+        try:
+            os.unlink(self._pin_file)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def released(self) -> bool:
+        return not os.path.exists(self._pin_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def local_filename(filename: str) -> str:
+    'The name a file from a listing (`scope:name`) has on disk'
+    return filename.split(':')[-1]
+
+
+def size_matches(actual: int, expected: int) -> bool:
+    '''
+    Does the size on disk match the listing? The command line tools print sizes rounded to three
+    decimal places (e.g. `1.981 GB`), so allow for that.
+    '''
+    return abs(actual - expected) <= expected * 0.0005 + 1
+
+
+def _as_file_table(files: Optional[Sequence[RucioFile]]) -> Optional[rucio_file_table]:
+    if files is None or isinstance(files, rucio_file_table):
+        return files
+    return rucio_file_table(files)
 
 
 class dataset_listing_info:
@@ -23,10 +296,60 @@ class dataset_listing_info:
         Arguments
         created_time:   When this listing was created. Used to calculate age
         flies:          Listing of files. None means the dataset does not exist. Empty list means an empty dataset.
+                        Stored as a compact `rucio_file_table`.
         '''
         self.Name = name
         self.Created = created_time if created_time is not None else datetime.now()
-        self.FileList = files
+        self.FileList = _as_file_table(files)
+
+    def __setstate__(self, state):
+        # Listings pickled before the file table was introduced have a plain list.
+        self.__dict__.update(state)
+        self.FileList = _as_file_table(self.FileList)
+
+
+class _listing_lru:
+    '''
+    Bounded, in-memory, least-recently-used cache of listings. Each entry carries a stamp (file mtime,
+    catalog generation, etc.) - an entry is only used if the stamp still matches.
+    '''
+    def __init__(self, max_entries: int, max_bytes: Optional[int]):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str, stamp) -> Optional[dataset_listing_info]:
+        with self._lock:
+            e = self._entries.get(name)
+            if e is None or e[0] != stamp:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return e[2]
+
+    def put(self, name: str, stamp, size: int, listing: dataset_listing_info) -> None:
+        with self._lock:
+            self._remove(name)
+            if self._max_bytes is not None and size > self._max_bytes:
+                return
+            self._entries[name] = (stamp, size, listing)
+            self._bytes += size
+            while len(self._entries) > self._max_entries or (self._max_bytes is not None and self._bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, name: str) -> None:
+        e = self._entries.pop(name, None)
+        if e is not None:
+            self._bytes -= e[1]
+
+    def stats(self) -> ListingCacheStats:
+        with self._lock:
+            return ListingCacheStats(self.hits, self.misses, len(self._entries), self._bytes)
 
 
 class dataset_local_cache:
@@ -37,44 +360,269 @@ class dataset_local_cache:
     This code does not talk to rucio - code that does talks to this code.
     '''
 
-    def __init__(self, location=None):
+    def __init__(self, location=None, listing_catalog=None,
+                 listing_cache_entries: int = 256, listing_cache_bytes: Optional[int] = None,
+                 quota_bytes: Optional[int] = None, eviction_policy: EvictionPolicy = EvictionPolicy.lru,
+                 file_store: bool = False, sharded: Optional[bool] = None,
+                 shared: Optional['dataset_local_cache'] = None, link_shared_files: bool = False,
+                 lock_class=filelock.SoftFileLock):
         '''
         Initialize the dataset cache.
 
         Arguments:
             location            If given, use that as the proper location of the cache.
                                 Defaults to a temp directory /tmp/rucio-cache.
+            listing_catalog     If given, store the dataset listings here (e.g. a `sqlite_listing_catalog`)
+                                instead of a pickle file per dataset. Listings still in pickle files are
+                                moved into the catalog as they are read (or all at once with
+                                `migrate_listings_to_catalog`).
+            listing_cache_entries
+                                How many listings to keep in memory. Zero turns off the in-memory cache.
+                                Listings are checked against the file mtime (or catalog generation) before
+                                they are used, so changes from other processes are seen.
+            listing_cache_bytes If not None, the in-memory cache is also limited to this many bytes (as measured
+                                by the size of the pickle file or approximate catalog size).
+            quota_bytes         If not None, the most disk the downloaded datasets may use. Before a download
+                                `make_room` removes datasets (see `eviction_policy`) to fit it in.
+            eviction_policy     How to choose which datasets to remove when over quota.
+            file_store          If True, keep one copy of each file in a store (`store/<scope>/<name>`) and
+                                hard link (or, if that fails, symlink) it into each dataset that contains it.
+                                A file already downloaded for one dataset is not downloaded again for another.
+            sharded             If True, use the sharded directory layout, which copes with many more datasets.
+                                An existing flat cache is migrated (see `migrate_layout`). Otherwise use whatever
+                                layout the cache on disk has (flat for a new cache).
+            shared              A second, shared, cache (e.g. on NFS or Lustre) that sits behind this one. Listings
+                                not found here are read from it, and listings saved here are also saved to it.
+                                Files it already has are copied here rather than downloaded (`fetch_from_shared`),
+                                and files downloaded here are copied to it (`publish_to_shared`).
+            link_shared_files   Symlink files from the shared cache rather than copying them.
+            lock_class          The `filelock` class used for the download locks in this cache. `SoftFileLock`
+                                (the default) works on any file system; `filelock.FileLock` is more robust
+                                on a local disk (the lock goes away if the process dies).
         '''
         self._loc = location if location is not None else "{0}/rucio-cache".format(tempfile.gettempdir())
         if not os.path.exists(self._loc):
             os.mkdir(self._loc)
+        self._catalog = listing_catalog
+        self._made_directories = set()
+        self._listing_cache = _listing_lru(listing_cache_entries, listing_cache_bytes) if listing_cache_entries > 0 else None
+        self._manifest_cache = _listing_lru(listing_cache_entries, None) if listing_cache_entries > 0 else None
+        self._last_touch = {}
+        self._quota_bytes = quota_bytes
+        self._eviction_policy = eviction_policy
+        self._file_store = file_store
+        self._shared = shared
+        self._link_shared_files = link_shared_files
+        self._lock_class = lock_class
+
+        layout = self._read_layout()
+        if layout is not None and layout not in (_layout_flat, _layout_sharded):
+            raise Exception("The cache at {0} has layout version {1}, which this version of ruciopylib does not know about".format(self._loc, layout))
+        self._sharded = layout == _layout_sharded
+        if sharded and not self._sharded:
+            self.migrate_layout()
 
     def get_download_directory(self):
         'Return the directory where all data should be downloaded'
         return self._loc
 
+    def get_ds_directory(self, name: str) -> str:
+        'Return the directory where the files for a dataset are downloaded to'
+        return "{0}/{1}".format(self._loc, name)
+
     def _get_directory(self, dirname):
         d = "{self._loc}/{dirname}".format(**locals())
-        if not os.path.exists(d):
-            os.mkdir(d)
+        if d not in self._made_directories:
+            if not os.path.exists(d):
+                os.makedirs(d, exist_ok=True)
+            self._made_directories.add(d)
         return d
 
     def _get_filename(self, dirname, fname_stub, ext="pickle"):
+        if self._sharded and dirname in _sharded_directories:
+            dirname = "{0}/{1}".format(dirname, _shard(fname_stub))
         d = self._get_directory(dirname)
         return "{d}/{fname_stub}.{ext}".format(**locals())
 
+    def _flat_filename(self, dirname, fname_stub, ext="pickle"):
+        return "{0}/{1}/{2}.{3}".format(self._loc, dirname, fname_stub, ext)
+
+    def _find_filename(self, dirname, fname_stub, ext="pickle"):
+        '''
+        Where a file that should already exist is. During a layout migration it may still be at its flat
+        location, or the cache may have been migrated by another process.
+        '''
+        f_name = self._get_filename(dirname, fname_stub, ext)
+        if os.path.exists(f_name):
+            return f_name
+        if self._sharded:
+            f_flat = self._flat_filename(dirname, fname_stub, ext)
+            if os.path.exists(f_flat):
+                return f_flat
+        elif self._check_layout():
+            return self._find_filename(dirname, fname_stub, ext)
+        return f_name
+
+    def _layout_filename(self) -> str:
+        return "{0}/layout_version".format(self._loc)
+
+    def _read_layout(self) -> Optional[int]:
+        try:
+            with open(self._layout_filename(), 'r') as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def _check_layout(self) -> bool:
+        'Switch to the sharded layout if someone has migrated the cache. Returns True if we switched'
+        if not self._sharded and self._read_layout() == _layout_sharded:
+            self._sharded = True
+            return True
+        return False
+
+    def migrate_layout(self, log_func=None) -> int:
+        '''
+        Move the cache to the sharded layout. Safe to run while other processes are using the cache: they
+        look in both places, and switch to the sharded layout once they see it has been migrated. Pin files
+        are left where they are (they belong to running processes), and are still checked.
+
+        Returns:
+            count           The number of listings and done marks moved.
+        '''
+        f_temp = "{0}.{1}.tmp".format(self._layout_filename(), os.getpid())
+        with open(f_temp, 'w') as f:
+            f.write("{0}\n".format(_layout_sharded))
+        os.replace(f_temp, self._layout_filename())
+        self._sharded = True
+
+        count = 0
+        for dirname, ext in [("cache", "pickle"), ("done_downloading", "txt"), ("manifest", "pickle")]:
+            d = "{0}/{1}".format(self._loc, dirname)
+            if not os.path.isdir(d):
+                continue
+            for entry in os.scandir(d):
+                if not entry.is_file() or not entry.name.endswith("." + ext):
+                    continue
+                f_new = self._get_filename(dirname, entry.name[:-len(ext) - 1], ext)
+                if os.path.exists(f_new):
+                    # Someone already wrote it in the new layout - that is the newer one.
+                    os.unlink(entry.path)
+                else:
+                    os.replace(entry.path, f_new)
+                count += 1
+        if log_func is not None:
+            log_func("Moved {0} files in the cache at {1} to the sharded layout".format(count, self._loc))
+        return count
+
     def save_listing(self, ds_listing: dataset_listing_info) -> None:
-        'Save a listing to the cache'
-        with open(self._get_filename("cache", ds_listing.Name), 'wb') as f:
+        'Save a listing to the cache (and the shared cache behind it)'
+        if self._shared is not None:
+            self._shared.save_listing(ds_listing)
+        self._save_local_listing(ds_listing)
+
+    def _save_local_listing(self, ds_listing: dataset_listing_info) -> None:
+        if self._catalog is not None:
+            self._catalog.save_listing(ds_listing)
+            return
+        # Write to a temp file and move it in place so readers never see a partial file, and
+        # every save results in a new file (which the in-memory cache relies on).
+        self._check_layout()
+        f_name = self._get_filename("cache", ds_listing.Name)
+        f_temp = "{0}.{1}.{2}.tmp".format(f_name, os.getpid(), threading.get_ident())
+        with open(f_temp, 'wb') as f:
             pickle.dump(ds_listing, f)
+        os.replace(f_temp, f_name)
+        if self._sharded:
+            # Do not leave an out of date copy from before the migration.
+            try:
+                os.unlink(self._flat_filename("cache", ds_listing.Name))
+            except FileNotFoundError:
+                pass
 
     def get_listing(self, name) -> Optional[dataset_listing_info]:
-        'Return the listing. None if the listing does not exist'
-        f_name = self._get_filename("cache", name)
-        if not os.path.exists(f_name):
+        '''
+        Return the listing. None if the listing does not exist. The listing may be shared with other
+        callers, so do not modify it.
+        '''
+        listing = self._get_local_listing(name)
+        if listing is None and self._shared is not None:
+            listing = self._shared.get_listing(name)
+            if listing is not None:
+                self._save_local_listing(listing)
+        return listing
+
+    def _get_local_listing(self, name) -> Optional[dataset_listing_info]:
+        if self._catalog is not None:
+            generation = self._catalog.get_generation(name)
+            if generation is None:
+                # Not in the catalog yet - see if it is in an old pickle file.
+                listing = self._get_pickled_listing(name)
+                if listing is not None:
+                    self._catalog.save_listing(listing)
+                return listing
+            return self._cached_listing(name, generation, lambda: self._catalog.get_listing(name),
+                                        lambda l: 100 * (len(l.FileList) if l.FileList is not None else 1))
+
+        return self._get_pickled_listing(name)
+
+    def _get_pickled_listing(self, name) -> Optional[dataset_listing_info]:
+        f_name = self._find_filename("cache", name)
+        try:
+            st = os.stat(f_name)
+        except FileNotFoundError:
             return None
-        with open(f_name, 'rb') as f:
-            return pickle.load(f)
+
+        def load():
+            with open(f_name, 'rb') as f:
+                return pickle.load(f)
+        return self._cached_listing(name, (st.st_mtime_ns, st.st_size, st.st_ino), load, lambda _: st.st_size)
+
+    def _cached_listing(self, name, stamp, load, size) -> Optional[dataset_listing_info]:
+        'Use the in-memory cache if it has this listing with the same stamp, otherwise load it'
+        if self._listing_cache is None:
+            return load()
+        listing = self._listing_cache.get(name, stamp)
+        if listing is None:
+            listing = load()
+            if listing is not None:
+                self._listing_cache.put(name, stamp, size(listing), listing)
+        return listing
+
+    def listing_cache_stats(self) -> ListingCacheStats:
+        'How the in-memory listing cache is doing'
+        if self._listing_cache is None:
+            return ListingCacheStats(0, 0, 0, 0)
+        return self._listing_cache.stats()
+
+    def migrate_listings_to_catalog(self, remove_pickles: bool = False) -> int:
+        '''
+        Copy all listings in pickle files into the listing catalog. Safe to run while other processes
+        are using the cache.
+
+        Arguments:
+            remove_pickles      Delete the pickle files once they are in the catalog. Only do this if no
+                                process is still using the cache without the catalog.
+
+        Returns:
+            count               Number of listings copied into the catalog.
+        '''
+        if self._catalog is None:
+            raise Exception("No listing catalog to migrate the listings to")
+        count = 0
+        for d, _, files in os.walk(self._get_directory("cache")):
+            for f_name in files:
+                if not f_name.endswith(".pickle"):
+                    continue
+                with open("{0}/{1}".format(d, f_name), 'rb') as f:
+                    listing = pickle.load(f)
+                # Do not overwrite something newer.
+                current = self._catalog.get_listing(listing.Name)
+                if current is None or current.Created < listing.Created:
+                    self._catalog.save_listing(listing)
+                    count += 1
+                if remove_pickles:
+                    os.unlink("{0}/{1}".format(d, f_name))
+        return count
 
     def mark_dataset_done(self, name: str) -> None:
         '''
@@ -83,17 +631,109 @@ class dataset_local_cache:
         Arguments:
             name:       Name of the dataset
         '''
-        f_done = self._get_filename("done_downloading", name, ext="txt")
-        if not os.path.exists(os.path.basename(f_done)):
-            os.mkdir(os.path.basename(f_done))
+        self._check_layout()
+        # An empty dataset downloads nothing, so rucio never made its directory.
+        os.makedirs(self.get_ds_directory(name), exist_ok=True)
+        self._write_manifest(name)
+        f_done = self._find_filename("done_downloading", name, ext="txt")
         if not os.path.exists(f_done):
             with open(f_done, 'w') as f:
                 f.write("Done\n")
 
-    def get_dataset_downloading_lock(self, ds_name: str) -> None:
-        'Returns a lock. Use in a with statement'
+    def _scan_ds_directory(self, name: str) -> Optional[DatasetManifest]:
+        'Look at what is in the dataset directory. None if there is no directory'
+        d = self.get_ds_directory(name)
+        try:
+            dir_mtime = os.stat(d).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        files = []
+        for entry in os.scandir(d):
+            if entry.name.endswith(".part"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                # A symlink to a file that has gone away
+                continue
+            files.append((entry.name, st.st_size, st.st_mtime_ns))
+        return DatasetManifest(dir_mtime, files)
+
+    def _write_manifest(self, name: str, manifest: Optional[DatasetManifest] = None) -> Optional[DatasetManifest]:
+        'Scan the dataset directory (unless given the result) and save it as the manifest'
+        if manifest is None:
+            manifest = self._scan_ds_directory(name)
+            if manifest is None:
+                return None
+        f_name = self._get_filename("manifest", name)
+        f_temp = "{0}.{1}.{2}.tmp".format(f_name, os.getpid(), threading.get_ident())
+        with open(f_temp, 'wb') as f:
+            pickle.dump(manifest, f)
+        os.replace(f_temp, f_name)
+        return manifest
+
+    def _read_manifest(self, name: str) -> Optional[DatasetManifest]:
+        f_name = self._find_filename("manifest", name)
+        try:
+            st = os.stat(f_name)
+        except FileNotFoundError:
+            return None
+
+        def load():
+            with open(f_name, 'rb') as f:
+                return pickle.load(f)
+        if self._manifest_cache is None:
+            return load()
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        manifest = self._manifest_cache.get(name, stamp)
+        if manifest is None:
+            manifest = load()
+            self._manifest_cache.put(name, stamp, 0, manifest)
+        return manifest
+
+    def get_dataset_downloading_lock(self, ds_name: str) -> _download_lock:
+        'Returns a lock. Use in a with statement. A lock left behind by a process that has died is reclaimed.'
         f_lock = self._get_filename('download_lock', ds_name, ext='lock')
-        return filelock.SoftFileLock(f_lock, 0)
+        return _download_lock(self._lock_class, f_lock)
+
+    def _download_lock_held(self, lock: _download_lock) -> bool:
+        'True if someone holds the lock. Stale lock files are removed.'
+        if lock.reclaimable:
+            return os.path.exists(lock.lock_file) and not _reclaim_stale_lock(lock.lock_file)
+        try:
+            lock.acquire()
+        except filelock.Timeout:
+            return True
+        lock.release()
+        return False
+
+    def wait_for_download_lock(self, ds_name: str, timeout: Optional[float] = None) -> bool:
+        '''
+        Block until nobody holds the download lock for a dataset (e.g. another process finishes downloading
+        or querying it). The lock file is watched with inotify where possible, so this returns as soon as it is
+        released; otherwise it is polled with a back-off. A lock left behind by a process that has died is
+        removed.
+
+        Arguments:
+            ds_name         Name of the dataset
+            timeout         Give up after this many seconds. None to wait forever.
+
+        Returns:
+            True            The lock is free (it is not taken - use `get_dataset_downloading_lock` for that).
+            False           Timed out.
+        '''
+        lock = self.get_dataset_downloading_lock(ds_name)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        # Locks that aren't lock files that come and go (e.g. `filelock.FileLock`) must be tried to see if they
+        # are free, which makes inotify events of our own - so they are only polled.
+        with directory_watch(os.path.dirname(lock.lock_file), names=[os.path.basename(lock.lock_file)],
+                             use_inotify=lock.reclaimable) as watch:
+            while self._download_lock_held(lock):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                watch.wait(remaining)
+        return True
 
     def _check_dataset_done(self, name: str) -> bool:
         '''
@@ -106,15 +746,17 @@ class dataset_local_cache:
             True        The mark file is present
             False       The mark file is not present.
         '''
-        f_done = self._get_filename("done_downloading", name, ext="txt")
+        f_done = self._find_filename("done_downloading", name, ext="txt")
         return os.path.exists(f_done)
 
-    def get_ds_contents(self, name: str) -> Optional[List[str]]:
+    def get_ds_contents(self, name: str, verify: bool = False) -> Optional[List[str]]:
         '''
-        Return the list of files in the current dataset
+        Return the list of files in the current dataset. This comes from the manifest written when the
+        dataset was marked done, as long as the dataset directory has not changed (its mtime is checked).
 
         Args:
             name:       Name fo the dataset
+            verify:     If True, also check the size and mtime of every file against the manifest.
 
         Returns:
             [files]:    List of files.
@@ -127,13 +769,565 @@ class dataset_local_cache:
         if not self._check_dataset_done(name):
             return None
 
-        f_name = "{0}/{1}".format(self._loc, name)
-        if not os.path.isdir(f_name):
+        try:
+            dir_mtime = os.stat(self.get_ds_directory(name)).st_mtime_ns
+        except FileNotFoundError:
+            # Empty datasets marked done before their directory was made when marking them. Otherwise
+            # someone removed the directory, and the done mark is wrong.
+            listing = self.get_listing(name)
+            if listing is not None and listing.FileList is not None and len(listing.FileList) == 0:
+                return []
+            try:
+                os.unlink(self._find_filename("done_downloading", name, ext="txt"))
+            except FileNotFoundError:
+                pass
             return None
 
-        # Find all the non-part files in the directory.
+        manifest = self._read_manifest(name)
+        if manifest is None or manifest.dir_mtime_ns != dir_mtime:
+            manifest = self._write_manifest(name)
+        elif verify:
+            current = self._scan_ds_directory(name)
+            if current != manifest:
+                manifest = self._write_manifest(name, current)
+        if manifest is None:
+            return None
+
+        self._touch_dataset(name)
+        return ["{0}/{1}".format(name, f[0]) for f in manifest.files]
+
+    def _touch_dataset(self, name: str) -> None:
+        '''
+        Record that the dataset was used just now (the done mark mtime is the last access time). This
+        is only done once a minute, as on a network file system it is not cheap.
+        '''
+        now = datetime.now().timestamp()
+        if now - self._last_touch.get(name, 0) < 60:
+            return
+        self._last_touch[name] = now
+        try:
+            os.utime(self._find_filename("done_downloading", name, ext="txt"))
+        except FileNotFoundError:
+            pass
+
+    def get_missing_files(self, name: str, files: List[RucioFile]) -> List[RucioFile]:
+        '''
+        Compare the files from a dataset listing to what is on disk.
+
+        Arguments:
+            name:       Name of the dataset
+            files:      The dataset listing
+
+        Returns:
+            [files]:    The files from the listing that are not on disk, or whose size on
+                        disk does not match the listing.
+        '''
+        d = self.get_ds_directory(name)
+        missing = []
+        for f in files:
+            try:
+                size = os.stat("{0}/{1}".format(d, local_filename(f.filename))).st_size
+            except FileNotFoundError:
+                missing.append(f)
+                continue
+            if not size_matches(size, f.size):
+                missing.append(f)
+        return missing
+
+    def get_partial_files(self, name: str) -> List[str]:
+        '''
+        Return the `.part` files that a download left behind in the dataset directory. Those
+        are files that were not completely downloaded.
+        '''
+        d = self.get_ds_directory(name)
+        if not os.path.isdir(d):
+            return []
+        return ["{0}/{1}".format(name, f) for f in os.listdir(d) if f.endswith(".part")]
+
+    def remove_partial_files(self, name: str) -> List[str]:
+        '''
+        Delete all the `.part` files left behind by a download. Only do this when holding the
+        download lock for the dataset!
+
+        Returns:
+            [files]:    The files that were removed.
+        '''
+        removed = self.get_partial_files(name)
+        for f in removed:
+            os.unlink("{0}/{1}".format(self._loc, f))
+        return removed
+
+    def get_dataset_usage(self) -> List[DatasetUsage]:
+        '''
+        How much disk each dataset in the cache uses. Datasets that are not completely downloaded have
+        a `last_access` of None.
+        '''
         result = []
-        for f in os.listdir(f_name):
-            if not f.endswith(".part"):
-                result.append("{name}/{f}".format(**locals()))
+        for entry in os.scandir(self._loc):
+            if not entry.is_dir() or entry.name in _bookkeeping_directories:
+                continue
+            # Only count what removing the dataset would free: files linked into other datasets
+            # from the store stay.
+            size = 0
+            for st in self._walk_files(entry.path):
+                if st.st_nlink <= (2 if self._file_store else 1):
+                    size += st.st_size
+            try:
+                last_access = os.stat(self._find_filename("done_downloading", entry.name, ext="txt")).st_mtime
+            except FileNotFoundError:
+                last_access = None
+            result.append(DatasetUsage(entry.name, size, last_access))
+        return result
+
+    def _walk_files(self, d: str):
+        'The stat of each regular file under a directory (symlinks are skipped)'
+        for d, _, files in os.walk(d):
+            for f in files:
+                try:
+                    st = os.lstat(os.path.join(d, f))
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISLNK(st.st_mode):
+                    yield st
+
+    def get_cache_size(self) -> int:
+        'Bytes used by all the downloaded datasets (files linked into several datasets are counted once)'
+        seen = set()
+        size = 0
+        for entry in os.scandir(self._loc):
+            if not entry.is_dir() or (entry.name in _bookkeeping_directories and entry.name != 'store'):
+                continue
+            for st in self._walk_files(entry.path):
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    size += st.st_size
+        return size
+
+    def evict_dataset(self, name: str) -> bool:
+        '''
+        Remove a downloaded dataset from disk (the listing is kept). The dataset is not touched if someone
+        holds its download lock, or it is pinned. The done mark is removed before the pins are checked,
+        so anyone pinning the dataset at the same time will either be seen, or will see the dataset as
+        not downloaded.
+
+        Returns:
+            True        The dataset was removed.
+            False       The dataset is locked by someone else or pinned.
+        '''
+        try:
+            with self.get_dataset_downloading_lock(name):
+                if self.is_pinned(name):
+                    return False
+                f_done = self._find_filename("done_downloading", name, ext="txt")
+                try:
+                    done_stat = os.stat(f_done)
+                    os.unlink(f_done)
+                except FileNotFoundError:
+                    done_stat = None
+                if self.is_pinned(name):
+                    if done_stat is not None:
+                        self.mark_dataset_done(name)
+                        os.utime(self._find_filename("done_downloading", name, ext="txt"),
+                                 ns=(done_stat.st_atime_ns, done_stat.st_mtime_ns))
+                    return False
+                shutil.rmtree(self.get_ds_directory(name), ignore_errors=True)
+                try:
+                    os.unlink(self._find_filename("manifest", name))
+                except FileNotFoundError:
+                    pass
+                if self._shared is not None:
+                    # Nothing here links to the shared cache's copy any more.
+                    try:
+                        os.unlink(self._shared_link_pin_file(name))
+                    except FileNotFoundError:
+                        pass
+                return True
+        except filelock.Timeout:
+            return False
+
+    def _pin_directory(self, name: str) -> str:
+        if self._sharded:
+            return self._get_directory("pins/{0}/{1}".format(_shard(name), name))
+        return self._get_directory("pins/{0}".format(name))
+
+    def pin_dataset(self, name: str, lease: timedelta = timedelta(hours=1)) -> dataset_pin:
+        '''
+        Pin a dataset so it will not be evicted. This does not check the dataset is downloaded -
+        see `get_pinned_ds_contents`.
+
+        Arguments:
+            name        Name of the dataset
+            lease       How long the pin lasts if it is not released or renewed.
+        '''
+        return dataset_pin(self._pin_directory(name), name, lease)
+
+    def is_pinned(self, name: str) -> bool:
+        'True if anyone holds a live pin on the dataset. Dead pins are removed.'
+        self._check_layout()
+        # Pins made before the cache was migrated to the sharded layout stay in the flat location.
+        pin_dirs = ["{0}/pins/{1}".format(self._loc, name)]
+        if self._sharded:
+            pin_dirs.append("{0}/pins/{1}/{2}".format(self._loc, _shard(name), name))
+        pinned = False
+        for d in pin_dirs:
+            if not os.path.isdir(d):
+                continue
+            for f in os.listdir(d):
+                if not f.endswith('.pin'):
+                    continue
+                if _pin_is_live("{0}/{1}".format(d, f)):
+                    pinned = True
+                else:
+                    try:
+                        os.unlink("{0}/{1}".format(d, f))
+                    except FileNotFoundError:
+                        pass
+        return pinned
+
+    def get_pinned_ds_contents(self, name: str, lease: timedelta = timedelta(hours=1)) -> Optional[dataset_pin]:
+        '''
+        Like `get_ds_contents`, but the dataset is pinned so it can not be evicted while it is being used.
+
+        Returns:
+            pin         The pin, with the files in `pin.files`. Release it when done with the files.
+                        None if the dataset has not been downloaded (and nothing is left pinned).
+        '''
+        # Pin before looking, so an eviction either sees the pin or has already removed the done mark.
+        pin = self.pin_dataset(name, lease)
+        files = self.get_ds_contents(name)
+        if files is None:
+            pin.release()
+            return None
+        pin.files = files
+        return pin
+
+    def _eviction_order(self, usage: List[DatasetUsage]) -> List[DatasetUsage]:
+        # Incomplete datasets (left over from failed downloads) go first.
+        now = datetime.now().timestamp()
+        if self._eviction_policy == EvictionPolicy.lru_size_weighted:
+            return sorted(usage, key=lambda u: -float('inf') if u.last_access is None else -(now - u.last_access) * u.size)
+        return sorted(usage, key=lambda u: -float('inf') if u.last_access is None else u.last_access)
+
+    def make_room(self, needed_bytes: int, keep: Iterable[str] = (), log_func=None) -> bool:
+        '''
+        Remove datasets until `needed_bytes` more will fit in the quota. Datasets that are locked (being
+        downloaded or evicted by someone else) are skipped.
+
+        Arguments:
+            needed_bytes    How much space is about to be used
+            keep            Datasets that should not be removed (e.g. the one about to be downloaded)
+            log_func        Called with a line for each dataset removed
+
+        Returns:
+            True            There is room (or there is no quota)
+            False           Even after removing everything we could, there is not enough room.
+        '''
+        if self._quota_bytes is None:
+            return True
+        if needed_bytes > self._quota_bytes:
+            return False
+
+        usage = self.get_dataset_usage()
+        used = self.get_cache_size()
+        keep = set(keep)
+        for u in self._eviction_order([u for u in usage if u.name not in keep]):
+            if used + needed_bytes <= self._quota_bytes:
+                break
+            if self.evict_dataset(u.name):
+                used -= u.size
+                if log_func is not None:
+                    log_func(f'Removed dataset {u.name} ({u.size} bytes) from the cache to make room')
+        if self._file_store:
+            self.gc_store()
+        return used + needed_bytes <= self._quota_bytes
+
+    def _store_path(self, filename: str) -> str:
+        'Where a file (`scope:name`) lives in the store'
+        scope, _, name = filename.rpartition(':')
+        return "{0}/{1}".format(self._get_directory("store/{0}".format(scope if scope != '' else '_noscope')), name)
+
+    def _link(self, src: str, dest: str) -> None:
+        'Make dest point to the same file as src. Hard link if possible, symlink otherwise'
+        try:
+            os.link(src, dest)
+        except OSError:
+            os.symlink(os.path.abspath(src), dest)
+
+    def link_from_store(self, name: str, files: Sequence[RucioFile]) -> List[RucioFile]:
+        '''
+        Link any file in the listing that is already in the store (downloaded for some other dataset)
+        into the dataset directory. Files whose size in the store does not match the listing are ignored.
+        Does nothing unless the cache was created with `file_store=True`.
+
+        Returns:
+            [files]     The files that were linked in.
+        '''
+        if not self._file_store:
+            return []
+        d = self.get_ds_directory(name)
+        linked = []
+        for f in files:
+            dest = "{0}/{1}".format(d, local_filename(f.filename))
+            if os.path.lexists(dest):
+                continue
+            src = self._store_path(f.filename)
+            try:
+                if not size_matches(os.stat(src).st_size, f.size):
+                    continue
+                if not os.path.isdir(d):
+                    os.makedirs(d, exist_ok=True)
+                self._link(src, dest)
+            except FileNotFoundError:
+                # Not there (or removed by `gc_store` while we looked)
+                continue
+            linked.append(f)
+        return linked
+
+    def add_to_store(self, name: str, files: Sequence[RucioFile]) -> None:
+        '''
+        Put the downloaded files of a dataset into the store, so other datasets can use them. If the
+        store already has a good copy, the dataset's copy is replaced by a link to it.
+        Does nothing unless the cache was created with `file_store=True`.
+        '''
+        if not self._file_store:
+            return
+        d = self.get_ds_directory(name)
+        for f in files:
+            ds_file = "{0}/{1}".format(d, local_filename(f.filename))
+            if os.path.islink(ds_file) or not os.path.isfile(ds_file):
+                continue
+            store_file = self._store_path(f.filename)
+            try:
+                store_stat = os.stat(store_file)
+            except FileNotFoundError:
+                store_stat = None
+            if store_stat is not None:
+                ds_stat = os.stat(ds_file)
+                if (store_stat.st_dev, store_stat.st_ino) == (ds_stat.st_dev, ds_stat.st_ino):
+                    continue
+                if size_matches(store_stat.st_size, f.size):
+                    # Downloaded twice - keep the one in the store.
+                    f_temp = ds_file + '.link'
+                    self._link(store_file, f_temp)
+                    os.replace(f_temp, ds_file)
+                    continue
+            # Put this copy in the store (replacing a bad one).
+            f_temp = "{0}.{1}.{2}.tmp".format(store_file, os.getpid(), threading.get_ident())
+            try:
+                os.link(ds_file, f_temp)
+            except OSError:
+                # No hard links - move the file into the store, and link back to it.
+                os.replace(ds_file, f_temp)
+                os.symlink(os.path.abspath(store_file), ds_file)
+            os.replace(f_temp, store_file)
+
+    def gc_store(self) -> int:
+        '''
+        Remove files from the store that are no longer in any dataset.
+
+        Returns:
+            bytes       How much space was freed.
+        '''
+        store = "{0}/store".format(self._loc)
+        if not os.path.isdir(store):
+            return 0
+
+        # Files in the store that datasets point to with a symlink.
+        targets = set()
+        for entry in os.scandir(self._loc):
+            if not entry.is_dir() or entry.name in _bookkeeping_directories:
+                continue
+            for d, _, files in os.walk(entry.path):
+                for f in files:
+                    if os.path.islink(os.path.join(d, f)):
+                        targets.add(os.path.realpath(os.path.join(d, f)))
+
+        freed = 0
+        for d, _, files in os.walk(store):
+            for f in files:
+                path = os.path.join(d, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if st.st_nlink == 1 and not f.endswith('.tmp') and os.path.realpath(path) not in targets:
+                    os.unlink(path)
+                    freed += st.st_size
+        return freed
+
+    @property
+    def links_shared_files(self) -> bool:
+        'True if files found in the shared cache are linked, rather than copied, so they take no room here'
+        return self._shared is not None and self._link_shared_files
+
+    def fetch_from_shared(self, name: str, files: Sequence[RucioFile], log_func=None) -> List[RucioFile]:
+        '''
+        Copy (or link, see `link_shared_files`) the files in the listing that the shared cache already has
+        into this cache. Files whose size in the shared cache does not match the listing are ignored.
+        The dataset is pinned in the shared cache while the files are copied. If the files are linked, the
+        dataset stays pinned in the shared cache until it is evicted from this one.
+
+        Returns:
+            [files]     The files that were copied.
+        '''
+        if self._shared is None:
+            return []
+        d = self.get_ds_directory(name)
+        shared_d = self._shared.get_ds_directory(name)
+        fetched = []
+        with self._shared.pin_dataset(name):
+            if self._link_shared_files:
+                self._pin_shared_for_links(name)
+            for f in self.get_missing_files(name, files):
+                src = "{0}/{1}".format(shared_d, local_filename(f.filename))
+                dest = "{0}/{1}".format(d, local_filename(f.filename))
+                try:
+                    if not size_matches(os.stat(src).st_size, f.size):
+                        continue
+                    if not os.path.isdir(d):
+                        os.makedirs(d, exist_ok=True)
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    if self._link_shared_files:
+                        os.symlink(os.path.abspath(src), dest)
+                    else:
+                        # Copy to a .part file so a crash does not leave a bad file behind
+                        shutil.copyfile(src, dest + '.part')
+                        os.replace(dest + '.part', dest)
+                except FileNotFoundError:
+                    continue
+                fetched.append(f)
+        if log_func is not None and len(fetched) > 0:
+            log_func(f'Copied {len(fetched)} files of {name} from the shared cache')
+        return fetched
+
+    def _shared_link_pin_file(self, name: str) -> str:
+        'The pin in the shared cache that is held while files in this cache link to its copy of the dataset'
+        me = hashlib.sha1(os.path.abspath(self._loc).encode()).hexdigest()[0:16]
+        return "{0}/link-{1}.pin".format(self._shared._pin_directory(name), me)
+
+    def _pin_shared_for_links(self, name: str) -> None:
+        'Pin the dataset in the shared cache, with no expiry and no owning process, until `evict_dataset`'
+        f_pin = self._shared_link_pin_file(name)
+        f_temp = "{0}.{1}.tmp".format(f_pin, os.getpid())
+        with open(f_temp, 'w') as f:
+            f.write("inf - 0\n")
+        os.replace(f_temp, f_pin)
+
+    def publish_to_shared(self, name: str, files: Sequence[RucioFile], log_func=None) -> bool:
+        '''
+        Copy the files of a dataset that the shared cache does not have into it, and mark the dataset as
+        downloaded there. Uses the shared cache's own download lock, and gives up if someone holds it or
+        the shared cache can not make room.
+
+        Returns:
+            True        The shared cache has the complete dataset.
+            False       The dataset was not copied.
+        '''
+        if self._shared is None:
+            return False
+        try:
+            with self._shared.get_dataset_downloading_lock(name):
+                missing = self._shared.get_missing_files(name, files)
+                if not self._shared.make_room(sum(f.size for f in missing), keep=[name], log_func=log_func):
+                    return False
+                d = self.get_ds_directory(name)
+                shared_d = self._shared.get_ds_directory(name)
+                if not os.path.isdir(shared_d):
+                    os.makedirs(shared_d, exist_ok=True)
+                for f in missing:
+                    dest = "{0}/{1}".format(shared_d, local_filename(f.filename))
+                    shutil.copyfile("{0}/{1}".format(d, local_filename(f.filename)), dest + '.part')
+                    os.replace(dest + '.part', dest)
+                self._shared.add_to_store(name, files)
+                self._shared.mark_dataset_done(name)
+                if log_func is not None and len(missing) > 0:
+                    log_func(f'Copied {len(missing)} files of {name} to the shared cache')
+                return True
+        except filelock.Timeout:
+            return False
+
+    def verify_dataset(self, name: str, files: Optional[Sequence[RucioFile]] = None,
+                       checksums: bool = False, workers: int = 4, repair: bool = False,
+                       exact_sizes: bool = False, log_func=None) -> DatasetVerification:
+        '''
+        Check that the files of a downloaded dataset are all there, and the right size. Only `stat` is used,
+        unless `checksums` is True, in which case the adler32 checksum of every file (that has one in the
+        listing) is also calculated.
+
+        Arguments:
+            name        Name of the dataset
+            files       The dataset listing. Defaults to the listing in the cache.
+            checksums   Also check the adler32 checksums (reads every byte of every file).
+            workers     How many files to checksum at once.
+            repair      If a file is missing or bad, delete the bad files and remove the done mark, so the
+                        next download only fetches the files that are missing. Nothing is done if someone
+                        holds the download lock for the dataset.
+            exact_sizes The sizes in the listing are exact (see `rucio_backend.exact_sizes`). Otherwise they
+                        are rounded, so a file of the wrong size is only repaired if its checksum is also
+                        wrong.
+            log_func    Called with a line for each bad file
+
+        Returns:
+            result      The files that were bad
+        '''
+        if files is None:
+            listing = self.get_listing(name)
+            if listing is None or listing.FileList is None:
+                raise Exception("No listing for dataset {0}, so it can not be verified".format(name))
+            files = listing.FileList
+
+        d = self.get_ds_directory(name)
+        missing = []
+        wrong_size = []
+        to_checksum = []
+        for f in files:
+            path = "{0}/{1}".format(d, local_filename(f.filename))
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                missing.append(f)
+                continue
+            right_size = size == f.size if exact_sizes else size_matches(size, f.size)
+            if not right_size:
+                wrong_size.append(f)
+            if checksums and f.adler32 is not None and (right_size or not exact_sizes):
+                to_checksum.append((f, path))
+
+        wrong_checksum = []
+        if len(to_checksum) > 0:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                sums = list(executor.map(lambda fp: file_adler32(fp[1]), to_checksum))
+            wrong_checksum = [f for (f, _), adler32 in zip(to_checksum, sums) if adler32 != f.adler32.lower()]
+
+        result = DatasetVerification(missing, wrong_size, wrong_checksum)
+        if log_func is not None:
+            for what, bad in [('missing', missing), ('the wrong size', wrong_size), ('a bad checksum', wrong_checksum)]:
+                for f in bad:
+                    log_func(f'File {f.filename} of dataset {name} is {what}')
+        bad = wrong_checksum + [f for f in wrong_size if exact_sizes and f not in wrong_checksum]
+        if repair and (len(missing) > 0 or len(bad) > 0):
+            self._mark_for_redownload(name, bad)
         return result
+
+    def _mark_for_redownload(self, name: str, bad_files: Sequence[RucioFile]) -> None:
+        'Remove bad files and the done mark, so the next download fetches whatever is missing'
+        try:
+            with self.get_dataset_downloading_lock(name):
+                d = self.get_ds_directory(name)
+                for f in bad_files:
+                    path = "{0}/{1}".format(d, local_filename(f.filename))
+                    try:
+                        # Do not let the bad copy be linked back in from the store
+                        store_path = self._store_path(f.filename) if self._file_store else None
+                        if store_path is not None and os.path.exists(store_path) and os.path.samefile(path, store_path):
+                            os.unlink(store_path)
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                try:
+                    os.unlink(self._find_filename("done_downloading", name, ext="txt"))
+                except FileNotFoundError:
+                    pass
+        except filelock.Timeout:
+            pass
@@ -0,0 +1,146 @@
+# A compact, column oriented, list of RucioFile's. A dataset with 100k files as a list of
+# namedtuples is many megabytes of python objects, and slow to pickle.
+from ruciopylib.rucio import RucioFile, normalize_guid
+from array import array
+from collections.abc import Sequence
+from typing import Iterable, Optional
+import uuid
+
+# Stored in the GUID column when the GUID is not known
+_no_guid = bytes(16)
+
+
+def _guid_to_bytes(guid: Optional[str]) -> bytes:
+    return uuid.UUID(guid).bytes if guid is not None else _no_guid
+
+
+def _guid_from_bytes(guid: bytes) -> Optional[str]:
+    return str(uuid.UUID(bytes=guid)).upper() if guid != _no_guid else None
+
+
+class rucio_file_table(Sequence):
+    r'''
+    Read-only sequence of `RucioFile`s stored as columns: all the file names in a single string
+    (with an offset table), the sizes and event counts in 64 bit `array`s, the adler32 checksums in a
+    32 bit `array` (they use all 32 bits, so a byte per file says if the checksum is known), and the
+    GUIDs as 16 bytes each. Entries are turned back into `RucioFile`s as they are accessed.
+
+    The total size and number of events are calculated once, when the table is built.
+    '''
+    def __init__(self, files: Iterable[RucioFile]):
+        '''
+        Build the table.
+
+        Arguments:
+            files       The files that will be in the table.
+        '''
+        names = []
+        self._offsets = array('q', [0])
+        self._sizes = array('q')
+        self._events = array('q')
+        self._adler32 = array('I')
+        self._adler32_known = bytearray()
+        guids = []
+        for f in files:
+            names.append(f.filename)
+            self._offsets.append(self._offsets[-1] + len(f.filename))
+            self._sizes.append(f.size)
+            self._events.append(f.events)
+            self._adler32.append(int(f.adler32, 16) if f.adler32 is not None else 0)
+            self._adler32_known.append(f.adler32 is not None)
+            guids.append(_guid_to_bytes(f.guid))
+        self._names = ''.join(names)
+        self._guids = b''.join(guids)
+        self._calc_totals()
+
+    def _calc_totals(self):
+        self.total_size = sum(self._sizes)
+        self.total_events = sum(self._events)
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def _name(self, index: int) -> str:
+        return self._names[self._offsets[index]:self._offsets[index + 1]]
+
+    def _adler32_str(self, index: int) -> Optional[str]:
+        return '{0:08x}'.format(self._adler32[index]) if self._adler32_known[index] else None
+
+    def _guid(self, index: int) -> Optional[str]:
+        return _guid_from_bytes(self._guids[index * 16:index * 16 + 16])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('rucio_file_table index out of range')
+        return RucioFile(self._name(index), self._sizes[index], self._events[index],
+                         self._adler32_str(index), self._guid(index))
+
+    def __iter__(self):
+        for i, (size, events) in enumerate(zip(self._sizes, self._events)):
+            yield RucioFile(self._name(i), size, events, self._adler32_str(i), self._guid(i))
+
+    def find_guid(self, guid: str) -> Optional[RucioFile]:
+        'The file with this GUID (in any of the forms `normalize_guid` understands). None if it is not here'
+        guid = normalize_guid(guid)
+        if guid is None:
+            return None
+        key = uuid.UUID(guid).bytes
+        index = self._guids.find(key)
+        while index >= 0:
+            if index % 16 == 0:
+                return self[index // 16]
+            index = self._guids.find(key, index + 1)
+        return None
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return 'rucio_file_table({0!r})'.format(list(self))
+
+    @property
+    def sizes(self) -> array:
+        'The size of each file, in bytes'
+        return self._sizes
+
+    @property
+    def events(self) -> array:
+        'The number of events in each file'
+        return self._events
+
+    def __getstate__(self):
+        return {'names': self._names, 'offsets': self._offsets.tobytes(),
+                'sizes': self._sizes.tobytes(), 'events': self._events.tobytes(),
+                'adler32_u32': self._adler32.tobytes(), 'adler32_known': bytes(self._adler32_known),
+                'guids': self._guids}
+
+    def __setstate__(self, state):
+        self._names = state['names']
+        self._offsets = array('q')
+        self._offsets.frombytes(state['offsets'])
+        self._sizes = array('q')
+        self._sizes.frombytes(state['sizes'])
+        self._events = array('q')
+        self._events.frombytes(state['events'])
+        self._adler32 = array('I')
+        if 'adler32_u32' in state:
+            self._adler32.frombytes(state['adler32_u32'])
+            self._adler32_known = bytearray(state['adler32_known'])
+        elif 'adler32' in state:
+            # Pickled when checksums were kept as 64 bit values, with -1 for unknown
+            old = array('q')
+            old.frombytes(state['adler32'])
+            self._adler32.extend(max(a, 0) for a in old)
+            self._adler32_known = bytearray(a >= 0 for a in old)
+        else:
+            # Pickled before checksums were kept
+            self._adler32.extend([0] * len(self._sizes))
+            self._adler32_known = bytearray(len(self._sizes))
+        self._guids = state.get('guids', _no_guid * len(self._sizes))
+        self._calc_totals()
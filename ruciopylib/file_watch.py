@@ -0,0 +1,126 @@
+# Wait for files in a directory to go away (e.g. a lock file being released) without spinning.
+# Uses inotify on linux, and falls back to sleeping with a back-off everywhere else.
+from typing import Iterable, Optional
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie, len - followed by len bytes of (null padded) file name
+_event_header = struct.Struct('iIII')
+
+
+def _inotify_watch(directory: str, mask: int) -> Optional[int]:
+    'Start an inotify watch on the directory. Returns the inotify file descriptor, or None if inotify can not be used.'
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class directory_watch:
+    r'''
+    Wait for files in a directory to be removed, renamed or closed after writing.
+
+    On linux inotify is used, so `wait` returns as soon as it happens. inotify does not see changes made on
+    other nodes of a network file system, so `wait` also returns every `max_interval` seconds - the caller
+    should check for whatever it is waiting for each time `wait` returns. Where inotify is not available `wait`
+    sleeps, starting at `min_interval` and doubling each time up to `max_interval`.
+
+    Use it in a `with` statement, or call `close` when done.
+    '''
+    def __init__(self, directory: str, names: Optional[Iterable[str]] = None,
+                 min_interval: float = 0.05, max_interval: float = 2.0, use_inotify: bool = True):
+        '''
+        Arguments:
+            directory       The directory to watch
+            names           Only wake up for changes to these files in the directory. None for any file.
+            min_interval    First sleep when polling (seconds)
+            max_interval    Longest sleep when polling, and how often to wake up when using inotify (seconds)
+            use_inotify     If False, always poll.
+        '''
+        self._names = set(os.fsencode(n) for n in names) if names is not None else None
+        self._interval = min_interval
+        self._max_interval = max_interval
+        self._fd = _inotify_watch(directory, _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_DELETE | _IN_DELETE_SELF) \
+            if use_inotify else None
+
+    @property
+    def using_inotify(self) -> bool:
+        'True if changes are being watched with inotify, rather than polled for'
+        return self._fd is not None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        '''
+        Wait for a change, or for it to be time to check again.
+
+        Arguments:
+            timeout     Never wait longer than this (seconds)
+
+        Returns:
+            True        inotify saw one of the files change
+            False       Nothing was seen (it is time to check again, or we are polling)
+        '''
+        if self._fd is None:
+            delay = self._interval if timeout is None else min(self._interval, timeout)
+            time.sleep(max(delay, 0))
+            self._interval = min(self._interval * 2, self._max_interval)
+            return False
+
+        deadline = time.monotonic() + (self._max_interval if timeout is None else min(self._max_interval, timeout))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if len(ready) > 0 and self._read_events():
+                return True
+
+    def _read_events(self) -> bool:
+        'Read all waiting events. True if any were for a file we are watching'
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        seen = False
+        offset = 0
+        while offset + _event_header.size <= len(buffer):
+            _, mask, _, length = _event_header.unpack_from(buffer, offset)
+            name = buffer[offset + _event_header.size:offset + _event_header.size + length].rstrip(b'\0')
+            offset += _event_header.size + length
+            if self._names is None or name in self._names or (mask & _IN_DELETE_SELF):
+                seen = True
+        return seen
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
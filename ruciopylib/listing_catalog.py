@@ -0,0 +1,147 @@
+# Keep the dataset listings in a single SQLite database rather than a pickle file per
+# dataset. This makes questions about all the listings (which are stale, how big is
+# everything) cheap.
+from ruciopylib.dataset_local_cache import dataset_listing_info
+from ruciopylib.rucio import RucioFile
+from datetime import datetime, timedelta
+from typing import List, Optional
+import sqlite3
+import threading
+import uuid
+
+
+_schema = [
+    '''CREATE TABLE IF NOT EXISTS datasets (
+        name TEXT PRIMARY KEY,
+        created REAL NOT NULL,
+        missing INTEGER NOT NULL,
+        generation INTEGER NOT NULL DEFAULT 0
+    )''',
+    'CREATE INDEX IF NOT EXISTS datasets_by_created ON datasets(created)',
+    # The last generation handed out, so a generation is never reused - even after a listing is removed.
+    '''CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        last INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS files (
+        dataset TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        events INTEGER NOT NULL,
+        adler32 TEXT,
+        guid BLOB,
+        PRIMARY KEY (dataset, idx)
+    )''',
+    'CREATE INDEX IF NOT EXISTS files_by_filename ON files(filename)',
+]
+
+
+def _guid_to_blob(guid: Optional[str]) -> Optional[bytes]:
+    return uuid.UUID(guid).bytes if guid is not None else None
+
+
+def _guid_from_blob(guid: Optional[bytes]) -> Optional[str]:
+    return str(uuid.UUID(bytes=guid)).upper() if guid is not None else None
+
+
+class sqlite_listing_catalog:
+    r'''
+    Stores dataset listings, and a row per file, in a SQLite database. The database is run in WAL
+    mode so many processes can read while one writes. Each thread gets its own connection.
+
+    Can be handed to `dataset_local_cache(listing_catalog=...)` in place of the pickle files.
+    '''
+    def __init__(self, db_path: str, timeout: float = 30.0):
+        '''
+        Open (or create) the catalog.
+
+        Arguments:
+            db_path         File the database lives in
+            timeout         How long (seconds) to wait for another process that is writing.
+        '''
+        self._db_path = db_path
+        self._timeout = timeout
+        self._local = threading.local()
+        with self._connection() as c:
+            for s in _schema:
+                c.execute(s)
+            # Catalogs made before checksums and GUIDs were kept
+            columns = [r[1] for r in c.execute('PRAGMA table_info(files)')]
+            if 'adler32' not in columns:
+                c.execute('ALTER TABLE files ADD COLUMN adler32 TEXT')
+            if 'guid' not in columns:
+                c.execute('ALTER TABLE files ADD COLUMN guid BLOB')
+            c.execute('CREATE INDEX IF NOT EXISTS files_by_guid ON files(guid)')
+            c.execute('INSERT OR IGNORE INTO generations (id, last) SELECT 0, COALESCE(MAX(generation), 0) FROM datasets')
+
+    def _connection(self) -> sqlite3.Connection:
+        'The connection for this thread'
+        c = getattr(self._local, 'connection', None)
+        if c is None:
+            c = sqlite3.connect(self._db_path, timeout=self._timeout)
+            c.execute('PRAGMA journal_mode=WAL')
+            c.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = c
+        return c
+
+    def save_listing(self, ds_listing: dataset_listing_info) -> None:
+        'Save a listing, replacing any that is already there'
+        files = ds_listing.FileList
+        with self._connection() as c:
+            c.execute('UPDATE generations SET last = last + 1')
+            generation = c.execute('SELECT last FROM generations').fetchone()[0]
+            c.execute('INSERT INTO datasets (name, created, missing, generation) VALUES (?, ?, ?, ?) '
+                      'ON CONFLICT(name) DO UPDATE SET created=excluded.created, missing=excluded.missing, generation=excluded.generation',
+                      (ds_listing.Name, ds_listing.Created.timestamp(), 1 if files is None else 0, generation))
+            c.execute('DELETE FROM files WHERE dataset = ?', (ds_listing.Name,))
+            if files is not None:
+                c.executemany('INSERT INTO files (dataset, idx, filename, size, events, adler32, guid) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              ((ds_listing.Name, i, f.filename, f.size, f.events, f.adler32, _guid_to_blob(f.guid))
+                               for i, f in enumerate(files)))
+
+    def get_listing(self, name: str) -> Optional[dataset_listing_info]:
+        'Return the listing. None if the listing does not exist'
+        c = self._connection()
+        row = c.execute('SELECT created, missing FROM datasets WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        created, missing = row
+        files = None
+        if not missing:
+            files = [RucioFile(filename, size, events, adler32, _guid_from_blob(guid))
+                     for filename, size, events, adler32, guid
+                     in c.execute('SELECT filename, size, events, adler32, guid FROM files WHERE dataset = ? ORDER BY idx', (name,))]
+        return dataset_listing_info(name, files, created_time=datetime.fromtimestamp(created))
+
+    def get_generation(self, name: str) -> Optional[int]:
+        'A number that changes every time the listing is saved, and is never reused. None if there is no listing.'
+        row = self._connection().execute('SELECT generation FROM datasets WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_listing_names(self) -> List[str]:
+        'Names of all the datasets with listings'
+        return [r[0] for r in self._connection().execute('SELECT name FROM datasets ORDER BY name')]
+
+    def get_stale_listings(self, max_age: timedelta) -> List[str]:
+        'Names of the datasets whose listings are older than `max_age`'
+        cutoff = (datetime.now() - max_age).timestamp()
+        return [r[0] for r in self._connection().execute('SELECT name FROM datasets WHERE created < ? ORDER BY name', (cutoff,))]
+
+    def total_size(self) -> int:
+        'Total size, in bytes, of the files in all the listings'
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+
+    def find_file(self, filename: str) -> List[str]:
+        'Names of the datasets that contain this file'
+        return [r[0] for r in self._connection().execute('SELECT DISTINCT dataset FROM files WHERE filename = ? ORDER BY dataset', (filename,))]
+
+    def find_guid(self, guid: str) -> List[str]:
+        'Names of the datasets that contain the file with this GUID'
+        return [r[0] for r in self._connection().execute('SELECT DISTINCT dataset FROM files WHERE guid = ? ORDER BY dataset', (_guid_to_blob(guid),))]
+
+    def remove_listing(self, name: str) -> None:
+        'Remove a listing from the catalog'
+        with self._connection() as c:
+            c.execute('DELETE FROM files WHERE dataset = ?', (name,))
+            c.execute('DELETE FROM datasets WHERE name = ?', (name,))
@@ -0,0 +1,105 @@
+# Download the files of a dataset as many small downloads run in parallel, so one
+# slow file does not hold up everything else.
+from ruciopylib.rucio import RucioFile, RucioException, rucio_backend
+from ruciopylib.runner import CommandCancelled
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import os
+import threading
+import time
+
+
+class DownloadStats(namedtuple('DownloadStats', 'files bytes seconds')):
+    '''
+    Summary of a download: the files that were downloaded, their total size (in bytes), and
+    how long it took (in seconds).
+    '''
+    @property
+    def throughput(self) -> float:
+        'Bytes per second'
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class parallel_download:
+    r'''
+    Splits a dataset into tasks of a few files each, and runs the tasks on a pool of workers. Each
+    task is a single call to the backend's `download_file_list`. The number of threads each
+    task uses is set on the backend (see `rucio(downloader_threads=...)`).
+    '''
+    def __init__(self, workers: int = 4, files_per_task: int = 1):
+        '''
+        Initialize the downloader.
+
+        Arguments:
+            workers         How many downloads to run at once.
+            files_per_task  How many files to download in each call to rucio.
+        '''
+        self._workers = workers
+        self._files_per_task = files_per_task
+
+    def download(self, rucio_mgr: rucio_backend, files: List[RucioFile], dest_dir: str, log_func=None) -> DownloadStats:
+        '''
+        Download files into a directory.
+
+        Arguments:
+            rucio_mgr       The backend that will do the downloads.
+            files           The files to download (from the dataset listing).
+            dest_dir        Where the files should end up.
+            log_func        Called with the output of all the downloads. If it has a `cancelled` event (see
+                            `single_flight`), so does the log function each download is given, and no new
+                            downloads are started once it is set.
+
+        Returns:
+            stats           The files that were downloaded and how fast it went.
+
+        Raises:
+            RucioException  If any of the tasks failed. The tasks that did not fail will
+                            have run to completion.
+        '''
+        tasks = [files[i:i + self._files_per_task] for i in range(0, len(files), self._files_per_task)]
+
+        # The log function may not be thread safe.
+        log_lock = threading.Lock()
+
+        def log_line(l):
+            if log_func is not None:
+                with log_lock:
+                    log_func(l)
+        cancelled = getattr(log_func, 'cancelled', None)
+        if cancelled is not None:
+            # So a download that prints nothing is still stopped (see `runner.shell_stream`)
+            log_line.cancelled = cancelled
+
+        def run_task(task: List[RucioFile]) -> Optional[List[str]]:
+            if cancelled is not None and cancelled.is_set():
+                raise CommandCancelled('Download of {0} cancelled.'.format(', '.join(t.filename for t in task)))
+            return rucio_mgr.download_file_list([f.filename for f in task], dest_dir, log_func=log_line)
+
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [(task, executor.submit(run_task, task)) for task in tasks]
+
+        downloaded = []
+        n_bytes = 0
+        failed = 0
+        for task, f in futures:
+            try:
+                r = f.result()
+            except RucioException as e:
+                log_line('Download of {0} failed: {1}'.format(', '.join(t.filename for t in task), e))
+                r = None
+            if r is None:
+                failed += 1
+            else:
+                downloaded += r
+                n_bytes += sum(t.size for t in task)
+        stats = DownloadStats(downloaded, n_bytes, time.monotonic() - start)
+
+        log_line('Downloaded {0} bytes in {1:.2f} seconds = {2:.2f} MBps'.format(stats.bytes, stats.seconds, stats.throughput / 1024 / 1024))
+        if failed > 0:
+            raise RucioException('{0} of {1} download tasks failed.'.format(failed, len(tasks)))
+        return stats
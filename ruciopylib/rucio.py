@@ -1,12 +1,16 @@
 # Provides the interface to rucio. THis is a pretty raw level interface, and can be used
 # to download data files to various places.
-from ruciopylib.runner import runner
+from ruciopylib.runner import runner, exe_result, exe_stream, stream_command
+from abc import ABC, abstractmethod
 import re
-from collections import namedtuple
-from typing import Optional, List
+from collections import namedtuple, deque
+from typing import Dict, Optional, List
+import uuid
 
-# Info for a single file. Contains the name, the size (in bytes), and the number of events
-RucioFile = namedtuple('RucioFile', 'filename size events')
+# Info for a single file. Contains the name, the size (in bytes), the number of events, the
+# adler32 checksum (8 hex digits, as rucio prints it - None if not known), and the GUID (upper case,
+# with dashes - None if not known)
+RucioFile = namedtuple('RucioFile', 'filename size events adler32 guid', defaults=(None, None))
 
 
 class RucioException (BaseException):
@@ -14,31 +18,176 @@ class RucioException (BaseException):
         BaseException.__init__(self, message)
 
 
-unit_index = {'B': 0, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4}
+# The command line tools print sizes in decimal (SI) units
+unit_index = {'B': 0, 'kB': 1, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4, 'PB': 5}
 
 
 def calc_size(size_str):
-    'Given a rucio size string, calculate the number of bytes'
-    number, units = size_str.strip().split(' ')
-    number = float(number)
-    for _ in range(unit_index[units]):
-        number = number * 1024
-    return int(number)
+    'Given a rucio size string, calculate the number of bytes (rounded, as the string is)'
+    number, units = size_str.strip().split()
+    return int(round(float(number) * 1000 ** unit_index[units]))
 
 
-class rucio:
+# Example output:
+# | mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1 | 1DCBECFA-EDC0-5840-A25A-8277CA9A31D4 | ad:c14ee390 | 5.956 GB   |    30000 |
+_listing_finder = re.compile(r"\|\s+(?P<file_name>[^|]+)\s+\|\s+(?P<guid>[^|]+)\s+\|\s+(?P<hash>[^|]+)\s+\|\s+(?P<size>[^|]+)\s+\|\s+(?P<events>[^|]+)\s+\|")
+
+
+def normalize_guid(guid: Optional[str]) -> Optional[str]:
+    'GUIDs come with and without dashes, and in either case. Return the form the listing prints, or None if it is not a GUID'
+    if guid is None:
+        return None
+    try:
+        return str(uuid.UUID(guid.strip())).upper()
+    except ValueError:
+        return None
+
+
+def _parse_adler32(hash_str: str) -> Optional[str]:
+    'The listing prints the adler32 checksum as `ad:c14ee390`'
+    hash_str = hash_str.strip()
+    return hash_str[3:] if hash_str.startswith('ad:') else None
+
+
+_download_finder = re.compile(r".*File (?P<file_name>\S+) successfully downloaded.*")
+
+
+class _file_listing_parser:
+    'Parse the output of `rucio list-files` a line at a time. See `rucio.get_file_listing`.'
+    def __init__(self):
+        self.files = []
+
+    def add_line(self, line: str) -> None:
+        m = _listing_finder.match(line)
+        if m is not None and m.group('events') != 'EVENTS':
+            self.files.append(RucioFile(m.group('file_name'), calc_size(m.group('size')), int(m.group('events')),
+                                        _parse_adler32(m.group('hash')), normalize_guid(m.group('guid'))))
+
+    def finish(self, r: exe_result) -> Optional[List[RucioFile]]:
+        'Called with the result of the command once all lines have been seen.'
+        # See if it failed. If so, figure out what to do next.
+        if r.shell_result == 12 and any("" in l for l in r.shell_output):
+            # This is an actual bad dataset. Nothing we do will fix this!
+            return None
+        elif r.shell_result != 0:
+            # Something went wrong. Best option: retry at some point.
+            raise RucioException("Unable to get rucio to list files - died with a status code of {r.shell_result}. Try again.".format(**locals()))
+        return self.files
+
+
+class _download_parser:
+    'Parse the output of `rucio download` a line at a time. See `rucio.download_files`.'
+    def __init__(self):
+        self.files = []
+        self._no_files = False
+
+    def add_line(self, line: str) -> None:
+        m = _download_finder.match(line)
+        if m:
+            self.files.append(m.group("file_name"))
+        elif "Using main thread to download 0 file" in line:
+            self._no_files = True
+
+    def finish(self, r: exe_result) -> Optional[List[str]]:
+        'Called with the result of the command once all lines have been seen.'
+        if r.shell_status:
+            return self.files
+
+        # We failed. Time to figure out why and return the proper type of error.
+        for l in r.shell_output:
+            print("->" + l)
+        if self._no_files:
+            return None
+        raise RucioException("Rucio failed with exit code {0}.".format(r.shell_result))
+
+
+def _parse_stream(s: exe_stream, parser):
+    'Feed each line to the parser as it comes in'
+    for l in s:
+        parser.add_line(l)
+    return parser.finish(s.result)
+
+
+def _parse_result(r: exe_result, parser):
+    'Feed the lines of a completed command to the parser'
+    return _parse_stream(exe_stream.from_result(r), parser)
+
+
+class rucio_backend(ABC):
+    r'''
+    The operations the rest of this library needs from rucio. Anything that implements these can be
+    handed to a `rucio_cache_interface`:
+
+        - `rucio` runs the rucio command line tools and scrapes their output.
+        - `rucio_client_backend` calls the rucio client library directly, in process.
+    '''
+    # True if the file sizes in listings are exact, rather than rounded (the command line tools print
+    # `1.981 GB`).
+    exact_sizes = False
+
+    @abstractmethod
+    def get_file_listing(self, ds_name, log_func=None) -> Optional[List[RucioFile]]:
+        '''
+        Return a list of files in the dataset.
+
+        Returns:
+            None         Dataset doesn't exist according to `rucio`
+            [f1, f2,...] Listing of all files that are in the dataset.
+
+        Raises:
+            RucioException  Something went wrong, and the call should be retried.
+        '''
+
+    def get_file_listings(self, ds_names: List[str], log_func=None) -> Dict[str, Optional[List[RucioFile]]]:
+        '''
+        Return the file listings for many datasets. See `rucio.get_file_listings`. By default this
+        just calls `get_file_listing` for each dataset.
+        '''
+        result = {}
+        for ds_name in ds_names:
+            try:
+                result[ds_name] = self.get_file_listing(ds_name, log_func=log_func)
+            except RucioException:
+                pass
+        return result
+
+    @abstractmethod
+    def download_files(self, ds_name: str, data_dir: str, log_func=None) -> Optional[List[str]]:
+        '''
+        Download files in a dataset to the data directory.
+
+        Returns:
+            file_list       None if the dataset does not exist
+                            Names of the files that were downloaded
+
+        Raises:
+            RucioException  Something went wrong, and the call should be retried.
+        '''
+
+    @abstractmethod
+    def download_file_list(self, files: List[str], dest_dir: str, log_func=None) -> Optional[List[str]]:
+        '''
+        Download individual files (by DID) directly into `dest_dir`. See `rucio.download_file_list`.
+        '''
+
+
+class rucio(rucio_backend):
     r'''
     Provides synchronos access to rucio commands. The methods here will run the `rucio` command
     and parse the returned data.
     '''
-    def __init__(self, executor: runner = None):
+    def __init__(self, executor: runner = None, downloader_threads: Optional[int] = None):
         '''
         Initialize a rucio controller.
 
         Arguments:
-            executor        Dependency injection for the code that will execute against the command shell.
+            executor            Dependency injection for the code that will execute against the command shell.
+                                Use an `async_runner` to be able to call the `_async` versions of the methods.
+            downloader_threads  Number of threads `rucio download` should use (`--ndownloader`). If None, use
+                                the rucio default.
         '''
         self._runner = executor if executor is not None else runner()
+        self._download_options = ' --ndownloader {0}'.format(downloader_threads) if downloader_threads is not None else ''
 
     def get_file_listing(self, ds_name, log_func=None) -> Optional[List[RucioFile]]:
         '''
@@ -53,22 +202,64 @@ class rucio:
             [f1, f2,...] Listing of all files that are in the dataset. Each entry contains the name, the size and # of events in the file.
         '''
         # run the command to get the list of files back.
-        r = self._runner.shell_execute("rucio list-files {ds_name}".format(**locals()), log_func=log_func)
+        s = stream_command(self._runner, "rucio list-files {ds_name}".format(**locals()), log_func=log_func)
+        return _parse_stream(s, _file_listing_parser())
 
-        # See if it failed. If so, figure out what to do next.
-        if r.shell_result == 12 and any("" in l for l in r.shell_output):
-            # This is an actual bad dataset. Nothing we do will fix this!
-            return None
-        elif r.shell_result != 0:
-            # Something went wrong. Best option: retry at some point.
-            raise RucioException("Unable to get rucio to list files - died with a status code of {r.shell_result}. Try again.".format(**locals()))
+    def get_file_listings(self, ds_names: List[str], log_func=None, batch_size: int = 50) -> Dict[str, Optional[List[RucioFile]]]:
+        '''
+        Return the file listings for many datasets. The `rucio list-files` commands for up to `batch_size`
+        datasets are run in a single shell command, and the output is split back up by dataset.
+
+        Arguments:
+            ds_names    Names, including scope, of the rucio datasets
+            log_func    If set, will get called with each line of loging information.
+            batch_size  Most number of datasets to list in a single shell command.
+
+        Returns:
+            {ds: files}  Dictionary keyed by dataset name. The value is the same as `get_file_listing` returns: None
+                         if the dataset does not exist, otherwise the list of files.
+                         Datasets whose listing failed (and should be retried) are not in the dictionary.
+        '''
+        result = {}
+        for i in range(0, len(ds_names), batch_size):
+            result.update(self._get_file_listings_batch(ds_names[i:i + batch_size], log_func))
+        return result
+
+    def _get_file_listings_batch(self, ds_names: List[str], log_func) -> Dict[str, Optional[List[RucioFile]]]:
+        'Run one shell command to list all the datasets'
+        marker = '@@@ruciopylib-{0}'.format(uuid.uuid4().hex)
+        cmd = '; '.join('echo "{0} start {1}"; rucio list-files {2}; echo "{0} status {1} $?"'.format(marker, index, ds_name)
+                        for index, ds_name in enumerate(ds_names))
+        marker_finder = re.compile(r'^{0} (?P<what>start|status) (?P<index>\d+)(?: (?P<code>\d+))?$'.format(marker))
 
-        # Now, parse the lines for the data that we return.
-        # Example output:
-        # | mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1 | 1DCBECFA-EDC0-5840-A25A-8277CA9A31D4 | ad:c14ee390 | 5.956 GB   |    30000 |
-        finder = re.compile(r"\|\s+(?P<file_name>[^|]+)\s+\|\s+(?P<guid>[^|]+)\s+\|\s+(?P<hash>[^|]+)\s+\|\s+(?P<size>[^|]+)\s+\|\s+(?P<events>[^|]+)\s+\|")
+        result = {}
+        parser = None
+        lines = deque(maxlen=100)
+        for l in stream_command(self._runner, cmd, log_func=log_func):
+            m = marker_finder.match(l)
+            if m is None:
+                if parser is not None:
+                    parser.add_line(l)
+                    lines.append(l)
+            elif m.group('what') == 'start':
+                parser = _file_listing_parser()
+                lines = deque(maxlen=100)
+            elif parser is not None:
+                code = int(m.group('code'))
+                ds_name = ds_names[int(m.group('index'))]
+                try:
+                    result[ds_name] = parser.finish(exe_result(code, code == 0, list(lines)))
+                except RucioException:
+                    pass
+                parser = None
+        return result
 
-        return [RucioFile(m.group('file_name'), calc_size(m.group('size')), int(m.group('events'))) for m in [finder.match(l) for l in r.shell_output] if m is not None and (m.group('events') != 'EVENTS')]
+    async def get_file_listing_async(self, ds_name, log_func=None) -> Optional[List[RucioFile]]:
+        '''
+        Same as `get_file_listing`, but the executor must be an `async_runner` (or provide a `shell_execute_async`).
+        '''
+        r = await self._runner.shell_execute_async("rucio list-files {ds_name}".format(**locals()), log_func=log_func)
+        return _parse_result(r, _file_listing_parser())
 
     def download_files(self, ds_name: str, data_dir: str, log_func=None) -> Optional[List[RucioFile]]:
         '''
@@ -88,19 +279,33 @@ class rucio:
             Exception           If something went wrong that isn't either of the above
                                 two (generally means this command needs to be retried).
         '''
-        r = self._runner.shell_execute("cd {data_dir}; rucio download {ds_name}".format(**locals()), log_func=log_func)
-        if r.shell_status:
-            pat = re.compile(r".*File (?P<file_name>\S+) successfully downloaded.*")
-            files = []
-            for l in r.shell_output:
-                m = pat.match(l)
-                if m:
-                    files.append(m.group("file_name"))
-            return files
+        s = stream_command(self._runner, "cd {data_dir}; rucio download{self._download_options} {ds_name}".format(**locals()), log_func=log_func)
+        return _parse_stream(s, _download_parser())
 
-        # We failed. Time to figure out why and return the proper type of error.
-        for l in r.shell_output:
-            print("->" + l)
-        if any("Using main thread to download 0 file" in l for l in r.shell_output):
-            return None
-        raise RucioException("Rucio failed with exit code {0}.".format(r.shell_result))
+    def download_file_list(self, files: List[str], dest_dir: str, log_func=None) -> Optional[List[str]]:
+        '''
+        Download a list of files into a directory.
+
+        Arguments:
+            files:              The DIDs (scope:name) of the files to download
+            dest_dir:           The directory the files should end up in (no sub-directories are created)
+            log_func:           Called with each line of output from the shell executing
+                                the download command.
+
+        Returns:
+            file_list           None if none of the files exist.
+                                The files that were downloaded
+
+        Raises:
+            RucioException      If the download failed and should be retried.
+        '''
+        dids = ' '.join(files)
+        s = stream_command(self._runner, "rucio download{self._download_options} --dir {dest_dir} --no-subdir {dids}".format(**locals()), log_func=log_func)
+        return _parse_stream(s, _download_parser())
+
+    async def download_files_async(self, ds_name: str, data_dir: str, log_func=None) -> Optional[List[RucioFile]]:
+        '''
+        Same as `download_files`, but the executor must be an `async_runner` (or provide a `shell_execute_async`).
+        '''
+        r = await self._runner.shell_execute_async("cd {data_dir}; rucio download{self._download_options} {ds_name}".format(**locals()), log_func=log_func)
+        return _parse_result(r, _download_parser())
@@ -1,11 +1,18 @@
 # Higher level object to help manage a group of datasets on disk.
-from ruciopylib.rucio import RucioFile, rucio, RucioException
-from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info
-from typing import List, Optional, Tuple
+from ruciopylib.rucio import RucioFile, rucio, rucio_backend, RucioException, _download_finder
+from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info, dataset_pin, local_filename
+from ruciopylib.parallel_download import parallel_download
+from ruciopylib.single_flight import single_flight, CallCancelled
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Dict, Iterable, List, Optional, Tuple
 import datetime
 from enum import Enum
 from retry.api import retry_call
 import filelock
+import queue
+import threading
+import time
 
 
 DatasetQueryStatus = Enum('DatasetQueryStatus', 'does_not_exist, query_queued, results_valid')
@@ -17,6 +24,18 @@ class RucioAlreadyBeingDownloaded(BaseException):
         BaseException.__init__(self, msg)
 
 
+class CacheFull(BaseException):
+    'Thrown if there is not enough room under the cache quota for a dataset'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
+class DownloadCancelled(BaseException):
+    'Raised inside a download when the `ds_download_stream` that started it has been cancelled'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
 def ds_age_too_old(age: datetime.datetime, time_valid: Optional[datetime.timedelta]):
     '''If current time is older than datetime plus timedelta.
 
@@ -28,13 +47,20 @@ def ds_age_too_old(age: datetime.datetime, time_valid: Optional[datetime.timedel
                         timedelta - how long till the present time it is allowed.
 
     Returns
-    valid           True if still valid
+    too_old         True if the dataset is no longer valid
     '''
     if time_valid is None:
         return False
-    if time_valid.seconds == 0:
+    if time_valid.total_seconds() <= 0:
         return True
-    return (datetime.datetime.now() + time_valid) <= age
+    return (age + time_valid) <= datetime.datetime.now()
+
+
+def _cancel_if_cancelled(queued: Future, futures: Iterable[Future]) -> None:
+    'When work queued on a pool is cancelled (see `rucio_cache_interface.close`), cancel the futures it would have set'
+    if queued.cancelled():
+        for f in futures:
+            f.cancel()
 
 
 class rucio_cache_interface:
@@ -46,24 +72,80 @@ class rucio_cache_interface:
           this code.
     '''
     def __init__(self, data_mgr: dataset_local_cache,
-                 rucio_mgr: Optional[rucio] = None,
-                 seconds_between_retries: float = 60.0 * 5):
+                 rucio_mgr: Optional[rucio_backend] = None,
+                 seconds_between_retries: float = 60.0 * 5,
+                 downloader: Optional[parallel_download] = None,
+                 query_workers: int = 2,
+                 lock_wait: Optional[float] = None,
+                 download_workers: int = 2,
+                 background_tries: int = 3):
         '''
         Setup a dataset_mgr
 
         Arguments:
 
-            rucio_mgr           Interface to query rucio directly to get back dataset file results.
+            rucio_mgr           Interface to query rucio directly to get back dataset file results. Defaults
+                                to running the command line tools (`rucio`). See `rucio_backend`.
+            downloader          If not None, datasets are downloaded file-by-file, in parallel, using the
+                                dataset listing. Otherwise the whole dataset is downloaded in one go.
+            query_workers       How many rucio queries to run at once in the background for non-blocking
+                                `get_ds_contents` calls.
+            lock_wait           If not None, when another process holds the download lock for a dataset, wait
+                                up to this many seconds for it to finish and use what it cached, rather than
+                                raising `RucioAlreadyBeingDownloaded` right away.
+            download_workers    How many datasets `download_many_ds` downloads at once.
+            background_tries    How many times a background query (`block=False`, `get_many_ds_contents`) asks
+                                rucio before it gives up. -1 to keep trying.
+
+        Call `close` (or use a `with` statement) when done, to stop the background work.
         '''
         # We want to query rucio one dataset at a time.
         self._rucio = rucio_mgr if rucio_mgr is not None else rucio()
         self._cache_mgr = data_mgr
         self._seconds_between_retries = seconds_between_retries
+        self._downloader = downloader
+        self._query_workers = query_workers
+        self._query_executor = None
+        self._download_workers = download_workers
+        self._download_executor = None
+        self._executor_lock = threading.Lock()
+        self._queries: Dict[str, Future] = {}
+        self._queries_lock = threading.Lock()
+        self._refreshes = set()
+        # Datasets whose download lock a batched listing holds - set once the batch lets go.
+        self._batched: Dict[str, threading.Event] = {}
+        self._flights = single_flight()
+        self._lock_wait = lock_wait
+        self._background_tries = background_tries
+        # Background work waits on this, so it stops once we are closed.
+        self._closed = threading.Event()
+
+    def close(self) -> None:
+        '''
+        Stop the background work: queued queries and downloads are cancelled (their futures are cancelled),
+        and running ones are told to stop (rucio commands nobody else is waiting on are killed). Nothing
+        is waited for. Calls that would start background work raise `RuntimeError` after this.
+        '''
+        self._closed.set()
+        with self._executor_lock:
+            for executor in (self._query_executor, self._download_executor):
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def get_ds_contents(self, ds_name: str,
                         maxAge: Optional[datetime.timedelta] = None,
                         maxAgeIfNotSeen: Optional[datetime.timedelta] = datetime.timedelta(minutes=60),
-                        log_func=None) -> Tuple[DatasetQueryStatus, Optional[List[RucioFile]]]:
+                        log_func=None,
+                        block: bool = True,
+                        timeout: Optional[float] = None,
+                        cancel: Optional[threading.Event] = None,
+                        staleGrace: Optional[datetime.timedelta] = None) -> Tuple[DatasetQueryStatus, Optional[List[RucioFile]]]:
         '''
         Return the list of files that are in a dataset. Use the local cache if possible, and if not,
         then we run rucio to get the listing (so this can take a while!!).
@@ -79,30 +161,231 @@ class rucio_cache_interface:
                                   than maxAgeIfNotSeen, then return does not exist.
                               Otherwise re-query rucio to see if the dataset has now appeared.
         log_func            Function called with any logging information.
+        block             If False, and rucio has to be queried, the query is run in the background and
+                          query_queued is returned right away. Call again later to pick up the result. If the
+                          background query failed (see `background_tries`), the error is raised by the next call
+                          only - the call after that starts a new query. log_func is called from the background
+                          thread.
+        timeout           Seconds to wait for rucio before raising `CallTimedOut`. The query keeps running, and
+                          its result is still cached.
+        cancel            If this event is set while waiting for rucio, raise `CallCancelled`.
+        staleGrace        If not None, a cached listing older than maxAge (or maxAgeIfNotSeen) by less than this is
+                          still returned right away, and a query is started in the background to refresh it
+                          (stale-while-revalidate). If the refresh fails the old listing is kept.
+
+        Threads asking for the same dataset at the same time share a single rucio query.
 
         Returns
         status        Status of the returned results (see DatasetQueryStatus) and below:
         files         Depends on the status:
+                          query_queued - files will be None, and a query is running in the background.
                           does_not_exist - files will be None, and the dataset was not found on the last query to rucio.
                           results_valid - files will be a list of all files in the dataset.
                               Empty Dataset: The dataset is empty if the list has len()==0.
                               Dataset with files: The list will have an entry per file
         '''
         # See if the listing exists, if so, return it.
-        listing = self._cache_mgr.get_listing(ds_name)
-        if listing is not None:
-            status = DatasetQueryStatus.results_valid if listing.FileList is not None else DatasetQueryStatus.does_not_exist
-            if (status is not DatasetQueryStatus.does_not_exist or not ds_age_too_old(listing.Created, maxAgeIfNotSeen)) \
-                    and (status is not DatasetQueryStatus.results_valid or not ds_age_too_old(listing.Created, maxAge)):
-                return (status, listing.FileList)
+        cached = self._cached_result(ds_name, maxAge, maxAgeIfNotSeen, staleGrace, log_func)
+        if cached is not None:
+            return cached
 
         # If we are here, we need to run the query against rucio for whatever reason.
+        if not block:
+            return self._queue_query(ds_name, log_func)
+
         # We might be disconnected, or similar, so let this go.
-        retry_call(self._query_rucio, [ds_name, log_func], exceptions=RucioException, delay=self._seconds_between_retries)
+        self._shared_query(ds_name, log_func, timeout=timeout, cancel=cancel)
+        return self._listing_result(ds_name)
+
+    def _cached_result(self, ds_name: str,
+                       maxAge: Optional[datetime.timedelta],
+                       maxAgeIfNotSeen: Optional[datetime.timedelta],
+                       staleGrace: Optional[datetime.timedelta] = None,
+                       log_func=None) -> Optional[Tuple[DatasetQueryStatus, Optional[List[RucioFile]]]]:
+        '''
+        The cached listing, if there is one and it is recent enough (see `get_ds_contents`). Otherwise None.
+        A listing that is too old, but within `staleGrace`, is returned and refreshed in the background.
+        '''
+        listing = self._cache_mgr.get_listing(ds_name)
+        if listing is None:
+            return None
+        status = DatasetQueryStatus.results_valid if listing.FileList is not None else DatasetQueryStatus.does_not_exist
+        max_age = maxAgeIfNotSeen if status is DatasetQueryStatus.does_not_exist else maxAge
+        if not ds_age_too_old(listing.Created, max_age):
+            return (status, listing.FileList)
+        if staleGrace is not None and not ds_age_too_old(listing.Created, max_age + staleGrace):
+            self._refresh_in_background(ds_name, log_func)
+            return (status, listing.FileList)
+        return None
+
+    def _refresh_in_background(self, ds_name: str, log_func=None) -> None:
+        '''
+        Query rucio for the dataset on the background query pool, unless a refresh is already running.
+        The listing is only replaced if the query works. Nobody is waiting on a refresh, so rucio is only
+        asked once - if that fails, the next call that finds the listing stale tries again. Once we are
+        closed, nothing is refreshed.
+        '''
+        with self._queries_lock:
+            if ds_name in self._refreshes or self._closed.is_set():
+                return
+            self._refreshes.add(ds_name)
+
+        def refresh():
+            try:
+                self._flights.do(('query', ds_name), lambda log: self._query_rucio(ds_name, log), log_func=log_func,
+                                 cancel=self._closed)
+            except BaseException as e:
+                if log_func is not None:
+                    log_func(f'Unable to refresh the listing for {ds_name}, keeping the old one: {e}')
+            finally:
+                with self._queries_lock:
+                    self._refreshes.discard(ds_name)
+        try:
+            self._get_query_executor().submit(refresh)
+        except RuntimeError:
+            with self._queries_lock:
+                self._refreshes.discard(ds_name)
+
+    def get_many_ds_contents(self, ds_names: Iterable[str],
+                             maxAge: Optional[datetime.timedelta] = None,
+                             maxAgeIfNotSeen: Optional[datetime.timedelta] = datetime.timedelta(minutes=60),
+                             log_func=None,
+                             batch_size: int = 50,
+                             staleGrace: Optional[datetime.timedelta] = None) -> Dict[str, Future]:
+        '''
+        Like `get_ds_contents`, for many datasets at once. Listings in the cache are returned right away.
+        The rest are listed with `rucio_backend.get_file_listings`, `batch_size` datasets at a time, on the
+        background query pool (see `query_workers`).
+
+        Arguments
+        ds_names          The rucio fully qualified names of the datasets
+        maxAge, maxAgeIfNotSeen, staleGrace
+                          As for `get_ds_contents`
+        log_func          Function called with any logging information (from the background threads).
+        batch_size        Most datasets to ask rucio about in one go.
+
+        Returns
+        futures           Dictionary keyed by dataset name. Each `Future` gives the (status, files) that
+                          `get_ds_contents` would return, or raises what it would raise. Those for cached
+                          listings are already done. Use `concurrent.futures.as_completed` to handle them as
+                          they arrive.
+        '''
+        futures = {}
+        misses = []
+        for ds_name in ds_names:
+            if ds_name in futures:
+                continue
+            futures[ds_name] = Future()
+            cached = self._cached_result(ds_name, maxAge, maxAgeIfNotSeen, staleGrace, log_func)
+            if cached is not None:
+                futures[ds_name].set_result(cached)
+            else:
+                misses.append(ds_name)
+
+        for i in range(0, len(misses), batch_size):
+            batch = {ds_name: futures[ds_name] for ds_name in misses[i:i + batch_size]}
+            queued = self._get_query_executor().submit(self._query_batch, batch, log_func)
+            queued.add_done_callback(lambda q, batch=batch: _cancel_if_cancelled(q, batch.values()))
+        return futures
+
+    def _get_query_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._closed.is_set():
+                raise RuntimeError('The rucio_cache_interface has been closed.')
+            if self._query_executor is None:
+                self._query_executor = ThreadPoolExecutor(max_workers=self._query_workers, thread_name_prefix='ruciopylib-query')
+            return self._query_executor
+
+    def _query_batch(self, batch: Dict[str, Future], log_func=None) -> None:
+        '''
+        List a batch of datasets with a single rucio call, and set each future with its result. Datasets
+        someone else has locked, or that the batched call did not list, are queried one at a time. Datasets
+        this process is already querying are left out of the batch, and wait for that query instead. Anyone
+        in this process who wants a dataset while the batch holds its lock waits for the batch.
+        '''
+        batch_done = threading.Event()
+        locked = []
+        try:
+            with ExitStack() as locks:
+                for ds_name in batch:
+                    if self._flights.in_flight(('query', ds_name)):
+                        continue
+                    # Registered first, so nobody in this process can see the lock held and not know why.
+                    with self._queries_lock:
+                        self._batched[ds_name] = batch_done
+                    try:
+                        locks.enter_context(self._cache_mgr.get_dataset_downloading_lock(ds_name))
+                        locked.append(ds_name)
+                    except filelock.Timeout:
+                        with self._queries_lock:
+                            del self._batched[ds_name]
+                listings = self._rucio.get_file_listings(locked, log_func=log_func) if len(locked) > 0 else {}
+                for ds_name, files in listings.items():
+                    self._cache_mgr.save_listing(dataset_listing_info(ds_name, files))
+        except (Exception, RucioException) as e:
+            listings = {}
+            if log_func is not None:
+                log_func(f'Batched rucio listing failed ({e}), listing the datasets one at a time.')
+        finally:
+            with self._queries_lock:
+                for ds_name in batch:
+                    if self._batched.get(ds_name) is batch_done:
+                        del self._batched[ds_name]
+            batch_done.set()
+
+        for ds_name, future in batch.items():
+            try:
+                if ds_name not in listings:
+                    self._shared_query(ds_name, log_func, cancel=self._closed, tries=self._background_tries)
+                future.set_result(self._listing_result(ds_name))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _shared_query(self, ds_name: str, log_func=None, timeout: Optional[float] = None, cancel: Optional[threading.Event] = None,
+                      tries: int = -1) -> None:
+        '''
+        Query rucio, or wait for the query for this dataset that is already running. `tries` only applies
+        if this starts the query.
+        '''
+        self._flights.do(('query', ds_name), lambda log: self._query_rucio_with_retries(ds_name, log, tries),
+                         log_func=log_func, timeout=timeout, cancel=cancel)
+
+    def _listing_result(self, ds_name: str) -> Tuple[DatasetQueryStatus, Optional[List[RucioFile]]]:
         listing = self._cache_mgr.get_listing(ds_name)
         status = DatasetQueryStatus.results_valid if listing.FileList is not None else DatasetQueryStatus.does_not_exist
         return (status, listing.FileList)
 
+    def _query_rucio_with_retries(self, ds_name: str, log_func=None, tries: int = -1) -> None:
+        retry_call(self._query_rucio, [ds_name, log_func], exceptions=RucioException, tries=tries, delay=self._seconds_between_retries)
+
+    def _queue_query(self, ds_name: str, log_func=None) -> Tuple[DatasetQueryStatus, Optional[List[RucioFile]]]:
+        '''
+        Start a background query for the dataset, unless one is already running. If one has finished
+        since the last call, return its result (even if the caller's age limits say it is already too old -
+        otherwise a `maxAge` of zero would never return anything).
+        '''
+        with self._queries_lock:
+            query = self._queries.get(ds_name)
+            if query is not None and query.cancelled():
+                del self._queries[ds_name]
+                query = None
+            if query is not None and query.done():
+                del self._queries[ds_name]
+                e = query.exception()
+                if e is None:
+                    return self._listing_result(ds_name)
+                if not isinstance(e, RucioAlreadyBeingDownloaded):
+                    raise e
+                # Someone else was querying - see if they are done.
+                listing = self._cache_mgr.get_listing(ds_name)
+                if listing is not None:
+                    return self._listing_result(ds_name)
+                query = None
+            if query is None:
+                self._queries[ds_name] = self._get_query_executor().submit(self._shared_query, ds_name, log_func,
+                                                                           cancel=self._closed, tries=self._background_tries)
+        return (DatasetQueryStatus.query_queued, None)
+
     def _query_rucio(self, ds_name: str, log_func=None) -> None:
         '''
         Run a query against rucio and then save the results.
@@ -111,18 +394,49 @@ class rucio_cache_interface:
         ds_name         The name of the dataset we should fetch
         '''
 
-        try:
-            with self._cache_mgr.get_dataset_downloading_lock(ds_name):
-                # Run the fetch of the result
-                r = self._rucio.get_file_listing(ds_name, log_func=log_func)
-                # Cache the result.
-                self._cache_mgr.save_listing(dataset_listing_info(ds_name, r))
-        except filelock.Timeout:
-            raise RucioAlreadyBeingDownloaded(f'Cannot query rucio about contents of dataset as someone else already has the lock for {ds_name}.')
+        started = datetime.datetime.now()
+        deadline = time.monotonic() + self._lock_wait if self._lock_wait is not None else None
+        while True:
+            try:
+                with self._cache_mgr.get_dataset_downloading_lock(ds_name):
+                    # Run the fetch of the result
+                    r = self._rucio.get_file_listing(ds_name, log_func=log_func)
+                    # Cache the result.
+                    self._cache_mgr.save_listing(dataset_listing_info(ds_name, r))
+                    return
+            except filelock.Timeout:
+                if not self._wait_for_lock_holder(ds_name, deadline, log_func):
+                    raise RucioAlreadyBeingDownloaded(f'Cannot query rucio about contents of dataset as someone else already has the lock for {ds_name}.')
+            # Whoever had the lock may have done the query for us - if not, try again.
+            listing = self._cache_mgr.get_listing(ds_name)
+            if listing is not None and listing.Created >= started:
+                return
+
+    def _wait_for_lock_holder(self, ds_name: str, deadline: Optional[float], log_func=None) -> bool:
+        '''
+        Wait for whoever holds the download lock for the dataset to let go of it.
+
+        Returns:
+            True        The lock was released
+            False       We aren't waiting for locks, or we gave up.
+        '''
+        with self._queries_lock:
+            batch = self._batched.get(ds_name)
+        if batch is not None:
+            # A batched listing in this process has it - wait for that rather than give up.
+            batch.wait()
+            return True
+        if deadline is None:
+            return False
+        if log_func is not None:
+            log_func(f'Waiting for another process to finish with {ds_name}.')
+        return self._cache_mgr.wait_for_download_lock(ds_name, timeout=max(deadline - time.monotonic(), 0))
 
     def download_ds(self, ds_name: str,
                     do_download: bool = True,
-                    log_func=None) -> Tuple[DatasetQueryStatus, Optional[List[str]]]:
+                    log_func=None,
+                    timeout: Optional[float] = None,
+                    cancel: Optional[threading.Event] = None) -> Tuple[DatasetQueryStatus, Optional[List[str]]]:
         '''
         Return the list of files that are in a dataset if they have been downloaded.
         If not, then a download is started.
@@ -132,6 +446,12 @@ class rucio_cache_interface:
             do_download     If true, then do the download if the file isn't local. If the dataset isn't local, then
                             return does_not_exist for the status.
             log_func        Function called to log any output that occurs
+            timeout         Seconds to wait (for the query and the download) before raising `CallTimedOut`.
+                            The download keeps running in the background.
+            cancel          If this event is set while waiting, raise `CallCancelled`. If nobody else is
+                            waiting for the download, it is stopped.
+
+        Threads asking for the same dataset at the same time share a single download.
 
         Returns:
             status        Status of the returned results (see DatasetQueryStatus) and below:
@@ -142,8 +462,10 @@ class rucio_cache_interface:
                                 Dataset with files: The list will have an entry per file. The files will be relative to
                                     cache directory, unless prefix is not none - then they will have the prefix added.
         '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
         # Do we know if the dataset already exists or not locally? If so, take advantage of that info.
-        status, _ = self.get_ds_contents(ds_name, log_func=log_func)
+        status, _ = self.get_ds_contents(ds_name, log_func=log_func, timeout=timeout, cancel=cancel)
         if status == DatasetQueryStatus.does_not_exist:
             return (DatasetQueryStatus.does_not_exist, None)
 
@@ -154,18 +476,287 @@ class rucio_cache_interface:
             if not do_download:
                 return (DatasetQueryStatus.does_not_exist, None)
 
-            retry_call(self._rucio_download, [ds_name, log_func], exceptions=RucioException, delay=self._seconds_between_retries)
+            self._flights.do(('download', ds_name),
+                             lambda log: retry_call(self._rucio_download, [ds_name, log], exceptions=RucioException, delay=self._seconds_between_retries),
+                             log_func=log_func, timeout=max(deadline - time.monotonic(), 0) if deadline is not None else None,
+                             cancel=cancel)
             f_list = self._cache_mgr.get_ds_contents(ds_name)
 
         return (DatasetQueryStatus.results_valid, f_list)
 
+    def download_many_ds(self, ds_names: Iterable[str],
+                         do_download: bool = True,
+                         log_func=None,
+                         batch_size: int = 50) -> Dict[str, Future]:
+        '''
+        Like `download_ds`, for many datasets at once. The listings are fetched with `get_many_ds_contents`.
+        Datasets already downloaded are returned as soon as their listing is known; the rest are downloaded
+        on a background pool, `download_workers` at a time.
+
+        Arguments
+            ds_names        The rucio fully qualified names of the datasets
+            do_download     As for `download_ds`
+            log_func        Function called to log any output that occurs (from the background threads)
+            batch_size      Most datasets to ask rucio about in one go.
+
+        Returns:
+            futures         Dictionary keyed by dataset name. Each `Future` gives the (status, files) that
+                            `download_ds` would return, or raises what it would raise. Use
+                            `concurrent.futures.as_completed` to handle them as they arrive.
+        '''
+        listings = self.get_many_ds_contents(ds_names, log_func=log_func, batch_size=batch_size)
+        futures = {ds_name: Future() for ds_name in listings}
+        for ds_name, listing in listings.items():
+            listing.add_done_callback(lambda l, ds_name=ds_name: self._download_after_listing(ds_name, l, futures[ds_name], do_download, log_func))
+        return futures
+
+    def _download_after_listing(self, ds_name: str, listing: Future, future: Future, do_download: bool, log_func) -> None:
+        'Once the listing is known, return the dataset if it is already here, otherwise queue the download'
+        try:
+            status, _ = listing.result()
+            if status == DatasetQueryStatus.does_not_exist:
+                future.set_result((DatasetQueryStatus.does_not_exist, None))
+                return
+            f_list = self._cache_mgr.get_ds_contents(ds_name)
+            if f_list is not None:
+                future.set_result((DatasetQueryStatus.results_valid, f_list))
+                return
+            if not do_download:
+                future.set_result((DatasetQueryStatus.does_not_exist, None))
+                return
+        except BaseException as e:
+            future.set_exception(e)
+            return
+
+        def download():
+            try:
+                future.set_result(self.download_ds(ds_name, log_func=log_func, cancel=self._closed))
+            except BaseException as e:
+                future.set_exception(e)
+        try:
+            queued = self._get_download_executor().submit(download)
+        except RuntimeError:
+            # We were closed while the listing was being fetched.
+            future.cancel()
+            return
+        queued.add_done_callback(lambda q: _cancel_if_cancelled(q, [future]))
+
+    def _get_download_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._closed.is_set():
+                raise RuntimeError('The rucio_cache_interface has been closed.')
+            if self._download_executor is None:
+                self._download_executor = ThreadPoolExecutor(max_workers=self._download_workers, thread_name_prefix='ruciopylib-download')
+            return self._download_executor
+
+    def download_ds_pinned(self, ds_name: str,
+                           do_download: bool = True,
+                           log_func=None,
+                           lease: datetime.timedelta = datetime.timedelta(hours=1)) -> Tuple[DatasetQueryStatus, Optional[dataset_pin]]:
+        '''
+        Like `download_ds`, but the dataset is pinned in the cache so it is not evicted while you are using it.
+
+        Arguments
+            ds_name         The rucio fully qualified name of the dataset
+            do_download     If true, then do the download if the file isn't local.
+            log_func        Function called to log any output that occurs
+            lease           How long the pin lasts if it isn't released or renewed
+
+        Returns:
+            status          As for `download_ds`
+            pin             If status is results_valid, a `dataset_pin` with the files in `pin.files`. Use it in a
+                            with statement (or call `release`) when done with the files. None otherwise.
+        '''
+        while True:
+            status, files = self.download_ds(ds_name, do_download=do_download, log_func=log_func)
+            if status != DatasetQueryStatus.results_valid:
+                return (status, None)
+            pin = self._cache_mgr.get_pinned_ds_contents(ds_name, lease)
+            if pin is not None:
+                return (status, pin)
+            # It was evicted between the download and the pin
+            if log_func is not None:
+                log_func(f'Dataset {ds_name} was removed from the cache before it could be pinned, trying again.')
+
+    def download_ds_stream(self, ds_name: str, log_func=None) -> 'ds_download_stream':
+        '''
+        Download a dataset, returning each file as soon as it is available locally, rather than
+        waiting for the whole dataset. Files already on disk are returned first.
+
+        Arguments
+            ds_name         The rucio fully qualified name of the dataset
+            log_func        Function called to log any output that occurs
+
+        Returns:
+            stream          Iterate over it to get the files (relative to the cache directory, like `download_ds`).
+                            Once the iteration is done `status` and `files` hold what `download_ds` would
+                            have returned. Call `cancel` (or stop iterating and close it) to stop the download.
+        '''
+        return ds_download_stream(self, ds_name, log_func)
+
+    def _files_already_downloaded(self, ds_name: str, log_func=None) -> List[str]:
+        'Files in the dataset listing that are already completely on disk'
+        status, listing = self.get_ds_contents(ds_name, log_func=log_func)
+        if status != DatasetQueryStatus.results_valid:
+            return []
+        missing = set(f.filename for f in self._cache_mgr.get_missing_files(ds_name, listing))
+        return [f'{ds_name}/{local_filename(f.filename)}' for f in listing if f.filename not in missing]
+
     def _rucio_download(self, ds_name: str, log_func) -> None:
         'Download the files synchronously - this could take a long time'
-        # Make sure we are the only ones
+        deadline = time.monotonic() + self._lock_wait if self._lock_wait is not None else None
+        while True:
+            # Make sure we are the only ones
+            try:
+                with self._cache_mgr.get_dataset_downloading_lock(ds_name):
+                    listing = self._cache_mgr.get_listing(ds_name)
+                    if listing is not None and listing.FileList is not None:
+                        self._download_missing_files(ds_name, listing.FileList, log_func)
+                        self._cache_mgr.add_to_store(ds_name, listing.FileList)
+                    else:
+                        self._rucio.download_files(ds_name, self._cache_mgr.get_download_directory(), log_func=log_func)
+                    # If we make it through here, then we are really done!
+                    self._cache_mgr.mark_dataset_done(ds_name)
+                    if listing is not None and listing.FileList is not None:
+                        self._publish_to_shared(ds_name, listing.FileList, log_func)
+                    return
+            except filelock.Timeout:
+                if not self._wait_for_lock_holder(ds_name, deadline, log_func):
+                    raise RucioAlreadyBeingDownloaded(f'Someone else has the lock file we need to download for {ds_name}.')
+            # Whoever had the lock may have downloaded it for us - if not (they failed), try again.
+            if self._cache_mgr.get_ds_contents(ds_name) is not None:
+                return
+
+    def _publish_to_shared(self, ds_name: str, files: List[RucioFile], log_func) -> None:
+        'Copy the dataset up to the shared cache. The local copy is already done, so a failure here is only logged.'
         try:
-            with self._cache_mgr.get_dataset_downloading_lock(ds_name):
-                self._rucio.download_files(ds_name, self._cache_mgr.get_download_directory(), log_func=log_func)
-                # If we make it through here, then we are really done!
-                self._cache_mgr.mark_dataset_done(ds_name)
-        except filelock.Timeout:
-            raise RucioAlreadyBeingDownloaded(f'Someone else has the lock file we need to download for {ds_name}.')
+            self._cache_mgr.publish_to_shared(ds_name, files, log_func=log_func)
+        except OSError as e:
+            if log_func is not None:
+                log_func(f'Unable to publish {ds_name} to the shared cache: {e}')
+
+    def _download_missing_files(self, ds_name: str, files: List[RucioFile], log_func) -> None:
+        '''
+        Download only the files in the listing that aren't already on disk (left over from a previous
+        attempt). Must be called while holding the download lock.
+        '''
+        # Anything left half-downloaded from last time has to be fetched again.
+        for f in self._cache_mgr.remove_partial_files(ds_name):
+            if log_func is not None:
+                log_func(f'Removed partially downloaded file {f}')
+
+        # Anything already downloaded for another dataset does not need to be downloaded again.
+        linked = self._cache_mgr.link_from_store(ds_name, files)
+        if log_func is not None and len(linked) > 0:
+            log_func(f'Using {len(linked)} files of {ds_name} already downloaded for other datasets')
+
+        missing = self._cache_mgr.get_missing_files(ds_name, files)
+        if len(missing) == 0:
+            return
+        if log_func is not None and len(missing) < len(files):
+            log_func(f'Resuming download of {ds_name}: {len(files) - len(missing)} of {len(files)} files already downloaded')
+
+        # The shared cache behind this one may already have them. Linked files take no room here, so they
+        # are fetched before making room, copies after.
+        links = self._cache_mgr.links_shared_files
+        if links and len(self._cache_mgr.fetch_from_shared(ds_name, missing, log_func=log_func)) > 0:
+            missing = self._cache_mgr.get_missing_files(ds_name, missing)
+            if len(missing) == 0:
+                return
+
+        needed = sum(f.size for f in missing)
+        if not self._cache_mgr.make_room(needed, keep=[ds_name], log_func=log_func):
+            raise CacheFull(f'Not enough room in the cache quota for the {needed} bytes of {ds_name}.')
+
+        if not links and len(self._cache_mgr.fetch_from_shared(ds_name, missing, log_func=log_func)) > 0:
+            missing = self._cache_mgr.get_missing_files(ds_name, missing)
+            if len(missing) == 0:
+                return
+
+        if self._downloader is not None:
+            self._downloader.download(self._rucio, missing, self._cache_mgr.get_ds_directory(ds_name), log_func=log_func)
+        elif len(missing) < len(files):
+            r = self._rucio.download_file_list([f.filename for f in missing], self._cache_mgr.get_ds_directory(ds_name), log_func=log_func)
+            if r is None:
+                raise RucioException(f'Unable to download the missing files of {ds_name}.')
+        else:
+            self._rucio.download_files(ds_name, self._cache_mgr.get_download_directory(), log_func=log_func)
+
+
+class ds_download_stream:
+    r'''
+    The files of a dataset, as they finish downloading. See `rucio_cache_interface.download_ds_stream`.
+
+    The download is run on a background thread, and is started when iteration starts.
+    '''
+
+    def __init__(self, ds_mgr: rucio_cache_interface, ds_name: str, log_func=None):
+        self._ds_mgr = ds_mgr
+        self._ds_name = ds_name
+        self._log_func = log_func
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self.status = None
+        self.files = None
+
+    def cancel(self) -> None:
+        '''
+        Stop the download. The running rucio command is stopped right away, unless someone else is
+        also waiting for the download. The iteration will end without a status.
+        '''
+        self._cancelled.set()
+        self._queue.put(('cancelled',))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def __iter__(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        seen = set()
+        try:
+            while True:
+                item = self._queue.get()
+                if item[0] == 'file':
+                    if item[1] not in seen:
+                        seen.add(item[1])
+                        yield item[1]
+                elif item[0] == 'error':
+                    raise item[1]
+                elif item[0] == 'cancelled':
+                    return
+                else:
+                    # Pick up anything we did not see go by in the log
+                    _, status, files = item
+                    for f in files if files is not None else []:
+                        if f not in seen:
+                            seen.add(f)
+                            yield f
+                    self.status, self.files = status, files
+                    return
+        finally:
+            if self.status is None:
+                self.cancel()
+
+    def _log(self, line: str) -> None:
+        'Look for files that have finished as the download log goes by'
+        if self._cancelled.is_set():
+            raise DownloadCancelled(f'Download of {self._ds_name} was cancelled.')
+        if self._log_func is not None:
+            self._log_func(line)
+        m = _download_finder.match(line)
+        if m is not None:
+            self._queue.put(('file', f'{self._ds_name}/{local_filename(m.group("file_name"))}'))
+
+    def _run(self) -> None:
+        try:
+            # Anything that is already here can be used right away
+            for f in self._ds_mgr._files_already_downloaded(self._ds_name, log_func=self._log):
+                self._queue.put(('file', f))
+
+            status, files = self._ds_mgr.download_ds(self._ds_name, log_func=self._log, cancel=self._cancelled)
+            self._queue.put(('done', status, files))
+        except (DownloadCancelled, CallCancelled):
+            pass
+        except BaseException as e:
+            self._queue.put(('error', e))
@@ -0,0 +1,115 @@
+# Talk to rucio using the rucio client library, in process, rather than
+# running the command line tools.
+from ruciopylib.rucio import RucioFile, RucioException, rucio_backend, normalize_guid
+from typing import List, Optional, Tuple
+
+
+def split_did(did: str) -> Tuple[str, str]:
+    '''
+    Split a DID into scope and name. If there is no scope, it is taken from the name the same way
+    the rucio command line tools do (`user.gwatts.ds` is in the `user.gwatts` scope, `mc16_13TeV.1234.ds`
+    is in the `mc16_13TeV` scope).
+    '''
+    if ':' in did:
+        scope, name = did.split(':', 1)
+        return (scope, name)
+    parts = did.split('.')
+    if parts[0] in ['user', 'group'] and len(parts) > 1:
+        return ('.'.join(parts[0:2]), did)
+    return (parts[0], did)
+
+
+def _is_rucio_exception(e: BaseException, name: str) -> bool:
+    'Is this exception (or one of its bases) the rucio exception with this name? Avoids having to import rucio.'
+    return any(c.__name__ == name for c in type(e).__mro__)
+
+
+class rucio_client_backend(rucio_backend):
+    r'''
+    Uses the rucio client library to list and download datasets. This avoids starting a new
+    process for each call, and parsing the text tables the command line tools print.
+
+    The `rucio-clients` package must be installed unless both clients are injected.
+    '''
+    exact_sizes = True
+
+    def __init__(self, client=None, download_client=None, num_threads: int = 2):
+        '''
+        Initialize the backend.
+
+        Arguments:
+            client              The rucio `Client` to use for queries. Created if None.
+            download_client     The rucio `DownloadClient` to use for downloads. Created if None.
+            num_threads         Number of threads the download client should use.
+        '''
+        if client is None:
+            from rucio.client import Client
+            client = Client()
+        if download_client is None:
+            from rucio.client.downloadclient import DownloadClient
+            download_client = DownloadClient(client=client)
+        self._client = client
+        self._download_client = download_client
+        self._num_threads = num_threads
+
+    def get_file_listing(self, ds_name, log_func=None) -> Optional[List[RucioFile]]:
+        '''
+        Return a list of files in the dataset. See `rucio.get_file_listing`.
+        '''
+        scope, name = split_did(ds_name)
+        try:
+            files = [RucioFile('{0}:{1}'.format(f['scope'], f['name']), int(f['bytes']),
+                               int(f['events']) if f.get('events') is not None else 0,
+                               f.get('adler32'), normalize_guid(f.get('guid')))
+                     for f in self._client.list_files(scope, name)]
+        except Exception as e:
+            if _is_rucio_exception(e, 'DataIdentifierNotFound'):
+                if log_func is not None:
+                    log_func('Data identifier {0} not found.'.format(ds_name))
+                return None
+            raise RucioException('Unable to get rucio to list files for {0}: {1}. Try again.'.format(ds_name, e))
+
+        if log_func is not None:
+            log_func('Found {0} files in {1}'.format(len(files), ds_name))
+        return files
+
+    def download_files(self, ds_name: str, data_dir: str, log_func=None) -> Optional[List[str]]:
+        '''
+        Download files in a dataset. See `rucio.download_files`.
+        '''
+        scope, name = split_did(ds_name)
+        return self._download([{'did': '{0}:{1}'.format(scope, name), 'base_dir': data_dir}], log_func)
+
+    def download_file_list(self, files: List[str], dest_dir: str, log_func=None) -> Optional[List[str]]:
+        '''
+        Download individual files into a directory. See `rucio.download_file_list`.
+        '''
+        return self._download([{'did': f, 'base_dir': dest_dir, 'no_subdir': True} for f in files], log_func)
+
+    def _download(self, items, log_func) -> Optional[List[str]]:
+        'Run the download client and turn its results into what `download_files` returns'
+        try:
+            results = self._download_client.download_dids(items, num_threads=self._num_threads)
+        except Exception as e:
+            if _is_rucio_exception(e, 'DataIdentifierNotFound'):
+                return None
+            raise RucioException('Rucio failed to download {0}: {1}.'.format(', '.join(i['did'] for i in items), e))
+
+        if len(results) == 0:
+            # Same as the command line "Using main thread to download 0 file(s)"
+            return None
+
+        # Log the same messages the command line tools do.
+        files = []
+        for r in results:
+            state = r.get('clientState')
+            if state == 'DONE':
+                msg = 'File {0} successfully downloaded.'.format(r['did'])
+                files.append(r['did'])
+            elif state == 'ALREADY_DONE':
+                msg = 'File exists already locally: {0}'.format(r['did'])
+            else:
+                raise RucioException('Rucio failed to download {0} (state {1}).'.format(r.get('did'), state))
+            if log_func is not None:
+                log_func(msg)
+        return files
@@ -1,10 +1,43 @@
 # Runs commands in a subprocess
-from collections import namedtuple
+from collections import namedtuple, deque
 from subprocess import Popen, PIPE, STDOUT
+from typing import Optional
+import asyncio
+import os
+import signal
+import threading
 
 exe_result = namedtuple('ExeResult', 'shell_result shell_status shell_output')
 
 
+class CommandCancelled(BaseException):
+    'Thrown when a command is killed because its `log_func.cancelled` event was set'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
+def _kill_process_group(p: Popen) -> None:
+    '''
+    Kill a command started in its own session: the whole process group, so the command the shell started
+    is killed along with the shell, and nothing is left holding the output pipe.
+    '''
+    if os.name != 'posix':
+        p.kill()
+        return
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _kill_when_cancelled(p: Popen, cancelled: threading.Event, poll_interval: float = 0.05) -> None:
+    'Kill the process once the event is set. Returns when the process has finished'
+    while not cancelled.wait(poll_interval):
+        if p.poll() is not None:
+            return
+    _kill_process_group(p)
+
+
 class runner:
     def __init__(self):
         pass
@@ -13,6 +46,128 @@ class runner:
         '''
         Run in the default command shell, synchronously.
 
+        Args:
+            shell_command       The shell command to run
+            log_func            Log the lines in real time.
+
+        Returns:
+            exe_result:         (shell_result,shell_status,shell_output)
+                                shell_result is the exit code
+                                shell_status is True if the exit code is 0
+                                shell_output are the stdout/stderr lines
+        '''
+        s = self.shell_stream(shell_command, log_func=log_func, keep_lines=None)
+        for _ in s:
+            pass
+        return s.result
+
+    def shell_stream(self, shell_command, log_func=None, keep_lines: Optional[int] = 100) -> 'exe_stream':
+        '''
+        Run in the default command shell, returning the lines as they are produced. Only the last
+        few lines are kept around for the final result (for error reporting).
+
+        Args:
+            shell_command       The shell command to run
+            log_func            Log the lines in real time. If it has a `cancelled` attribute (a
+                                `threading.Event`, like the log functions `single_flight` hands out), the
+                                command is killed as soon as that is set, and `CommandCancelled` is raised.
+            keep_lines          How many lines to keep for the `shell_output` of the final result.
+                                None means keep them all.
+
+        Returns:
+            exe_stream:         Iterate over it to get the lines. Once done, `result` holds the
+                                `exe_result`. If the iteration is abandoned, the command is killed.
+        '''
+        return exe_stream(self._run_lines(shell_command, log_func, keep_lines))
+
+    def _run_lines(self, shell_command, log_func, keep_lines):
+        lines = deque(maxlen=keep_lines)
+        cancelled = getattr(log_func, 'cancelled', None)
+        with Popen(shell_command, shell=True, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True,
+                   start_new_session=os.name == 'posix') as p:
+            if cancelled is not None:
+                threading.Thread(target=_kill_when_cancelled, args=(p, cancelled), daemon=True).start()
+            try:
+                for line in p.stdout:
+                    l_trim = line.rstrip()
+                    lines.append(l_trim)
+                    if log_func is not None:
+                        log_func(l_trim)
+                    yield l_trim
+            except BaseException:
+                # Nobody is listening any longer
+                _kill_process_group(p)
+                raise
+            p.wait()
+            if cancelled is not None and cancelled.is_set():
+                raise CommandCancelled(f'{shell_command} was cancelled.')
+            return exe_result(p.returncode, p.returncode == 0, list(lines))
+
+
+class exe_stream:
+    r'''
+    The lines of output from a command, as they are produced. Iterate over it to run the command.
+    Once the iteration is done, `result` contains the `exe_result`.
+    '''
+    def __init__(self, lines_generator):
+        '''
+        Arguments:
+            lines_generator     Generator that yields the lines, and returns the `exe_result`.
+        '''
+        self._lines = lines_generator
+        self.result = None
+
+    def __iter__(self):
+        self.result = yield from self._lines
+
+    def close(self) -> None:
+        'Abandon the command'
+        self._lines.close()
+
+    @classmethod
+    def from_result(cls, r: exe_result) -> 'exe_stream':
+        'Wrap an already finished command'
+        def lines():
+            yield from r.shell_output
+            return r
+        return cls(lines())
+
+
+def stream_command(executor, shell_command, log_func=None, keep_lines: Optional[int] = 100) -> exe_stream:
+    '''
+    Run a command on an executor, streaming the output lines if the executor supports it (a `shell_stream`
+    method). Otherwise `shell_execute` is used, and the lines are returned once the command is done.
+    '''
+    if hasattr(executor, 'shell_stream'):
+        return executor.shell_stream(shell_command, log_func=log_func, keep_lines=keep_lines)
+    return exe_stream.from_result(executor.shell_execute(shell_command, log_func=log_func))
+
+
+class async_runner:
+    r'''
+    Runs commands in a subprocess using `asyncio`. Many commands can be in flight on a single
+    event loop without tying up an OS thread per command.
+
+    Can be used anywhere a `runner` is used. The synchronous `shell_execute` will run the command
+    on the event loop given at construction (and block the calling thread), or, if there is no
+    loop, on a private one.
+    '''
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, line_limit: int = 1024 * 1024):
+        '''
+        Initialize the async runner.
+
+        Arguments:
+            loop            The event loop the synchronous `shell_execute` should submit commands to. This
+                            loop must be running in another thread. If None, `asyncio.run` is used.
+            line_limit      Longest line (in bytes) we can read back from a command.
+        '''
+        self._loop = loop
+        self._line_limit = line_limit
+
+    async def shell_execute_async(self, shell_command, log_func=None) -> exe_result:
+        '''
+        Run in the default command shell, asynchronously.
+
         Args:
             shell_command       The shell command to run
             log_func            Log the lines in real time.
@@ -24,11 +179,31 @@ class runner:
                                 shell_output are the stdout/stderr lines
         '''
         lines = []
-        with Popen(shell_command, shell=True, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True) as p:
-            for line in p.stdout:
-                l_trim = line.rstrip()
+        p = await asyncio.create_subprocess_shell(shell_command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                  limit=self._line_limit)
+        try:
+            while True:
+                line = await p.stdout.readline()
+                if not line:
+                    break
+                l_trim = line.decode(errors='replace').rstrip()
                 lines.append(l_trim)
                 if log_func is not None:
                     log_func(l_trim)
-            p.wait()
-            return exe_result(p.returncode, p.returncode == 0, lines)
+            await p.wait()
+        except BaseException:
+            # Cancelled or the log function failed - do not leave the process behind.
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            raise
+        return exe_result(p.returncode, p.returncode == 0, lines)
+
+    def shell_execute(self, shell_command, log_func=None) -> exe_result:
+        '''
+        Run in the default command shell, synchronously. See `shell_execute_async` for
+        arguments and return value.
+        '''
+        if self._loop is None:
+            return asyncio.run(self.shell_execute_async(shell_command, log_func=log_func))
+        return asyncio.run_coroutine_threadsafe(self.shell_execute_async(shell_command, log_func=log_func), self._loop).result()
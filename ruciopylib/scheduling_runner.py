@@ -0,0 +1,143 @@
+# Sits in front of a runner and limits how many commands can run at once.
+from ruciopylib.runner import runner, exe_result, exe_stream, stream_command
+from collections import namedtuple
+from enum import Enum
+from typing import Dict, Optional, Tuple
+import itertools
+import threading
+import time
+
+# Lower values are run first.
+CommandPriority = Enum('CommandPriority', 'interactive, bulk')
+
+# Snapshot of what the scheduler is doing. Wait times are in seconds.
+SchedulerStats = namedtuple('SchedulerStats', 'queued running completed total_wait max_wait')
+
+
+def classify_rucio_command(shell_command: str) -> Tuple[str, CommandPriority]:
+    '''
+    Figure out what sort of command this is. Listings are interactive (someone is usually waiting on
+    them), downloads are bulk.
+
+    Returns:
+        kind            'listing', 'download', or 'other'
+        priority        The `CommandPriority` the command should be run at.
+    '''
+    if 'rucio download' in shell_command:
+        return ('download', CommandPriority.bulk)
+    if 'rucio list-files' in shell_command:
+        return ('listing', CommandPriority.interactive)
+    return ('other', CommandPriority.interactive)
+
+
+class scheduling_runner:
+    r'''
+    Wraps a `runner` and only lets a limited number of commands run at once. Callers that can't
+    run right away are blocked until a slot opens up. When a slot opens, the waiting command with
+    the best priority that fits (and then the one that has waited longest) is run.
+
+    Can be used anywhere a `runner` is used. The command is run on the calling thread.
+    '''
+    def __init__(self, executor: runner = None,
+                 max_workers: int = 4,
+                 kind_limits: Optional[Dict[str, int]] = None,
+                 classify=None):
+        '''
+        Initialize the scheduler
+
+        Arguments:
+            executor        The runner that actually runs the commands.
+            max_workers     Total number of commands that can run at once.
+            kind_limits     Limit for each kind of command (see `classify_rucio_command`). Kinds not
+                            present are only limited by `max_workers`. Defaults to 2 downloads at a time.
+            classify        Function that takes a command and returns (kind, `CommandPriority`). Defaults
+                            to `classify_rucio_command`.
+        '''
+        self._runner = executor if executor is not None else runner()
+        self._max_workers = max_workers
+        self._kind_limits = kind_limits if kind_limits is not None else {'download': 2}
+        self._classify = classify if classify is not None else classify_rucio_command
+
+        self._lock = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = {}
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        'Number of commands waiting for a slot'
+        with self._lock:
+            return len(self._waiting)
+
+    def stats(self) -> SchedulerStats:
+        'Return a snapshot of the queue'
+        with self._lock:
+            return SchedulerStats(len(self._waiting), sum(self._running.values()), self._completed,
+                                  self._total_wait, self._max_wait)
+
+    def _has_room(self, kind: str) -> bool:
+        if sum(self._running.values()) >= self._max_workers:
+            return False
+        return self._running.get(kind, 0) < self._kind_limits.get(kind, self._max_workers)
+
+    def _next_ticket(self):
+        'The waiting ticket that should run next, or None if nothing can run. Must hold the lock.'
+        runnable = [t for t in self._waiting if self._has_room(t[2])]
+        return min(runnable) if len(runnable) > 0 else None
+
+    def _acquire(self, kind: str, priority: CommandPriority) -> None:
+        'Block until this command can run'
+        start = time.monotonic()
+        ticket = (priority.value, next(self._seq), kind)
+        with self._lock:
+            self._waiting.append(ticket)
+            try:
+                self._lock.wait_for(lambda: self._next_ticket() == ticket)
+            finally:
+                self._waiting.remove(ticket)
+            self._running[kind] = self._running.get(kind, 0) + 1
+
+            waited = time.monotonic() - start
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+            # Someone else may also fit now.
+            self._lock.notify_all()
+
+    def _release(self, kind: str) -> None:
+        with self._lock:
+            self._running[kind] -= 1
+            self._completed += 1
+            self._lock.notify_all()
+
+    def shell_execute(self, shell_command, log_func=None) -> exe_result:
+        '''
+        Run the command once there is a free slot. See `runner.shell_execute` for
+        arguments and return.
+        '''
+        kind, priority = self._classify(shell_command)
+        self._acquire(kind, priority)
+        try:
+            return self._runner.shell_execute(shell_command, log_func=log_func)
+        finally:
+            self._release(kind)
+
+    def shell_stream(self, shell_command, log_func=None, keep_lines: Optional[int] = 100) -> exe_stream:
+        '''
+        Stream the command once there is a free slot. The slot is held until the stream is finished
+        or abandoned. See `runner.shell_stream` for arguments and return.
+        '''
+        return exe_stream(self._stream_lines(shell_command, log_func, keep_lines))
+
+    def _stream_lines(self, shell_command, log_func, keep_lines):
+        kind, priority = self._classify(shell_command)
+        self._acquire(kind, priority)
+        try:
+            s = stream_command(self._runner, shell_command, log_func=log_func, keep_lines=keep_lines)
+            yield from s
+            return s.result
+        finally:
+            self._release(kind)
@@ -0,0 +1,229 @@
+# Runs commands in a long lived shell, so the cost of starting the shell and setting up
+# the environment (e.g. `lsetup rucio`) is only paid once.
+from ruciopylib.runner import CommandCancelled, exe_result, exe_stream, _kill_process_group
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT
+from typing import List, Optional
+import os
+import queue
+import re
+import signal
+import threading
+import uuid
+
+
+class SessionSetupFailed(BaseException):
+    'Thrown when one of the setup commands of a `shell_session` fails'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
+def _kill_shell_when_cancelled(p: Popen, cancelled: threading.Event, done: threading.Event,
+                               poll_interval: float = 0.05) -> None:
+    'Kill the shell if the event is set before the command is done'
+    while not done.wait(poll_interval):
+        if cancelled.is_set():
+            _kill_process_group(p)
+            return
+
+
+class shell_session:
+    r'''
+    A single long lived shell. Commands are sent to the shell one at a time, each followed by a
+    sentinel line that carries the exit code, so the output of each command can be split back
+    out into its own `exe_result`.
+
+    Each command is run in a sub-shell with no stdin, so a `cd` or `exit` in a command does not
+    change the session. Environment set by the `setup_commands` is seen by all commands.
+
+    If the `log_func` has a `cancelled` event (see `single_flight`), setting it kills the session
+    and `CommandCancelled` is raised. The session is restarted for the next command.
+
+    Can be used anywhere a `runner` is used. Only one command runs at a time - use a `session_pool`
+    to run several at once.
+    '''
+    def __init__(self, shell: str = '/bin/sh', setup_commands: Optional[List[str]] = None):
+        '''
+        Initialize the session. The shell is not started until the first command is run.
+
+        Arguments:
+            shell           The shell to run.
+            setup_commands  Commands that are run once, when the shell starts (and again if it
+                            has to be restarted). If one fails `SessionSetupFailed` is raised.
+        '''
+        self._shell = shell
+        self._setup_commands = setup_commands if setup_commands is not None else []
+        self._p = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        'Shut down the shell, and anything still running in it'
+        if self._p is not None:
+            try:
+                self._p.stdin.close()
+            except OSError:
+                pass
+            if os.name == 'posix':
+                # The shell leads its own process group, so this also gets the sub-shell and the command
+                # it is running.
+                try:
+                    os.killpg(self._p.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+            else:
+                self._p.kill()
+            self._p.wait()
+            self._p.stdout.close()
+            self._p = None
+
+    def _start(self) -> None:
+        'Start the shell if needed and run the setup commands'
+        if self._p is not None and self._p.poll() is None:
+            return
+        self.close()
+        self._p = Popen([self._shell], stdin=PIPE, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True,
+                        start_new_session=os.name == 'posix')
+        for c in self._setup_commands:
+            # Run in the shell itself, so the environment sticks, but never let it read our commands.
+            lines = deque(maxlen=100)
+            s = exe_stream(self._send('{\n' + c + '\n} </dev/null', sub_shell=False, log_func=None, lines=lines))
+            for _ in s:
+                pass
+            if s.result != 0:
+                self.close()
+                raise SessionSetupFailed(f'Setup command "{c}" failed with exit code {s.result}: {list(lines)}')
+
+    def _send(self, shell_command: str, sub_shell: bool, log_func, lines: deque):
+        'Send the command and yield the lines until the sentinel shows up. Returns the exit code.'
+        sentinel = '__ruciopylib_{0}__'.format(uuid.uuid4().hex)
+        if sub_shell:
+            shell_command = '(\n{0}\n) </dev/null 2>&1'.format(shell_command)
+        self._p.stdin.write('{0}\necho "{1} $?"\n'.format(shell_command, sentinel))
+        self._p.stdin.flush()
+
+        done = re.compile(r'(?P<last>.*){0} (?P<code>-?\d+)$'.format(sentinel))
+        for line in self._p.stdout:
+            l_trim = line.rstrip()
+            m = done.match(l_trim)
+            if m is not None:
+                # If the command's output did not end in a newline we'll have some of it here.
+                l_trim = m.group('last')
+                if len(l_trim) > 0:
+                    lines.append(l_trim)
+                    if log_func is not None:
+                        log_func(l_trim)
+                    yield l_trim
+                return int(m.group('code'))
+            lines.append(l_trim)
+            if log_func is not None:
+                log_func(l_trim)
+            yield l_trim
+
+        # The shell died out from under us.
+        self.close()
+        return -1
+
+    def shell_execute(self, shell_command, log_func=None) -> exe_result:
+        '''
+        Run the command in the session, synchronously. See `runner.shell_execute` for arguments and return.
+        '''
+        s = self.shell_stream(shell_command, log_func=log_func, keep_lines=None)
+        for _ in s:
+            pass
+        return s.result
+
+    def shell_stream(self, shell_command, log_func=None, keep_lines: Optional[int] = 100) -> exe_stream:
+        '''
+        Run the command in the session, streaming back the lines. If the stream is abandoned the
+        session is restarted. See `runner.shell_stream` for arguments and return.
+        '''
+        return exe_stream(self._run_lines(shell_command, log_func, keep_lines))
+
+    def _run_lines(self, shell_command, log_func, keep_lines):
+        lines = deque(maxlen=keep_lines)
+        cancelled = getattr(log_func, 'cancelled', None)
+        with self._lock:
+            if cancelled is not None and cancelled.is_set():
+                raise CommandCancelled(f'{shell_command} was cancelled.')
+            self._start()
+            done = threading.Event()
+            if cancelled is not None:
+                threading.Thread(target=_kill_shell_when_cancelled, args=(self._p, cancelled, done), daemon=True).start()
+            try:
+                code = yield from self._send(shell_command, True, log_func, lines)
+            except BaseException:
+                # The command is still running, and we can't get the shell back in sync.
+                self.close()
+                raise
+            finally:
+                done.set()
+            if cancelled is not None and cancelled.is_set():
+                # The shell may have been killed out from under the command.
+                self.close()
+                raise CommandCancelled(f'{shell_command} was cancelled.')
+            return exe_result(code, code == 0, list(lines))
+
+
+class session_pool:
+    r'''
+    A fixed number of `shell_session`s. Each command is run on the next free session, so up to
+    `size` commands can run at once.
+
+    Can be used anywhere a `runner` is used.
+    '''
+    def __init__(self, size: int = 4, shell: str = '/bin/sh', setup_commands: Optional[List[str]] = None):
+        '''
+        Initialize the pool. Sessions are not started until they are first used.
+
+        Arguments:
+            size            Number of sessions
+            shell           The shell to run.
+            setup_commands  Commands run once when each session starts.
+        '''
+        self._sessions = [shell_session(shell=shell, setup_commands=setup_commands) for _ in range(size)]
+        self._idle = queue.Queue()
+        for s in self._sessions:
+            self._idle.put(s)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        'Shut down all the sessions'
+        for s in self._sessions:
+            s.close()
+
+    def shell_execute(self, shell_command, log_func=None) -> exe_result:
+        '''
+        Run the command on the next free session. See `runner.shell_execute` for arguments and return.
+        '''
+        s = self._idle.get()
+        try:
+            return s.shell_execute(shell_command, log_func=log_func)
+        finally:
+            self._idle.put(s)
+
+    def shell_stream(self, shell_command, log_func=None, keep_lines: Optional[int] = 100) -> exe_stream:
+        '''
+        Stream the command on the next free session. The session is held until the stream is
+        done. See `runner.shell_stream` for arguments and return.
+        '''
+        return exe_stream(self._stream_lines(shell_command, log_func, keep_lines))
+
+    def _stream_lines(self, shell_command, log_func, keep_lines):
+        s = self._idle.get()
+        try:
+            st = s.shell_stream(shell_command, log_func=log_func, keep_lines=keep_lines)
+            yield from st
+            return st.result
+        finally:
+            self._idle.put(s)
@@ -0,0 +1,158 @@
+# Make sure that when several threads ask for the same thing at once, only one of them does the
+# work, and the rest wait for (and share) its result.
+from typing import Callable, Dict, Hashable, List, Optional
+import threading
+import time
+
+
+class CallTimedOut(BaseException):
+    'Thrown when a caller gives up waiting for a shared call'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
+class CallCancelled(BaseException):
+    'Thrown when a caller cancels waiting for a shared call, or into the call when nobody is waiting any more'
+    def __init__(self, msg):
+        BaseException.__init__(self, msg)
+
+
+class _waiter:
+    def __init__(self, log_func):
+        self.log_func = log_func
+        self.error = None
+        self.wakeup = threading.Event()
+
+
+class _flight:
+    def __init__(self):
+        self.waiters: List[_waiter] = []
+        self.result = None
+        self.error = None
+        # Someone timed out - they may come back for the result, so do not stop the call.
+        self.keep_running = False
+        # Set once nobody is waiting for the call any more.
+        self.cancelled = threading.Event()
+
+
+class single_flight:
+    r'''
+    Coalesce calls: while a call for a key is running, anyone else asking for the same key waits for
+    that call to finish and gets the same result (or exception).
+
+    The call is run on its own (daemon) thread, so each caller can have its own timeout and can cancel.
+    The call is given a log function that passes each line on to all the callers waiting for it. If a
+    caller's log function raises, that caller stops waiting and gets the exception. If a caller times out,
+    the call is left to finish (until someone new starts waiting for it).
+
+    Once everyone waiting has gone (cancelled, or their log function raised), the call is told to stop:
+    the log function's `cancelled` attribute (a `threading.Event`) is set, and the next time the log
+    function is called it raises `CallCancelled`. A `runner` kills a running command as soon as
+    `cancelled` is set, even if the command is not printing anything.
+
+    As the thread is a daemon, a call still running when the interpreter exits is stopped without any
+    clean up - e.g. a dataset download lock it holds is left behind (and is reclaimed as stale by the
+    next process to want it).
+    '''
+    def __init__(self, poll_interval: float = 0.05):
+        '''
+        Arguments:
+            poll_interval   How often (seconds) to check a caller's cancel event.
+        '''
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _flight] = {}
+        self._poll_interval = poll_interval
+
+    def in_flight(self, key: Hashable) -> bool:
+        'True if a call for this key is running'
+        with self._lock:
+            return key in self._flights
+
+    def do(self, key: Hashable, func: Callable, log_func=None,
+           timeout: Optional[float] = None, cancel: Optional[threading.Event] = None):
+        '''
+        Run `func(log_func)`, or wait for the call with the same key that is already running.
+
+        Arguments:
+            key         Calls with the same key are shared
+            func        Called with a log function. Its return value is returned to every caller. The log
+                        function's `cancelled` event is set when nobody is waiting any more.
+            log_func    Called with the log lines of the shared call (from another thread)
+            timeout     Seconds to wait before raising `CallTimedOut`. The call keeps running (and its result
+                        is thrown away).
+            cancel      If this event is set, stop waiting and raise `CallCancelled`.
+
+        Returns:
+            The result of the shared call.
+        '''
+        w = _waiter(log_func)
+        with self._lock:
+            flight = self._flights.get(key)
+            # A call that has been told to stop is no use to a new caller - start another.
+            start = flight is None or flight.cancelled.is_set()
+            if start:
+                flight = _flight()
+                self._flights[key] = flight
+            else:
+                # Someone is waiting again, so the call can be cancelled again.
+                flight.keep_running = False
+            flight.waiters.append(w)
+        if start:
+            threading.Thread(target=self._run, args=(key, flight, func), daemon=True).start()
+
+        try:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while True:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    flight.keep_running = True
+                    raise CallTimedOut(f'Gave up waiting for {key} after {timeout} seconds.')
+                if cancel is not None:
+                    wait = self._poll_interval if wait is None else min(wait, self._poll_interval)
+                if w.wakeup.wait(wait):
+                    break
+                if cancel is not None and cancel.is_set():
+                    raise CallCancelled(f'Stopped waiting for {key}.')
+        finally:
+            with self._lock:
+                flight.waiters.remove(w)
+                if len(flight.waiters) == 0 and not flight.keep_running and self._flights.get(key) is flight:
+                    flight.cancelled.set()
+
+        if w.error is not None:
+            raise w.error
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _run(self, key: Hashable, flight: _flight, func: Callable) -> None:
+        def log(line: str) -> None:
+            if flight.cancelled.is_set():
+                raise CallCancelled(f'Nobody is waiting for {key} any more.')
+            with self._lock:
+                waiters = [w for w in flight.waiters if w.error is None]
+            if len(waiters) == 0 and not flight.keep_running:
+                raise CallCancelled(f'Nobody is waiting for {key} any more.')
+            for w in waiters:
+                if w.log_func is not None:
+                    try:
+                        w.log_func(line)
+                    except BaseException as e:
+                        w.error = e
+                        w.wakeup.set()
+            if len(waiters) > 0 and all(w.error is not None for w in waiters) and not flight.keep_running:
+                flight.cancelled.set()
+                raise CallCancelled(f'Nobody is waiting for {key} any more.')
+        log.cancelled = flight.cancelled
+
+        try:
+            flight.result = func(log)
+        except BaseException as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                waiters = list(flight.waiters)
+            for w in waiters:
+                w.wakeup.set()
@@ -1,12 +1,17 @@
 # Tests for the dataset manager
 
-from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info
-from ruciopylib.rucio import RucioFile
+from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info, size_matches, EvictionPolicy, file_adler32
+from ruciopylib.rucio import RucioFile, calc_size
 from tests.utils_for_tests import simple_dataset, nonexistant_dataset
 import pytest
+import datetime
 import filelock
+import subprocess
 import tempfile
 import shutil
+import socket
+import threading
+import time
 import os
 
 @pytest.fixture()
@@ -111,3 +116,721 @@ def test_ds_mark_lock_works(local_cache, simple_dataset):
                 assert False
     except filelock.Timeout:
         return
+
+def test_ds_missing_files_none_downloaded(local_cache, simple_dataset):
+    assert 2 == len(local_cache.get_missing_files(simple_dataset.Name, simple_dataset.FileList))
+
+def test_ds_missing_files_all_there(local_cache):
+    ds = dataset_listing_info('dataset1', [RucioFile('scope:f1.root', 2, 1), RucioFile('scope:f2.root', 2, 1)])
+    create_ds(ds, local_cache, write_done_file=False)
+    os.rename(f'{local_cache._loc}/dataset1/scope:f1.root', f'{local_cache._loc}/dataset1/f1.root')
+    os.rename(f'{local_cache._loc}/dataset1/scope:f2.root', f'{local_cache._loc}/dataset1/f2.root')
+    assert 0 == len(local_cache.get_missing_files(ds.Name, ds.FileList))
+
+def test_ds_missing_files_wrong_size(local_cache):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 2, 1), RucioFile('f2.root', 2000, 1)])
+    create_ds(ds, local_cache, write_done_file=False)
+    missing = local_cache.get_missing_files(ds.Name, ds.FileList)
+    assert ['f2.root'] == [f.filename for f in missing]
+
+def test_ds_missing_files_parts(local_cache, simple_dataset):
+    create_ds(simple_dataset, local_cache, write_done_file=False, write_as_parts=True)
+    assert 2 == len(local_cache.get_missing_files(simple_dataset.Name, simple_dataset.FileList))
+
+def test_ds_partial_files(local_cache, simple_dataset):
+    create_ds(simple_dataset, local_cache, write_done_file=False, write_as_parts=True)
+    assert 2 == len(local_cache.get_partial_files(simple_dataset.Name))
+    removed = local_cache.remove_partial_files(simple_dataset.Name)
+    assert 'dataset1/f1.root.part' in removed
+    assert 0 == len(local_cache.get_partial_files(simple_dataset.Name))
+    assert 0 == len(os.listdir(f'{local_cache._loc}/dataset1'))
+
+def test_ds_partial_files_no_ds(local_cache, simple_dataset):
+    assert [] == local_cache.get_partial_files(simple_dataset.Name)
+
+def test_size_matches():
+    assert size_matches(100, 100)
+    assert not size_matches(101, 99)
+    assert size_matches(1981234567, calc_size('1.981 GB'))
+    assert not size_matches(1983000000, calc_size('1.981 GB'))
+    # Listed sizes are decimal - a binary GB is 7% bigger
+    assert not size_matches(int(1.981*1024*1024*1024), calc_size('1.981 GB'))
+
+def test_ds_listing_memory_hit(local_cache, simple_dataset):
+    local_cache.save_listing(simple_dataset)
+    l1 = local_cache.get_listing(simple_dataset.Name)
+    l2 = local_cache.get_listing(simple_dataset.Name)
+    assert l1 is l2
+    stats = local_cache.listing_cache_stats()
+    assert 1 == stats.hits
+    assert 1 == stats.misses
+    assert 1 == stats.entries
+    assert stats.bytes > 0
+
+def test_ds_listing_memory_sees_save(local_cache, simple_dataset, nonexistant_dataset):
+    local_cache.save_listing(simple_dataset)
+    assert 2 == len(local_cache.get_listing(simple_dataset.Name).FileList)
+    local_cache.save_listing(nonexistant_dataset)
+    assert None is local_cache.get_listing(simple_dataset.Name).FileList
+
+def test_ds_listing_memory_sees_other_process(local_cache, simple_dataset, nonexistant_dataset):
+    local_cache.save_listing(simple_dataset)
+    assert 2 == len(local_cache.get_listing(simple_dataset.Name).FileList)
+    other = dataset_local_cache(location=local_cache._loc)
+    other.save_listing(nonexistant_dataset)
+    assert None is local_cache.get_listing(simple_dataset.Name).FileList
+
+def test_ds_listing_memory_sees_delete(local_cache, simple_dataset):
+    local_cache.save_listing(simple_dataset)
+    local_cache.get_listing(simple_dataset.Name)
+    os.unlink(f'{local_cache._loc}/cache/{simple_dataset.Name}.pickle')
+    assert None is local_cache.get_listing(simple_dataset.Name)
+
+def test_ds_listing_memory_limit_entries(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, listing_cache_entries=2)
+    for i in range(3):
+        cache.save_listing(dataset_listing_info(f'ds{i}', []))
+        cache.get_listing(f'ds{i}')
+    assert 2 == cache.listing_cache_stats().entries
+    cache.get_listing('ds0')
+    assert 0 == cache.listing_cache_stats().hits
+
+def test_ds_listing_memory_limit_bytes(local_cache, simple_dataset):
+    cache = dataset_local_cache(location=local_cache._loc, listing_cache_bytes=10)
+    cache.save_listing(simple_dataset)
+    cache.get_listing(simple_dataset.Name)
+    assert 0 == cache.listing_cache_stats().entries
+
+def test_ds_listing_memory_off(local_cache, simple_dataset):
+    cache = dataset_local_cache(location=local_cache._loc, listing_cache_entries=0)
+    cache.save_listing(simple_dataset)
+    assert cache.get_listing(simple_dataset.Name) is not cache.get_listing(simple_dataset.Name)
+    assert 0 == cache.listing_cache_stats().hits
+
+def make_downloaded_ds(cache: dataset_local_cache, name: str, size: int, last_access: float = None):
+    'Create a completely downloaded dataset with a single file of `size` bytes'
+    d = cache.get_ds_directory(name)
+    os.mkdir(d)
+    with open(f'{d}/f1.root', 'w') as f:
+        f.write('h' * size)
+    cache.mark_dataset_done(name)
+    if last_access is not None:
+        os.utime(f'{cache._loc}/done_downloading/{name}.txt', (last_access, last_access))
+
+def test_mark_done_no_stray_directory(local_cache, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    local_cache.mark_dataset_done('dataset1')
+    assert [] == os.listdir(str(tmp_path))
+
+def test_ds_usage(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    local_cache.save_listing(dataset_listing_info('ds2', []))
+    usage = local_cache.get_dataset_usage()
+    assert 1 == len(usage)
+    assert 'ds1' == usage[0].name
+    assert 100 == usage[0].size
+    assert usage[0].last_access is not None
+    assert 100 == local_cache.get_cache_size()
+
+def test_ds_usage_updated_on_access(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100, last_access=1000)
+    local_cache.get_ds_contents('ds1')
+    assert local_cache.get_dataset_usage()[0].last_access > 1000
+
+def test_make_room_no_quota(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    assert local_cache.make_room(10**12)
+    assert local_cache.get_ds_contents('ds1') is not None
+
+def test_make_room_lru(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=250)
+    make_downloaded_ds(cache, 'ds1', 100, last_access=2000)
+    make_downloaded_ds(cache, 'ds2', 100, last_access=1000)
+    lines = []
+    assert cache.make_room(100, log_func=lambda l: lines.append(l))
+    assert cache.get_ds_contents('ds2') is None
+    assert not os.path.exists(cache.get_ds_directory('ds2'))
+    assert cache.get_ds_contents('ds1') is not None
+    assert 1 == len(lines)
+
+def test_make_room_fits(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=250)
+    make_downloaded_ds(cache, 'ds1', 100)
+    assert cache.make_room(150)
+    assert cache.get_ds_contents('ds1') is not None
+
+def test_make_room_size_weighted(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=1000, eviction_policy=EvictionPolicy.lru_size_weighted)
+    now = os.stat(local_cache._loc).st_mtime
+    make_downloaded_ds(cache, 'small_old', 10, last_access=now - 200)
+    make_downloaded_ds(cache, 'big_new', 900, last_access=now - 100)
+    assert cache.make_room(100)
+    assert cache.get_ds_contents('small_old') is not None
+    assert cache.get_ds_contents('big_new') is None
+
+def test_make_room_keep(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=150)
+    make_downloaded_ds(cache, 'ds1', 100)
+    assert not cache.make_room(100, keep=['ds1'])
+    assert cache.get_ds_contents('ds1') is not None
+
+def test_make_room_skips_locked(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=150)
+    make_downloaded_ds(cache, 'ds1', 100)
+    with cache.get_dataset_downloading_lock('ds1'):
+        assert not cache.make_room(100)
+    assert cache.get_ds_contents('ds1') is not None
+
+def test_make_room_too_big(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=150)
+    make_downloaded_ds(cache, 'ds1', 100)
+    assert not cache.make_room(200)
+    assert cache.get_ds_contents('ds1') is not None
+
+def test_make_room_partial_first(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=250)
+    make_downloaded_ds(cache, 'ds1', 100, last_access=1000)
+    os.mkdir(cache.get_ds_directory('ds2'))
+    with open(cache.get_ds_directory('ds2') + '/f1.root.part', 'w') as f:
+        f.write('h' * 100)
+    assert cache.make_room(100)
+    assert cache.get_ds_contents('ds1') is not None
+    assert not os.path.exists(cache.get_ds_directory('ds2'))
+
+def test_pin_prevents_eviction(local_cache):
+    cache = dataset_local_cache(location=local_cache._loc, quota_bytes=150)
+    make_downloaded_ds(cache, 'ds1', 100)
+    with cache.get_pinned_ds_contents('ds1') as pin:
+        assert ['ds1/f1.root'] == pin.files
+        assert cache.is_pinned('ds1')
+        assert not cache.make_room(100)
+        assert cache.get_ds_contents('ds1') is not None
+    assert pin.released
+    assert not cache.is_pinned('ds1')
+    assert cache.make_room(100)
+    assert cache.get_ds_contents('ds1') is None
+
+def test_pin_eviction_keeps_last_access(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100, last_access=1000)
+    with local_cache.pin_dataset('ds1'):
+        assert not local_cache.evict_dataset('ds1')
+    assert 1000 == local_cache.get_dataset_usage()[0].last_access
+
+def test_pin_not_downloaded(local_cache):
+    assert None is local_cache.get_pinned_ds_contents('ds1')
+    assert not local_cache.is_pinned('ds1')
+
+def test_pin_expired(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    pin = local_cache.pin_dataset('ds1', lease=datetime.timedelta(seconds=-1))
+    assert not local_cache.is_pinned('ds1')
+    assert pin.released
+    assert local_cache.evict_dataset('ds1')
+
+def test_pin_renew(local_cache):
+    pin = local_cache.pin_dataset('ds1', lease=datetime.timedelta(seconds=-1))
+    pin.renew(datetime.timedelta(hours=1))
+    assert local_cache.is_pinned('ds1')
+    pin.release()
+    pin.release()
+
+def test_pin_dead_process(local_cache):
+    'A pin left by a process on this host that has died does not count'
+    p = subprocess.Popen(['true'])
+    p.wait()
+    pin = local_cache.pin_dataset('ds1')
+    with open(pin._pin_file) as f:
+        expires, host, _ = f.read().split()
+    with open(pin._pin_file, 'w') as f:
+        f.write(f'{expires} {host} {p.pid}\n')
+    assert not local_cache.is_pinned('ds1')
+
+def test_pin_other_host(local_cache):
+    'Can not tell if a process on another host is alive, so believe the lease'
+    pin = local_cache.pin_dataset('ds1')
+    with open(pin._pin_file) as f:
+        expires, _, pid = f.read().split()
+    with open(pin._pin_file, 'w') as f:
+        f.write(f'{expires} some-other-host {pid}\n')
+    assert local_cache.is_pinned('ds1')
+
+def test_pin_not_counted_as_dataset(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    with local_cache.pin_dataset('ds1'):
+        assert ['ds1'] == [u.name for u in local_cache.get_dataset_usage()]
+
+@pytest.fixture()
+def store_cache(local_cache):
+    return dataset_local_cache(location=local_cache._loc, file_store=True)
+
+def write_ds_file(cache: dataset_local_cache, ds_name: str, f_name: str, size: int = 100):
+    d = cache.get_ds_directory(ds_name)
+    os.makedirs(d, exist_ok=True)
+    with open(f'{d}/{f_name}', 'w') as f:
+        f.write('h' * size)
+
+def test_store_off(local_cache):
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(local_cache, 'ds1', 'f1.root')
+    local_cache.add_to_store('ds1', files)
+    assert [] == local_cache.link_from_store('ds2', files)
+    assert not os.path.exists(f'{local_cache._loc}/store')
+
+def test_store_shared_file(store_cache):
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(store_cache, 'ds1', 'f1.root')
+    store_cache.add_to_store('ds1', files)
+    assert os.path.exists(f'{store_cache._loc}/store/scope/f1.root')
+
+    assert files == store_cache.link_from_store('ds2', files + [RucioFile('scope:f2.root', 100, 1)])
+    assert [] == store_cache.get_missing_files('ds2', files)
+    assert os.path.samefile(store_cache.get_ds_directory('ds1') + '/f1.root', store_cache.get_ds_directory('ds2') + '/f1.root')
+
+def test_store_size_mismatch(store_cache):
+    write_ds_file(store_cache, 'ds1', 'f1.root')
+    store_cache.add_to_store('ds1', [RucioFile('scope:f1.root', 100, 1)])
+    assert [] == store_cache.link_from_store('ds2', [RucioFile('scope:f1.root', 5000, 1)])
+
+def test_store_downloaded_twice(store_cache):
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(store_cache, 'ds1', 'f1.root')
+    write_ds_file(store_cache, 'ds2', 'f1.root')
+    store_cache.add_to_store('ds1', files)
+    store_cache.add_to_store('ds2', files)
+    assert os.path.samefile(store_cache.get_ds_directory('ds1') + '/f1.root', store_cache.get_ds_directory('ds2') + '/f1.root')
+    assert 100 == store_cache.get_cache_size()
+
+def test_store_usage_and_gc(store_cache):
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(store_cache, 'ds1', 'f1.root')
+    store_cache.add_to_store('ds1', files)
+    store_cache.mark_dataset_done('ds1')
+    store_cache.link_from_store('ds2', files)
+    store_cache.mark_dataset_done('ds2')
+
+    # Removing either dataset frees nothing
+    assert [0, 0] == [u.size for u in store_cache.get_dataset_usage()]
+    assert 0 == store_cache.gc_store()
+
+    assert store_cache.evict_dataset('ds1')
+    assert [100] == [u.size for u in store_cache.get_dataset_usage()]
+    assert 0 == store_cache.gc_store()
+    assert store_cache.evict_dataset('ds2')
+    assert 100 == store_cache.gc_store()
+    assert 0 == store_cache.get_cache_size()
+
+def test_store_symlink_fallback(store_cache, monkeypatch):
+    def no_links(src, dest):
+        raise OSError('no hard links here')
+    monkeypatch.setattr(os, 'link', no_links)
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(store_cache, 'ds1', 'f1.root')
+    store_cache.add_to_store('ds1', files)
+    assert os.path.islink(store_cache.get_ds_directory('ds1') + '/f1.root')
+    store_cache.link_from_store('ds2', files)
+    assert [] == store_cache.get_missing_files('ds2', files)
+
+    assert 0 == store_cache.gc_store()
+    store_cache.evict_dataset('ds1')
+    store_cache.evict_dataset('ds2')
+    assert 100 == store_cache.gc_store()
+
+def test_sharded_new_cache(local_cache, simple_dataset):
+    cache = dataset_local_cache(location=local_cache._loc, sharded=True)
+    cache.save_listing(simple_dataset)
+    cache.mark_dataset_done(simple_dataset.Name)
+    assert os.path.exists(f'{local_cache._loc}/layout_version')
+    assert not os.path.exists(f'{local_cache._loc}/cache/{simple_dataset.Name}.pickle')
+    assert not os.path.exists(f'{local_cache._loc}/done_downloading/{simple_dataset.Name}.txt')
+    assert 1 == len([f for _, _, files in os.walk(f'{local_cache._loc}/cache') for f in files])
+
+    # Re-opened without asking, it stays sharded
+    other = dataset_local_cache(location=local_cache._loc, listing_cache_entries=0)
+    assert simple_dataset.FileList == other.get_listing(simple_dataset.Name).FileList
+    assert other._check_dataset_done(simple_dataset.Name)
+
+def test_flat_cache_still_flat(local_cache, simple_dataset):
+    local_cache.save_listing(simple_dataset)
+    assert os.path.exists(f'{local_cache._loc}/cache/{simple_dataset.Name}.pickle')
+    assert not os.path.exists(f'{local_cache._loc}/layout_version')
+
+def test_sharded_migrate(local_cache, simple_dataset):
+    create_ds(simple_dataset, local_cache)
+    local_cache.save_listing(simple_dataset)
+    os.utime(f'{local_cache._loc}/done_downloading/{simple_dataset.Name}.txt', (1000, 1000))
+
+    cache = dataset_local_cache(location=local_cache._loc, sharded=True)
+    assert not os.path.exists(f'{local_cache._loc}/cache/{simple_dataset.Name}.pickle')
+    assert not os.path.exists(f'{local_cache._loc}/done_downloading/{simple_dataset.Name}.txt')
+    assert simple_dataset.FileList == cache.get_listing(simple_dataset.Name).FileList
+    assert 1000 == cache.get_dataset_usage()[0].last_access
+    assert cache.get_ds_contents(simple_dataset.Name) is not None
+
+def test_sharded_migrate_seen_by_flat_user(local_cache, simple_dataset):
+    'A process that opened the cache flat follows a migration done by someone else'
+    create_ds(simple_dataset, local_cache)
+    local_cache.save_listing(simple_dataset)
+    assert 2 == dataset_local_cache(location=local_cache._loc).migrate_layout()
+
+    assert local_cache.get_ds_contents(simple_dataset.Name) is not None
+    assert local_cache._sharded
+    local_cache.save_listing(nonexistant_dataset_info())
+    assert not os.path.exists(f'{local_cache._loc}/cache/bogus.pickle')
+
+def nonexistant_dataset_info():
+    return dataset_listing_info('bogus', None)
+
+def test_sharded_reads_flat_leftovers(local_cache, simple_dataset):
+    'Something written flat after the migration (by an older process) is still found'
+    cache = dataset_local_cache(location=local_cache._loc, sharded=True)
+    create_ds(simple_dataset, local_cache)
+    assert cache.get_ds_contents(simple_dataset.Name) is not None
+
+def test_sharded_flat_pins(local_cache):
+    pin = local_cache.pin_dataset('ds1')
+    cache = dataset_local_cache(location=local_cache._loc, sharded=True)
+    assert cache.is_pinned('ds1')
+    pin.release()
+    assert not cache.is_pinned('ds1')
+    with cache.pin_dataset('ds1'):
+        assert cache.is_pinned('ds1')
+        assert [] == os.listdir(f'{local_cache._loc}/pins/ds1')
+
+def test_unknown_layout(local_cache):
+    with open(f'{local_cache._loc}/layout_version', 'w') as f:
+        f.write('99\n')
+    with pytest.raises(Exception):
+        dataset_local_cache(location=local_cache._loc)
+
+@pytest.fixture()
+def two_tier(tmp_path):
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+    local = dataset_local_cache(location=str(tmp_path / 'local'), shared=shared, lock_class=filelock.FileLock)
+    return local, shared
+
+def test_tier_listing_write_through(two_tier, simple_dataset):
+    local, shared = two_tier
+    local.save_listing(simple_dataset)
+    assert simple_dataset.FileList == shared.get_listing(simple_dataset.Name).FileList
+
+def test_tier_listing_read_through(two_tier, simple_dataset):
+    local, shared = two_tier
+    shared.save_listing(simple_dataset)
+    assert simple_dataset.FileList == local.get_listing(simple_dataset.Name).FileList
+    assert os.path.exists(f'{local._loc}/cache/{simple_dataset.Name}.pickle')
+
+def test_tier_fetch(two_tier):
+    local, shared = two_tier
+    files = [RucioFile('scope:f1.root', 100, 1), RucioFile('scope:f2.root', 100, 1), RucioFile('scope:f3.root', 200, 1)]
+    write_ds_file(shared, 'ds1', 'f1.root')
+    write_ds_file(shared, 'ds1', 'f3.root')
+    lines = []
+    assert files[0:1] == local.fetch_from_shared('ds1', files, log_func=lambda l: lines.append(l))
+    assert files[1:] == local.get_missing_files('ds1', files)
+    assert not os.path.islink(local.get_ds_directory('ds1') + '/f1.root')
+    assert 1 == len(lines)
+    assert not shared.is_pinned('ds1')
+
+def test_tier_fetch_link(tmp_path):
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+    local = dataset_local_cache(location=str(tmp_path / 'local'), shared=shared, link_shared_files=True)
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(shared, 'ds1', 'f1.root')
+    assert files == local.fetch_from_shared('ds1', files)
+    assert os.path.islink(local.get_ds_directory('ds1') + '/f1.root')
+
+def test_tier_fetch_link_keeps_shared_pinned(tmp_path):
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+    local = dataset_local_cache(location=str(tmp_path / 'local'), shared=shared, link_shared_files=True)
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(shared, 'ds1', 'f1.root')
+    local.fetch_from_shared('ds1', files)
+    assert shared.is_pinned('ds1')
+    assert not shared.evict_dataset('ds1')
+    assert os.path.exists(local.get_ds_directory('ds1') + '/f1.root')
+
+    assert local.evict_dataset('ds1')
+    assert not shared.is_pinned('ds1')
+    assert shared.evict_dataset('ds1')
+
+def test_tier_publish(two_tier):
+    local, shared = two_tier
+    files = [RucioFile('scope:f1.root', 100, 1), RucioFile('scope:f2.root', 100, 1)]
+    write_ds_file(local, 'ds1', 'f1.root')
+    write_ds_file(local, 'ds1', 'f2.root')
+    write_ds_file(shared, 'ds1', 'f1.root')
+    assert local.publish_to_shared('ds1', files)
+    assert ['ds1/f1.root', 'ds1/f2.root'] == sorted(shared.get_ds_contents('ds1'))
+
+def test_tier_publish_locked(two_tier):
+    local, shared = two_tier
+    files = [RucioFile('scope:f1.root', 100, 1)]
+    write_ds_file(local, 'ds1', 'f1.root')
+    with shared.get_dataset_downloading_lock('ds1'):
+        assert not local.publish_to_shared('ds1', files)
+    assert shared.get_ds_contents('ds1') is None
+
+def test_tier_publish_no_room(tmp_path):
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'), quota_bytes=50)
+    local = dataset_local_cache(location=str(tmp_path / 'local'), shared=shared)
+    write_ds_file(local, 'ds1', 'f1.root')
+    assert not local.publish_to_shared('ds1', [RucioFile('scope:f1.root', 100, 1)])
+
+def test_tier_none(local_cache):
+    assert [] == local_cache.fetch_from_shared('ds1', [RucioFile('scope:f1.root', 100, 1)])
+    assert not local_cache.publish_to_shared('ds1', [RucioFile('scope:f1.root', 100, 1)])
+
+def test_manifest_used(local_cache, monkeypatch):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    assert ['ds1/f1.root'] == local_cache.get_ds_contents('ds1')
+
+    def no_scan(d):
+        assert False, 'Directory should not be scanned'
+    monkeypatch.setattr(os, 'scandir', no_scan)
+    monkeypatch.setattr(os, 'listdir', no_scan)
+    assert ['ds1/f1.root'] == local_cache.get_ds_contents('ds1')
+
+def test_manifest_written_when_done(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    assert os.path.exists(f'{local_cache._loc}/manifest/ds1.pickle')
+
+def test_manifest_directory_changed(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    local_cache.get_ds_contents('ds1')
+    os.utime(local_cache.get_ds_directory('ds1'), ns=(0, 0))
+    write_ds_file(local_cache, 'ds1', 'f2.root')
+    assert ['ds1/f1.root', 'ds1/f2.root'] == sorted(local_cache.get_ds_contents('ds1'))
+
+def test_manifest_verify(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    local_cache.get_ds_contents('ds1')
+    d_stat = os.stat(local_cache.get_ds_directory('ds1'))
+    write_ds_file(local_cache, 'ds1', 'f1.root', size=10)
+    os.utime(local_cache.get_ds_directory('ds1'), ns=(d_stat.st_atime_ns, d_stat.st_mtime_ns))
+
+    local_cache.get_ds_contents('ds1', verify=True)
+    assert 10 == local_cache._read_manifest('ds1').files[0][1]
+
+def test_manifest_no_old_manifest(local_cache, simple_dataset):
+    'Datasets marked done before manifests existed'
+    create_ds(simple_dataset, local_cache)
+    assert len(simple_dataset.FileList) == len(local_cache.get_ds_contents(simple_dataset.Name))
+    assert os.path.exists(f'{local_cache._loc}/manifest/{simple_dataset.Name}.pickle')
+
+def test_manifest_evicted(local_cache):
+    make_downloaded_ds(local_cache, 'ds1', 100)
+    local_cache.evict_dataset('ds1')
+    assert not os.path.exists(f'{local_cache._loc}/manifest/ds1.pickle')
+    assert local_cache.get_ds_contents('ds1') is None
+
+def test_file_adler32(tmp_path):
+    import zlib
+    p = tmp_path / 'f.root'
+    data = b'hello world' * 1000
+    p.write_bytes(data)
+    assert '{0:08x}'.format(zlib.adler32(data)) == file_adler32(str(p))
+    assert '{0:08x}'.format(zlib.adler32(data)) == file_adler32(str(p), chunk_size=7)
+
+def test_file_adler32_empty(tmp_path):
+    p = tmp_path / 'f.root'
+    p.write_bytes(b'')
+    assert '00000001' == file_adler32(str(p))
+
+@pytest.fixture()
+def verify_ds(local_cache):
+    'A downloaded dataset with two files whose checksums are right'
+    files = []
+    for i in range(2):
+        write_ds_file(local_cache, 'ds1', f'f{i}.root')
+        files.append(RucioFile(f'scope:f{i}.root', 100, 1, file_adler32(f'{local_cache.get_ds_directory("ds1")}/f{i}.root')))
+    local_cache.save_listing(dataset_listing_info('ds1', files))
+    local_cache.mark_dataset_done('ds1')
+    return files
+
+def test_verify_good(local_cache, verify_ds):
+    assert local_cache.verify_dataset('ds1').ok
+    assert local_cache.verify_dataset('ds1', checksums=True).ok
+    assert local_cache.get_ds_contents('ds1') is not None
+
+def test_verify_missing(local_cache, verify_ds):
+    os.unlink(f'{local_cache.get_ds_directory("ds1")}/f0.root')
+    lines = []
+    r = local_cache.verify_dataset('ds1', repair=True, log_func=lambda l: lines.append(l))
+    assert [verify_ds[0]] == r.missing
+    assert not r.ok
+    assert 1 == len(lines)
+    assert local_cache.get_ds_contents('ds1') is None
+    assert [verify_ds[0]] == local_cache.get_missing_files('ds1', verify_ds)
+
+def test_verify_wrong_size(local_cache, verify_ds):
+    write_ds_file(local_cache, 'ds1', 'f1.root', size=10)
+    r = local_cache.verify_dataset('ds1', repair=True, exact_sizes=True)
+    assert [verify_ds[1]] == r.wrong_size
+    assert local_cache.get_ds_contents('ds1') is None
+    assert [verify_ds[1]] == local_cache.get_missing_files('ds1', verify_ds)
+
+def test_verify_wrong_size_rounded(local_cache, verify_ds):
+    'Listed sizes are rounded, so the size alone is not enough to throw a file away'
+    write_ds_file(local_cache, 'ds1', 'f1.root', size=10)
+    r = local_cache.verify_dataset('ds1', repair=True)
+    assert [verify_ds[1]] == r.wrong_size
+    assert local_cache.get_ds_contents('ds1') is not None
+    assert os.path.exists(f'{local_cache.get_ds_directory("ds1")}/f1.root')
+
+    r = local_cache.verify_dataset('ds1', checksums=True, repair=True)
+    assert [verify_ds[1]] == r.wrong_checksum
+    assert local_cache.get_ds_contents('ds1') is None
+    assert [verify_ds[1]] == local_cache.get_missing_files('ds1', verify_ds)
+
+def test_verify_exact_size(local_cache, verify_ds):
+    write_ds_file(local_cache, 'ds1', 'f1.root', size=101)
+    assert local_cache.verify_dataset('ds1').ok
+    assert [verify_ds[1]] == local_cache.verify_dataset('ds1', exact_sizes=True).wrong_size
+
+def test_verify_no_repair_by_default(local_cache, verify_ds):
+    os.unlink(f'{local_cache.get_ds_directory("ds1")}/f0.root')
+    assert not local_cache.verify_dataset('ds1').ok
+    assert local_cache.get_ds_contents('ds1') is not None
+
+def test_verify_checksum(local_cache, verify_ds):
+    write_ds_file(local_cache, 'ds1', 'f1.root')
+    with open(f'{local_cache.get_ds_directory("ds1")}/f1.root', 'w') as f:
+        f.write('x' * 100)
+    assert local_cache.verify_dataset('ds1').ok
+    r = local_cache.verify_dataset('ds1', checksums=True, repair=True)
+    assert [verify_ds[1]] == r.wrong_checksum
+    assert local_cache.get_ds_contents('ds1') is None
+    assert [verify_ds[1]] == local_cache.get_missing_files('ds1', verify_ds)
+
+def test_verify_no_repair(local_cache, verify_ds):
+    os.unlink(f'{local_cache.get_ds_directory("ds1")}/f0.root')
+    assert not local_cache.verify_dataset('ds1', repair=False).ok
+    assert local_cache.get_ds_contents('ds1') is not None
+
+def test_verify_locked(local_cache, verify_ds):
+    write_ds_file(local_cache, 'ds1', 'f1.root', size=10)
+    with local_cache.get_dataset_downloading_lock('ds1'):
+        assert not local_cache.verify_dataset('ds1', repair=True, exact_sizes=True).ok
+    assert local_cache.get_ds_contents('ds1') is not None
+
+def test_verify_no_listing(local_cache):
+    with pytest.raises(Exception):
+        local_cache.verify_dataset('ds1')
+
+def dead_pid():
+    'A pid of a process that has finished'
+    p = subprocess.Popen(['true'])
+    p.wait()
+    return p.pid
+
+def write_lock_file(cache, name, pid, host=None):
+    lock = cache.get_dataset_downloading_lock(name)
+    os.makedirs(os.path.dirname(lock.lock_file), exist_ok=True)
+    with open(lock.lock_file, 'w') as f:
+        f.write(f'{pid}\n{host if host is not None else socket.gethostname()}\n')
+    return lock.lock_file
+
+def test_lock_records_holder(local_cache):
+    with local_cache.get_dataset_downloading_lock('ds1') as lock:
+        with open(lock.lock_file) as f:
+            pid, host = f.read().split('\n')[0:2]
+        assert os.getpid() == int(pid)
+        assert socket.gethostname() == host
+
+def test_lock_stale_reclaimed(local_cache):
+    lock_file = write_lock_file(local_cache, 'ds1', dead_pid())
+    with local_cache.get_dataset_downloading_lock('ds1'):
+        with open(lock_file) as f:
+            assert os.getpid() == int(f.read().split('\n')[0])
+    assert not os.path.exists(lock_file)
+
+def test_lock_live_not_reclaimed(local_cache):
+    write_lock_file(local_cache, 'ds1', os.getpid())
+    with pytest.raises(filelock.Timeout):
+        with local_cache.get_dataset_downloading_lock('ds1'):
+            pass
+
+def test_lock_other_host_not_reclaimed(local_cache):
+    write_lock_file(local_cache, 'ds1', dead_pid(), host='some-other-host')
+    with pytest.raises(filelock.Timeout):
+        with local_cache.get_dataset_downloading_lock('ds1'):
+            pass
+
+def test_lock_unreadable_not_reclaimed(local_cache):
+    lock_file = write_lock_file(local_cache, 'ds1', dead_pid())
+    with open(lock_file, 'w') as f:
+        f.write('')
+    with pytest.raises(filelock.Timeout):
+        with local_cache.get_dataset_downloading_lock('ds1'):
+            pass
+
+def test_lock_reclaim_race_restores_live_lock(local_cache, monkeypatch):
+    'Someone reclaims the lock and takes it between our check and our rename: their lock must survive'
+    import ruciopylib.dataset_local_cache as dlc
+    lock_file = write_lock_file(local_cache, 'ds1', os.getpid())
+    answers = [True, False]
+    monkeypatch.setattr(dlc, '_lock_holder_is_dead', lambda f: answers.pop(0))
+    assert not dlc._reclaim_stale_lock(lock_file)
+    with open(lock_file) as f:
+        assert os.getpid() == int(f.read().split('\n')[0])
+    assert [] == [f for f in os.listdir(os.path.dirname(lock_file)) if f.endswith('.reclaim')]
+
+def test_wait_for_lock_free(local_cache):
+    assert local_cache.wait_for_download_lock('ds1', timeout=0)
+
+def test_wait_for_lock_timeout(local_cache):
+    with local_cache.get_dataset_downloading_lock('ds1'):
+        assert not local_cache.wait_for_download_lock('ds1', timeout=0.1)
+
+def test_wait_for_lock_stale(local_cache):
+    write_lock_file(local_cache, 'ds1', dead_pid())
+    assert local_cache.wait_for_download_lock('ds1', timeout=0)
+
+def hold_lock(cache, name, delay=0.1):
+    'Hold the download lock on another thread for a while'
+    locked = threading.Event()
+    def hold():
+        with cache.get_dataset_downloading_lock(name):
+            locked.set()
+            time.sleep(delay)
+    t = threading.Thread(target=hold)
+    t.start()
+    assert locked.wait(5)
+    return t
+
+def test_wait_for_lock_released(local_cache):
+    t = hold_lock(local_cache, 'ds1')
+    start = time.monotonic()
+    assert local_cache.wait_for_download_lock('ds1', timeout=5)
+    assert time.monotonic() - start < 2.5
+    t.join()
+
+def test_wait_for_lock_released_filelock(tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path), lock_class=filelock.FileLock)
+    t = hold_lock(cache, 'ds1')
+    assert cache.wait_for_download_lock('ds1', timeout=5)
+    t.join()
+    with cache.get_dataset_downloading_lock('ds1'):
+        pass
+
+def test_mark_empty_dataset_done(local_cache):
+    local_cache.mark_dataset_done('empty')
+    assert [] == local_cache.get_ds_contents('empty')
+    with local_cache.get_pinned_ds_contents('empty') as pin:
+        assert [] == pin.files
+
+def test_empty_dataset_marked_without_directory(local_cache):
+    'Empty datasets marked done before the directory was made for them'
+    local_cache.save_listing(dataset_listing_info('empty', []))
+    local_cache.mark_dataset_done('empty')
+    os.rmdir(local_cache.get_ds_directory('empty'))
+    assert [] == local_cache.get_ds_contents('empty')
+
+def test_dataset_directory_removed(local_cache, simple_dataset):
+    'Someone removed the directory of a downloaded dataset'
+    local_cache.save_listing(simple_dataset)
+    write_ds_file(local_cache, simple_dataset.Name, 'f1.root')
+    local_cache.mark_dataset_done(simple_dataset.Name)
+    shutil.rmtree(local_cache.get_ds_directory(simple_dataset.Name))
+    assert local_cache.get_ds_contents(simple_dataset.Name) is None
+    assert not os.path.exists(f'{local_cache._loc}/done_downloading/{simple_dataset.Name}.txt')
@@ -0,0 +1,126 @@
+# Tests for the compact file table
+from ruciopylib.file_table import rucio_file_table
+from ruciopylib.dataset_local_cache import dataset_listing_info
+from ruciopylib.rucio import RucioFile
+from array import array
+import pickle
+import pytest
+
+@pytest.fixture()
+def files():
+    return [RucioFile('scope:f{0}.root'.format(i), 100 * i, i) for i in range(10)]
+
+def test_empty():
+    t = rucio_file_table([])
+    assert 0 == len(t)
+    assert [] == list(t)
+    assert 0 == t.total_size
+    assert t == []
+
+def test_sequence(files):
+    t = rucio_file_table(files)
+    assert 10 == len(t)
+    assert files == list(t)
+    assert files[3] == t[3]
+    assert files[-1] == t[-1]
+    assert files[2:5] == t[2:5]
+    assert files[3] in t
+    assert 3 == t.index(files[3])
+    assert t == files
+    assert t != files[1:]
+
+def test_out_of_range(files):
+    t = rucio_file_table(files)
+    with pytest.raises(IndexError):
+        t[10]
+
+def test_namedtuple_access(files):
+    t = rucio_file_table(files)
+    assert 'scope:f3.root' == t[3].filename
+    assert 300 == t[3].size
+    assert 3 == t[3].events
+
+def test_totals(files):
+    t = rucio_file_table(files)
+    assert sum(f.size for f in files) == t.total_size
+    assert sum(f.events for f in files) == t.total_events
+    assert [f.size for f in files] == list(t.sizes)
+    assert [f.events for f in files] == list(t.events)
+
+def test_pickle(files):
+    t = pickle.loads(pickle.dumps(rucio_file_table(files)))
+    assert files == list(t)
+    assert sum(f.size for f in files) == t.total_size
+
+def test_pickle_large():
+    files = [RucioFile('mc16_13TeV:DAOD_EXOT15.17545540._{0:06}.pool.root.1'.format(i), 2000000000 + i, 10000) for i in range(10000)]
+    t = pickle.loads(pickle.dumps(rucio_file_table(files)))
+    assert files[9999] == t[9999]
+    assert sum(f.size for f in files) == t.total_size
+
+def test_listing_uses_table(files):
+    l = dataset_listing_info('ds', files)
+    assert isinstance(l.FileList, rucio_file_table)
+    assert None is dataset_listing_info('ds', None).FileList
+
+def test_old_listing_pickle(files):
+    'Listings pickled before the table existed have a plain list'
+    old = dataset_listing_info.__new__(dataset_listing_info)
+    old.__dict__.update({'Name': 'ds', 'Created': None, 'FileList': files})
+    l = pickle.loads(pickle.dumps(old))
+    assert isinstance(l.FileList, rucio_file_table)
+    assert files == list(l.FileList)
+
+def test_adler32():
+    files = [RucioFile('scope:f1.root', 100, 1, 'c14ee390'), RucioFile('scope:f2.root', 100, 1)]
+    t = pickle.loads(pickle.dumps(rucio_file_table(files)))
+    assert 'c14ee390' == t[0].adler32
+    assert None is t[1].adler32
+    assert files == list(t)
+
+def test_no_adler32_pickle(files):
+    'Tables pickled before checksums were kept'
+    t = rucio_file_table(files)
+    state = t.__getstate__()
+    del state['adler32_u32']
+    del state['adler32_known']
+    t_old = rucio_file_table.__new__(rucio_file_table)
+    t_old.__setstate__(state)
+    assert files == list(t_old)
+
+def test_adler32_all_bits():
+    files = [RucioFile('scope:f1.root', 100, 1, 'ffffffff'), RucioFile('scope:f2.root', 100, 1, '00000000')]
+    t = pickle.loads(pickle.dumps(rucio_file_table(files)))
+    assert files == list(t)
+
+def test_adler32_64bit_pickle():
+    'Tables pickled when the checksums were kept as 64 bit numbers, with -1 for unknown'
+    files = [RucioFile('scope:f1.root', 100, 1, 'c14ee390'), RucioFile('scope:f2.root', 100, 1)]
+    state = rucio_file_table(files).__getstate__()
+    del state['adler32_u32']
+    del state['adler32_known']
+    state['adler32'] = array('q', [0xc14ee390, -1]).tobytes()
+    t_old = rucio_file_table.__new__(rucio_file_table)
+    t_old.__setstate__(state)
+    assert files == list(t_old)
+
+def test_guid():
+    files = [RucioFile('scope:f1.root', 100, 1, 'c14ee390', '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4'),
+             RucioFile('scope:f2.root', 100, 1, None, '46459733-8A1D-EA42-B037-D464BE3809AD'),
+             RucioFile('scope:f3.root', 100, 1)]
+    t = pickle.loads(pickle.dumps(rucio_file_table(files)))
+    assert files == list(t)
+    assert files[1] == t[1]
+    assert None is t[2].guid
+    assert files[1] == t.find_guid('46459733-8a1d-ea42-b037-d464be3809ad')
+    assert None is t.find_guid('7603A2A9-9A29-2F49-812C-CE3BE602B88F')
+    assert files[1] == t.find_guid(' 464597338a1dea42b037d464be3809ad ')
+    assert None is t.find_guid('not-a-guid')
+
+def test_no_guid_pickle(files):
+    'Tables pickled before GUIDs were kept'
+    state = rucio_file_table(files).__getstate__()
+    del state['guids']
+    t_old = rucio_file_table.__new__(rucio_file_table)
+    t_old.__setstate__(state)
+    assert files == list(t_old)
@@ -0,0 +1,57 @@
+# Tests for waiting on changes to files in a directory
+from ruciopylib.file_watch import directory_watch
+import os
+import threading
+import time
+import pytest
+
+def remove_later(path, delay=0.1):
+    t = threading.Timer(delay, lambda: os.unlink(path))
+    t.start()
+    return t
+
+def test_poll_times_out(tmp_path):
+    with directory_watch(str(tmp_path), use_inotify=False) as w:
+        assert not w.using_inotify
+        start = time.monotonic()
+        assert not w.wait(0.1)
+        assert time.monotonic() - start < 1.0
+
+def test_poll_backs_off(tmp_path):
+    with directory_watch(str(tmp_path), min_interval=0.01, max_interval=0.04, use_inotify=False) as w:
+        w.wait()
+        w.wait()
+        w.wait()
+        assert 0.04 == w._interval
+
+def test_inotify_sees_delete(tmp_path):
+    f = tmp_path / 'a.lock'
+    f.write_text('hi')
+    with directory_watch(str(tmp_path), names=['a.lock'], max_interval=10) as w:
+        if not w.using_inotify:
+            pytest.skip('inotify is not available')
+        t = remove_later(str(f))
+        start = time.monotonic()
+        assert w.wait(5)
+        assert time.monotonic() - start < 2.0
+        t.join()
+
+def test_inotify_ignores_other_files(tmp_path):
+    f = tmp_path / 'b.lock'
+    f.write_text('hi')
+    with directory_watch(str(tmp_path), names=['a.lock'], max_interval=10) as w:
+        if not w.using_inotify:
+            pytest.skip('inotify is not available')
+        t = remove_later(str(f), delay=0.01)
+        assert not w.wait(0.3)
+        t.join()
+
+def test_inotify_wakes_to_recheck(tmp_path):
+    with directory_watch(str(tmp_path), max_interval=0.1) as w:
+        start = time.monotonic()
+        assert not w.wait()
+        assert time.monotonic() - start < 1.0
+
+def test_missing_directory_polls(tmp_path):
+    with directory_watch(str(tmp_path / 'not-there')) as w:
+        assert not w.using_inotify
@@ -0,0 +1,155 @@
+# Tests for the SQLite listing catalog
+from ruciopylib.listing_catalog import sqlite_listing_catalog
+from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info
+from ruciopylib.rucio import RucioFile
+from tests.utils_for_tests import simple_dataset, nonexistant_dataset, empty_dataset
+from datetime import datetime, timedelta
+import threading
+import pytest
+import os
+
+@pytest.fixture()
+def catalog(tmp_path):
+    return sqlite_listing_catalog(str(tmp_path / 'listings.sqlite'))
+
+def test_roundtrip(catalog, simple_dataset):
+    catalog.save_listing(simple_dataset)
+    ds_back = catalog.get_listing(simple_dataset.Name)
+    assert simple_dataset.Name == ds_back.Name
+    assert list(simple_dataset.FileList) == list(ds_back.FileList)
+    assert abs((simple_dataset.Created - ds_back.Created).total_seconds()) < 0.001
+
+def test_miss(catalog):
+    assert None is catalog.get_listing('bogus')
+
+def test_does_not_exist(catalog, nonexistant_dataset):
+    catalog.save_listing(nonexistant_dataset)
+    assert None is catalog.get_listing(nonexistant_dataset.Name).FileList
+
+def test_empty(catalog, empty_dataset):
+    catalog.save_listing(empty_dataset)
+    assert 0 == len(catalog.get_listing(empty_dataset.Name).FileList)
+
+def test_replace(catalog, simple_dataset, nonexistant_dataset):
+    catalog.save_listing(nonexistant_dataset)
+    g1 = catalog.get_generation(simple_dataset.Name)
+    catalog.save_listing(simple_dataset)
+    assert 2 == len(catalog.get_listing(simple_dataset.Name).FileList)
+    assert g1 != catalog.get_generation(simple_dataset.Name)
+    assert None is catalog.get_generation('bogus')
+
+def test_stale(catalog):
+    catalog.save_listing(dataset_listing_info('old', [], created_time=datetime.now() - timedelta(days=2)))
+    catalog.save_listing(dataset_listing_info('new', []))
+    assert ['old'] == catalog.get_stale_listings(timedelta(days=1))
+    assert ['new', 'old'] == catalog.get_listing_names()
+
+def test_total_size_and_find(catalog, simple_dataset):
+    catalog.save_listing(simple_dataset)
+    catalog.save_listing(dataset_listing_info('dataset2', [RucioFile('f1.root', 100, 1)]))
+    assert 400 == catalog.total_size()
+    assert ['dataset1', 'dataset2'] == catalog.find_file('f1.root')
+
+def test_remove(catalog, simple_dataset):
+    catalog.save_listing(simple_dataset)
+    catalog.remove_listing(simple_dataset.Name)
+    assert None is catalog.get_listing(simple_dataset.Name)
+    assert 0 == catalog.total_size()
+
+def test_remove_then_save_new_generation(catalog, simple_dataset):
+    catalog.save_listing(simple_dataset)
+    g1 = catalog.get_generation(simple_dataset.Name)
+    catalog.remove_listing(simple_dataset.Name)
+    catalog.save_listing(simple_dataset)
+    assert g1 != catalog.get_generation(simple_dataset.Name)
+
+def test_two_catalogs_same_file(tmp_path, simple_dataset):
+    c1 = sqlite_listing_catalog(str(tmp_path / 'listings.sqlite'))
+    c2 = sqlite_listing_catalog(str(tmp_path / 'listings.sqlite'))
+    c1.save_listing(simple_dataset)
+    assert 2 == len(c2.get_listing(simple_dataset.Name).FileList)
+
+def test_threads(catalog, simple_dataset):
+    catalog.save_listing(simple_dataset)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(catalog.get_listing(simple_dataset.Name))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert 5 == len([r for r in results if r is not None])
+
+def test_cache_uses_catalog(tmp_path, catalog, simple_dataset):
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    cache.save_listing(simple_dataset)
+    assert 2 == len(catalog.get_listing(simple_dataset.Name).FileList)
+    assert 2 == len(cache.get_listing(simple_dataset.Name).FileList)
+    assert not os.path.exists(str(tmp_path / 'cache' / 'cache' / 'dataset1.pickle'))
+
+def test_cache_reads_old_pickles(tmp_path, catalog, simple_dataset):
+    dataset_local_cache(location=str(tmp_path / 'cache')).save_listing(simple_dataset)
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    assert 2 == len(cache.get_listing(simple_dataset.Name).FileList)
+    assert 2 == len(catalog.get_listing(simple_dataset.Name).FileList)
+
+def test_cache_migrate(tmp_path, catalog, simple_dataset, empty_dataset):
+    old_cache = dataset_local_cache(location=str(tmp_path / 'cache'))
+    old_cache.save_listing(simple_dataset)
+    old_cache.save_listing(dataset_listing_info('dataset2', None))
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    assert 2 == cache.migrate_listings_to_catalog(remove_pickles=True)
+    assert ['dataset1', 'dataset2'] == catalog.get_listing_names()
+    assert 0 == len(os.listdir(str(tmp_path / 'cache' / 'cache')))
+
+def test_cache_migrate_keeps_newer(tmp_path, catalog, simple_dataset):
+    dataset_local_cache(location=str(tmp_path / 'cache')).save_listing(dataset_listing_info('dataset1', None, created_time=datetime.now() - timedelta(days=1)))
+    catalog.save_listing(simple_dataset)
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    assert 0 == cache.migrate_listings_to_catalog()
+    assert 2 == len(catalog.get_listing('dataset1').FileList)
+
+def test_cache_memory_with_catalog(tmp_path, catalog, simple_dataset, nonexistant_dataset):
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    cache.save_listing(simple_dataset)
+    l1 = cache.get_listing(simple_dataset.Name)
+    assert l1 is cache.get_listing(simple_dataset.Name)
+    assert 1 == cache.listing_cache_stats().hits
+
+    # Someone else updates the catalog
+    sqlite_listing_catalog(str(tmp_path / 'listings.sqlite')).save_listing(nonexistant_dataset)
+    assert None is cache.get_listing(simple_dataset.Name).FileList
+
+def test_cache_memory_after_remove(tmp_path, catalog):
+    'A listing removed and saved again by someone else is not served from memory'
+    cache = dataset_local_cache(location=str(tmp_path / 'cache'), listing_catalog=catalog)
+    cache.save_listing(dataset_listing_info('ds', [RucioFile('scope:a.root', 100, 1)]))
+    assert 'scope:a.root' == cache.get_listing('ds').FileList[0].filename
+
+    other = sqlite_listing_catalog(str(tmp_path / 'listings.sqlite'))
+    other.remove_listing('ds')
+    other.save_listing(dataset_listing_info('ds', [RucioFile('scope:b.root', 100, 1)]))
+    assert 'scope:b.root' == cache.get_listing('ds').FileList[0].filename
+
+def test_adler32(catalog):
+    files = [RucioFile('scope:f1.root', 100, 1, 'c14ee390'), RucioFile('scope:f2.root', 100, 1)]
+    catalog.save_listing(dataset_listing_info('ds1', files))
+    assert files == list(catalog.get_listing('ds1').FileList)
+
+def test_old_catalog(tmp_path, simple_dataset):
+    'A catalog made before checksums were kept gets the new column'
+    import sqlite3
+    db = str(tmp_path / 'listings.sqlite')
+    c = sqlite3.connect(db)
+    c.execute('CREATE TABLE files (dataset TEXT NOT NULL, idx INTEGER NOT NULL, filename TEXT NOT NULL, size INTEGER NOT NULL, events INTEGER NOT NULL, PRIMARY KEY (dataset, idx))')
+    c.commit()
+    c.close()
+    catalog = sqlite_listing_catalog(db)
+    catalog.save_listing(simple_dataset)
+    assert list(simple_dataset.FileList) == list(catalog.get_listing(simple_dataset.Name).FileList)
+
+def test_guid(catalog):
+    files = [RucioFile('scope:f1.root', 100, 1, 'c14ee390', '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4'), RucioFile('scope:f2.root', 100, 1)]
+    catalog.save_listing(dataset_listing_info('ds1', files))
+    assert files == list(catalog.get_listing('ds1').FileList)
+    assert ['ds1'] == catalog.find_guid('1dcbecfa-edc0-5840-a25a-8277ca9a31d4')
+    assert [] == catalog.find_guid('46459733-8A1D-EA42-B037-D464BE3809AD')
@@ -0,0 +1,94 @@
+# Test the parallel file-by-file downloader
+from ruciopylib.parallel_download import parallel_download, DownloadStats
+from ruciopylib.rucio import RucioFile, RucioException
+from ruciopylib.runner import CommandCancelled
+from time import sleep
+import threading
+import os
+import pytest
+
+class rucio_dummy_files:
+    'Pretends to download individual files by writing them into the directory'
+    def __init__(self, delay = 0.0, bad_files = []):
+        self._delay = delay
+        self._bad_files = bad_files
+        self._lock = threading.Lock()
+        self.Calls = []
+        self.Running = 0
+        self.MaxRunning = 0
+
+    def download_file_list(self, files, dest_dir, log_func = None):
+        with self._lock:
+            self.Calls.append(files)
+            self.Running += 1
+            self.MaxRunning = max(self.MaxRunning, self.Running)
+        sleep(self._delay)
+        with self._lock:
+            self.Running -= 1
+        if any(f in self._bad_files for f in files):
+            raise RucioException('Try again')
+        for f in files:
+            with open(os.path.join(dest_dir, f.split(':')[-1]), 'w') as f_out:
+                f_out.write('hi')
+            if log_func is not None:
+                log_func('File {0} successfully downloaded.'.format(f))
+        return files
+
+@pytest.fixture()
+def many_files():
+    return [RucioFile('scope:f{0}.root'.format(i), 100, 1) for i in range(10)]
+
+def test_stats_throughput():
+    assert 50.0 == DownloadStats([], 100, 2.0).throughput
+    assert 0.0 == DownloadStats([], 100, 0.0).throughput
+
+def test_download_all(many_files, tmp_path):
+    r = rucio_dummy_files()
+    stats = parallel_download(workers=3).download(r, many_files, str(tmp_path / 'ds'))
+    assert 10 == len(stats.files)
+    assert 1000 == stats.bytes
+    assert 10 == len(r.Calls)
+    assert 10 == len(os.listdir(str(tmp_path / 'ds')))
+
+def test_download_in_chunks(many_files, tmp_path):
+    r = rucio_dummy_files()
+    stats = parallel_download(workers=3, files_per_task=4).download(r, many_files, str(tmp_path))
+    assert [4, 4, 2] == [len(c) for c in r.Calls]
+    assert 10 == len(stats.files)
+
+def test_download_in_parallel(many_files, tmp_path):
+    r = rucio_dummy_files(delay=0.05)
+    parallel_download(workers=3).download(r, many_files, str(tmp_path))
+    assert 3 == r.MaxRunning
+
+def test_download_logs(many_files, tmp_path):
+    lines = []
+    parallel_download(workers=3).download(rucio_dummy_files(), many_files, str(tmp_path), log_func=lambda l: lines.append(l))
+    assert 10 == len([l for l in lines if 'successfully downloaded' in l])
+    assert 'MBps' in lines[-1]
+
+def test_download_one_fails(many_files, tmp_path):
+    r = rucio_dummy_files(bad_files=['scope:f3.root'])
+    with pytest.raises(RucioException):
+        parallel_download(workers=3).download(r, many_files, str(tmp_path))
+    # Everything else should have been downloaded
+    assert 9 == len(os.listdir(str(tmp_path)))
+
+def test_download_cancelled(many_files, tmp_path):
+    'The cancel event reaches the downloads, and nothing new is started'
+    class rucio_quiet:
+        def __init__(self):
+            self.Calls = 0
+
+        def download_file_list(self, files, dest_dir, log_func = None):
+            self.Calls += 1
+            log_func.cancelled.wait(5)
+            raise CommandCancelled('killed')
+    def log(l):
+        pass
+    log.cancelled = threading.Event()
+    threading.Timer(0.1, log.cancelled.set).start()
+    r = rucio_quiet()
+    with pytest.raises(CommandCancelled):
+        parallel_download(workers=2).download(r, many_files, str(tmp_path), log_func=log)
+    assert 2 == r.Calls
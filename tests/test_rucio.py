@@ -1,9 +1,11 @@
 # Test out using rucio to run things
 #
 import pytest
-from tests.utils_for_tests import run_dummy_multiple
-from ruciopylib.rucio import rucio, RucioException
+from tests.utils_for_tests import run_dummy_multiple, run_dummy_streaming
+from ruciopylib.rucio import rucio, rucio_backend, RucioException, normalize_guid, calc_size
+from ruciopylib.runner import exe_result
 from time import sleep
+import asyncio
 
 # Runners that respond to commands from rucio with various outputs.
 @pytest.fixture()
@@ -201,9 +203,18 @@ def test_good_file_list(rucio_good_file_listing):
     r = rucio(executor = rucio_good_file_listing)
     files = r.get_file_listing("mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10724_r10726_p3795")
     assert 13 == len(files)
+    assert not r.exact_sizes
     f_dict = {info.filename: info for info in files}
     assert 30000 == f_dict["mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1"].events
-    assert int(5.956*1024*1024*1024) == f_dict["mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1"].size
+    assert 5956000000 == f_dict["mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1"].size
+    assert 'c14ee390' == f_dict["mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1"].adler32
+    assert '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4' == f_dict["mc16_13TeV:DAOD_EXOT15.17545540._000013.pool.root.1"].guid
+
+def test_calc_size():
+    assert 123 == calc_size('123.000 B')
+    assert 1500 == calc_size('1.500 kB')
+    assert 1981000000 == calc_size('1.981 GB')
+    assert 2500000000000 == calc_size('2.500 TB')
 
 def test_bad_ds_name(rucio_bad_ds_name):
     r = rucio(executor = rucio_bad_ds_name)
@@ -257,3 +268,136 @@ def test_download_bad_cert(rucio_no_cert_download):
         assert False
     except RucioException:
         return
+
+def test_good_file_list_async(rucio_good_file_listing):
+    r = rucio(executor = rucio_good_file_listing)
+    files = asyncio.run(r.get_file_listing_async("mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10724_r10726_p3795"))
+    assert 13 == len(files)
+
+def test_bad_ds_name_async(rucio_bad_ds_name):
+    r = rucio(executor = rucio_bad_ds_name)
+    assert None is asyncio.run(r.get_file_listing_async("mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.bogus"))
+
+def test_download_good_ds_async(rucio_good_ds_download):
+    r = rucio(executor=rucio_good_ds_download)
+    files = asyncio.run(r.download_files_async("mc16_13TeV.311309.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS5_ltlow.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10201_r10210_p3795", '/data'))
+    assert 5 == len(files)
+
+def test_good_file_list_streamed(rucio_good_file_listing):
+    runner = run_dummy_streaming(rucio_good_file_listing._responses)
+    r = rucio(executor = runner)
+    files = r.get_file_listing("mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10724_r10726_p3795")
+    assert 1 == runner.StreamCount
+    assert 13 == len(files)
+
+def test_bad_ds_name_streamed(rucio_bad_ds_name):
+    r = rucio(executor = run_dummy_streaming(rucio_bad_ds_name._responses))
+    assert None is r.get_file_listing("mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.bogus")
+
+def test_download_good_ds_streamed(rucio_good_ds_download):
+    runner = run_dummy_streaming(rucio_good_ds_download._responses)
+    r = rucio(executor=runner)
+    files = r.download_files("mc16_13TeV.311309.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS5_ltlow.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10201_r10210_p3795", '/data')
+    assert 1 == runner.StreamCount
+    assert runner.KeepLines is not None
+    assert 5 == len(files)
+
+def test_download_bad_ds_streamed(rucio_bad_ds_download):
+    r = rucio(executor=run_dummy_streaming(rucio_bad_ds_download._responses))
+    res = r.download_files("mc16_13TeV.311309.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS5_ltlow.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10201_r10210_p3795dude", '/data')
+    assert None is res
+
+class run_dummy_shell_script:
+    'Runs a simple "; " separated script of echo and rucio commands, using the responses from other runners'
+    def __init__(self, runners):
+        self._runners = runners
+        self.ExecutionCount = 0
+
+    def shell_execute(self, cmd, log_func = None):
+        self.ExecutionCount += 1
+        lines = []
+        code = 0
+        for c in cmd.split('; '):
+            if c.startswith('echo '):
+                lines.append(c[5:].strip('"').replace('$?', str(code)))
+            else:
+                r = None
+                for runner in self._runners:
+                    if c in runner._responses:
+                        r = runner.shell_execute(c)
+                if r is None:
+                    r = exe_result(12, False, ['Data identifier not found.'])
+                lines += r.shell_output
+                code = r.shell_result
+        if log_func is not None:
+            for l in lines:
+                log_func(l)
+        return exe_result(0, True, lines)
+
+good_ds = "mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10724_r10726_p3795"
+bad_ds = "mc16_13TeV:mc16_13TeV.311313.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS35_lthigh.deriv.DAOD_EXOT15.bogus"
+
+def test_many_file_lists(rucio_good_file_listing, rucio_bad_ds_name):
+    runner = run_dummy_shell_script([rucio_good_file_listing, rucio_bad_ds_name])
+    r = rucio(executor=runner)
+    result = r.get_file_listings([good_ds, bad_ds])
+    assert 1 == runner.ExecutionCount
+    assert 2 == len(result)
+    assert 13 == len(result[good_ds])
+    assert None is result[bad_ds]
+
+def test_many_file_lists_batched(rucio_good_file_listing, rucio_bad_ds_name):
+    runner = run_dummy_shell_script([rucio_good_file_listing, rucio_bad_ds_name])
+    r = rucio(executor=runner)
+    result = r.get_file_listings([good_ds, bad_ds, 'mc16_13TeV:other'], batch_size=2)
+    assert 2 == runner.ExecutionCount
+    assert 3 == len(result)
+    assert None is result['mc16_13TeV:other']
+
+def test_many_file_lists_one_fails(rucio_bad_internet, rucio_bad_ds_name):
+    runner = run_dummy_shell_script([rucio_bad_internet, rucio_bad_ds_name])
+    r = rucio(executor=runner)
+    result = r.get_file_listings([good_ds, bad_ds])
+    assert [bad_ds] == list(result.keys())
+
+def test_many_file_lists_empty():
+    r = rucio(executor=run_dummy_shell_script([]))
+    assert {} == r.get_file_listings([])
+
+def test_many_file_lists_default():
+    class backend_dummy(rucio_backend):
+        def get_file_listing(self, ds_name, log_func=None):
+            if ds_name == 'bad':
+                raise RucioException('Try again')
+            return [] if ds_name == 'empty' else None
+
+        def download_files(self, ds_name, data_dir, log_func=None):
+            return None
+
+        def download_file_list(self, files, dest_dir, log_func=None):
+            return None
+
+    result = backend_dummy().get_file_listings(['empty', 'missing', 'bad'])
+    assert {'empty': [], 'missing': None} == result
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        rucio_backend()
+
+def test_download_threads():
+    runner = run_dummy_multiple({"cd /data; rucio download --ndownloader 5 ds": {'shell_output': [], 'shell_result': 0}})
+    r = rucio(executor=runner, downloader_threads=5)
+    assert [] == r.download_files('ds', '/data')
+
+def test_download_file_list():
+    runner = run_dummy_multiple({"rucio download --dir /data/ds --no-subdir s:f1 s:f2": {'shell_output': [
+        'INFO    Thread 1/3: File s:f1 successfully downloaded. 2.011 GB in 2828.17 seconds = 0.71 MBps',
+        'INFO    Thread 1/3: File s:f2 successfully downloaded. 2.011 GB in 2828.17 seconds = 0.71 MBps'], 'shell_result': 0}})
+    r = rucio(executor=runner)
+    assert ['s:f1', 's:f2'] == r.download_file_list(['s:f1', 's:f2'], '/data/ds')
+
+def test_normalize_guid():
+    assert '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4' == normalize_guid(' 1dcbecfaedc05840a25a8277ca9a31d4 ')
+    assert '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4' == normalize_guid('1DCBECFA-EDC0-5840-A25A-8277CA9A31D4')
+    assert None is normalize_guid('None')
+    assert None is normalize_guid(None)
@@ -1,12 +1,18 @@
 # Test out everything with datasets.
-from ruciopylib.rucio_cache_interface import rucio_cache_interface, DatasetQueryStatus, RucioAlreadyBeingDownloaded
-from ruciopylib.rucio import RucioException
+from ruciopylib.rucio_cache_interface import rucio_cache_interface, DatasetQueryStatus, RucioAlreadyBeingDownloaded, CacheFull, ds_age_too_old
+from ruciopylib.rucio import RucioException, RucioFile
 from tests.utils_for_tests import simple_dataset
+from ruciopylib.dataset_local_cache import dataset_local_cache, dataset_listing_info
+from ruciopylib.parallel_download import parallel_download
+from ruciopylib.single_flight import CallTimedOut, CallCancelled
+from ruciopylib.runner import CommandCancelled
 from time import sleep
 import datetime
 import os
+import shutil
 import asyncio
 import filelock
+import threading
 import logging
 
 import pytest
@@ -158,6 +164,34 @@ def cache_empty():
         def get_dataset_downloading_lock(self, name:str) -> None:
             return filelock.SoftFileLock("./bogus.lock", 0)
 
+        def get_ds_directory(self, ds_name):
+            return 'totally-bogus/' + ds_name
+
+        def get_missing_files(self, ds_name, files):
+            if ds_name in self._downloaded_ds:
+                return []
+            return files
+
+        def remove_partial_files(self, ds_name):
+            return []
+
+        def make_room(self, needed_bytes, keep=(), log_func=None):
+            return True
+
+        def link_from_store(self, ds_name, files):
+            return []
+
+        def add_to_store(self, ds_name, files):
+            pass
+
+        links_shared_files = False
+
+        def fetch_from_shared(self, ds_name, files, log_func=None):
+            return []
+
+        def publish_to_shared(self, ds_name, files, log_func=None):
+            return False
+
         def get_ds_contents(self, ds_name):
             if ds_name not in self._done_ds:
                 return None
@@ -404,3 +438,841 @@ def test_two_downloads_fail(simple_dataset, cache_empty, rucio_do_nothing, rucio
             assert False
         except RucioAlreadyBeingDownloaded:
             return
+
+def test_dataset_download_parallel(simple_dataset, tmp_path):
+    class rucio_dummy_files:
+        def __init__(self, ds):
+            self._ds = ds
+            self.Calls = []
+
+        def get_file_listing(self, ds_name, log_func = None):
+            return self._ds.FileList
+
+        def download_file_list(self, files, dest_dir, log_func = None):
+            self.Calls.append(files)
+            for f in files:
+                with open(os.path.join(dest_dir, f), 'w') as f_out:
+                    f_out.write('hi')
+            return files
+
+    r = rucio_dummy_files(simple_dataset)
+    cache = dataset_local_cache(location=str(tmp_path))
+    dm = rucio_cache_interface(cache, rucio_mgr=r, downloader=parallel_download(workers=2))
+    lines = []
+    status, files = dm.download_ds(simple_dataset.Name, log_func=lambda l: lines.append(l))
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert [['f1.root'], ['f2.root']] == sorted(r.Calls)
+    assert any('MBps' in l for l in lines)
+
+class rucio_dummy_resume:
+    'Downloads whole datasets or file lists into a dataset_local_cache, and records what was asked for'
+    def __init__(self, ds, fail_after = None):
+        self._ds = ds
+        self._fail_after = fail_after
+        self.DatasetDownloads = 0
+        self.FileDownloads = []
+
+    def get_file_listing(self, ds_name, log_func = None):
+        return self._ds.FileList
+
+    def _write(self, d, f):
+        if not os.path.exists(d):
+            os.mkdir(d)
+        with open(os.path.join(d, f), 'w') as f_out:
+            f_out.write('h' * 100)
+
+    def download_files(self, ds_name, data_dir, log_func = None):
+        self.DatasetDownloads += 1
+        for i, f in enumerate(self._ds.FileList):
+            if self._fail_after is not None and i >= self._fail_after:
+                self._write(os.path.join(data_dir, ds_name), f.filename + '.part')
+                raise RucioException('Internet went away. Try again')
+            self._write(os.path.join(data_dir, ds_name), f.filename)
+        return [f.filename for f in self._ds.FileList]
+
+    def download_file_list(self, files, dest_dir, log_func = None):
+        self.FileDownloads.append(files)
+        for f in files:
+            self._write(dest_dir, f)
+        return files
+
+def test_dataset_download_resume(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1), RucioFile('f3.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_resume(ds, fail_after=1)
+    dm = rucio_cache_interface(cache, rucio_mgr=r, seconds_between_retries=0.01)
+    dm.get_ds_contents(ds.Name)
+
+    # First try dies part way through
+    try:
+        dm._rucio_download(ds.Name, None)
+        assert False
+    except RucioException:
+        pass
+    assert 1 == len(cache.get_partial_files(ds.Name))
+
+    # Second time should only get the missing files
+    lines = []
+    status, files = dm.download_ds(ds.Name, log_func=lambda l: lines.append(l))
+    assert DatasetQueryStatus.results_valid == status
+    assert 3 == len(files)
+    assert 1 == r.DatasetDownloads
+    assert [['f2.root', 'f3.root']] == r.FileDownloads
+    assert 0 == len(cache.get_partial_files(ds.Name))
+    assert any('Removed partially downloaded' in l for l in lines)
+
+def test_dataset_download_all_there(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    dm.get_ds_contents(ds.Name)
+    r._write(cache.get_ds_directory(ds.Name), 'f1.root')
+
+    status, files = dm.download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+    assert 0 == r.DatasetDownloads
+    assert 0 == len(r.FileDownloads)
+
+class rucio_dummy_slow_files(rucio_dummy_resume):
+    'Downloads one file at a time, logging each one, and waiting to be told to go on'
+    def __init__(self, ds):
+        rucio_dummy_resume.__init__(self, ds)
+        self.Go = threading.Semaphore(0)
+        self.Finished = False
+
+    def download_files(self, ds_name, data_dir, log_func = None):
+        self.DatasetDownloads += 1
+        for f in self._ds.FileList:
+            self.Go.acquire()
+            self._write(os.path.join(data_dir, ds_name), f.filename)
+            log_func(f'INFO    Thread 1/3: File scope:{f.filename} successfully downloaded. 2.011 GB in 2828.17 seconds = 0.71 MBps')
+        self.Finished = True
+        return [f.filename for f in self._ds.FileList]
+
+def test_dataset_stream(simple_dataset, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_slow_files(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+
+    s = dm.download_ds_stream(simple_dataset.Name)
+    files = iter(s)
+    r.Go.release()
+    assert 'dataset1/f1.root' == next(files)
+    assert not r.Finished
+    r.Go.release()
+    assert ['dataset1/f2.root'] == list(files)
+    assert DatasetQueryStatus.results_valid == s.status
+    assert 2 == len(s.files)
+
+def test_dataset_stream_already_there(simple_dataset, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_slow_files(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    dm.get_ds_contents(simple_dataset.Name)
+    r._write(cache.get_ds_directory(simple_dataset.Name), 'f1.root')
+
+    s = dm.download_ds_stream(simple_dataset.Name)
+    files = iter(s)
+    assert 'dataset1/f1.root' == next(files)
+    r.Go.release()
+    r.Go.release()
+    assert ['dataset1/f2.root'] == list(files)
+    assert [['f2.root']] == r.FileDownloads
+
+def test_dataset_stream_does_not_exist(rucio_2file_dataset, cache_empty):
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset)
+    s = dm.download_ds_stream('bogus')
+    assert [] == list(s)
+    assert DatasetQueryStatus.does_not_exist == s.status
+
+def test_dataset_stream_cancel(simple_dataset, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_slow_files(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+
+    s = dm.download_ds_stream(simple_dataset.Name)
+    files = iter(s)
+    r.Go.release()
+    assert 'dataset1/f1.root' == next(files)
+    s.cancel()
+    r.Go.release()
+    assert [] == list(files)
+    assert s.cancelled
+    assert None is s.status
+    wait_some_time(lambda: r.DatasetDownloads == 0)
+    sleep(0.05)
+    assert not r.Finished
+    assert None is cache.get_ds_contents(simple_dataset.Name)
+
+def test_dataset_stream_cancel_quiet(simple_dataset, tmp_path):
+    'A download that is not printing anything is still told to stop'
+    class rucio_dummy_quiet(rucio_dummy_resume):
+        def __init__(self, ds):
+            rucio_dummy_resume.__init__(self, ds)
+            self.Started = threading.Event()
+            self.Stopped = threading.Event()
+
+        def download_files(self, ds_name, data_dir, log_func = None):
+            self.Started.set()
+            if log_func.cancelled.wait(5):
+                self.Stopped.set()
+            raise CommandCancelled('killed')
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_quiet(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+
+    s = dm.download_ds_stream(simple_dataset.Name)
+    files = iter(s)
+    t = threading.Thread(target=lambda: list(files))
+    t.start()
+    assert r.Started.wait(5)
+    s.cancel()
+    assert r.Stopped.wait(1)
+    t.join(5)
+    assert s.cancelled
+
+def test_dataset_stream_error(rucio_2file_dataset_with_fails, cache_empty, simple_dataset):
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset_with_fails, seconds_between_retries=0.01)
+    with cache_empty.get_dataset_downloading_lock(simple_dataset.Name):
+        s = dm.download_ds_stream(simple_dataset.Name)
+        try:
+            list(s)
+            assert False
+        except RucioAlreadyBeingDownloaded:
+            pass
+
+def test_dataset_download_makes_room(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path), quota_bytes=250)
+    old_dir = cache.get_ds_directory('old')
+    os.mkdir(old_dir)
+    with open(f'{old_dir}/f1.root', 'w') as f:
+        f.write('h' * 100)
+    cache.mark_dataset_done('old')
+
+    dm = rucio_cache_interface(cache, rucio_mgr=rucio_dummy_resume(ds))
+    status, files = dm.download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert cache.get_ds_contents('old') is None
+
+def test_dataset_download_cache_full(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path), quota_bytes=150)
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    with pytest.raises(CacheFull):
+        dm.download_ds(ds.Name)
+    assert 0 == r.DatasetDownloads
+
+def test_dataset_download_pinned(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    dm = rucio_cache_interface(cache, rucio_mgr=rucio_dummy_resume(ds))
+    status, pin = dm.download_ds_pinned(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    with pin:
+        assert 2 == len(pin.files)
+        assert not cache.evict_dataset(ds.Name)
+    assert cache.evict_dataset(ds.Name)
+
+def test_dataset_download_pinned_no_exist(rucio_2file_dataset, cache_empty):
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset)
+    status, pin = dm.download_ds_pinned('bogus')
+    assert DatasetQueryStatus.does_not_exist == status
+    assert None is pin
+
+def test_dataset_download_uses_store(tmp_path):
+    ds1 = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    ds2 = dataset_listing_info('dataset2', [RucioFile('f2.root', 100, 1), RucioFile('f3.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path), file_store=True)
+    r1 = rucio_dummy_resume(ds1)
+    rucio_cache_interface(cache, rucio_mgr=r1).download_ds(ds1.Name)
+
+    r2 = rucio_dummy_resume(ds2)
+    lines = []
+    status, files = rucio_cache_interface(cache, rucio_mgr=r2).download_ds(ds2.Name, log_func=lambda l: lines.append(l))
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 0 == r2.DatasetDownloads
+    assert [['f3.root']] == r2.FileDownloads
+    assert any('already downloaded for other datasets' in l for l in lines)
+
+def test_dataset_download_two_tier(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+
+    # The first node downloads from rucio, and fills the shared cache
+    r1 = rucio_dummy_resume(ds)
+    node1 = dataset_local_cache(location=str(tmp_path / 'node1'), shared=shared)
+    rucio_cache_interface(node1, rucio_mgr=r1).download_ds(ds.Name)
+    assert 1 == r1.DatasetDownloads
+    assert 2 == len(shared.get_ds_contents(ds.Name))
+
+    # The second gets everything from the shared cache
+    r2 = rucio_dummy_resume(ds)
+    node2 = dataset_local_cache(location=str(tmp_path / 'node2'), shared=shared)
+    status, files = rucio_cache_interface(node2, rucio_mgr=r2).download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 0 == r2.DatasetDownloads
+    assert 0 == len(r2.FileDownloads)
+
+def test_dataset_download_two_tier_linked_needs_no_room(tmp_path):
+    'Files linked from the shared cache do not count against the local quota'
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+    node1 = dataset_local_cache(location=str(tmp_path / 'node1'), shared=shared)
+    rucio_cache_interface(node1, rucio_mgr=rucio_dummy_resume(ds)).download_ds(ds.Name)
+
+    r2 = rucio_dummy_resume(ds)
+    node2 = dataset_local_cache(location=str(tmp_path / 'node2'), shared=shared, link_shared_files=True, quota_bytes=150)
+    status, files = rucio_cache_interface(node2, rucio_mgr=r2).download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 0 == r2.DatasetDownloads
+
+def test_dataset_download_publish_fails(tmp_path, monkeypatch):
+    'A shared cache we can not write to does not undo the local download'
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1)])
+    shared = dataset_local_cache(location=str(tmp_path / 'shared'))
+    node = dataset_local_cache(location=str(tmp_path / 'node'), shared=shared)
+
+    def no_publish(ds_name, files, log_func=None):
+        raise OSError('Read-only file system')
+    monkeypatch.setattr(node, 'publish_to_shared', no_publish)
+
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(node, rucio_mgr=r)
+    lines = []
+    status, files = dm.download_ds(ds.Name, log_func=lambda l: lines.append(l))
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+    assert any('Unable to publish dataset1 to the shared cache' in l for l in lines)
+
+    status, _ = dm.download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == r.DatasetDownloads
+
+class rucio_dummy_gated:
+    'Listing queries wait until they are told to go'
+    def __init__(self, ds, fail=False):
+        self._ds = ds
+        self._fail = fail
+        self.Go = threading.Event()
+        self.CountCalled = 0
+
+    def get_file_listing(self, ds_name, log_func = None):
+        self.CountCalled += 1
+        self.Go.wait()
+        if self._fail:
+            raise RucioAlreadyBeingDownloaded('not really')
+        return self._ds.FileList if ds_name == self._ds.Name else None
+
+def test_dataset_query_nonblocking(cache_empty, simple_dataset):
+    r = rucio_dummy_gated(simple_dataset)
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    assert (DatasetQueryStatus.query_queued, None) == dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert (DatasetQueryStatus.query_queued, None) == dm.get_ds_contents(simple_dataset.Name, block=False)
+
+    r.Go.set()
+    wait_some_time(lambda: cache_empty.get_listing(simple_dataset.Name) is None)
+    status, files = dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert DatasetQueryStatus.results_valid == status
+    assert len(simple_dataset.FileList) == len(files)
+    assert 1 == r.CountCalled
+
+def test_dataset_query_nonblocking_missing(cache_empty, simple_dataset):
+    r = rucio_dummy_gated(simple_dataset)
+    r.Go.set()
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    dm.get_ds_contents('bogus', block=False)
+    wait_some_time(lambda: cache_empty.get_listing('bogus') is None)
+    assert (DatasetQueryStatus.does_not_exist, None) == dm.get_ds_contents('bogus', block=False)
+
+def test_dataset_query_nonblocking_always_old(cache_empty, simple_dataset):
+    'A finished query is used even if it is already older than maxAge'
+    r = rucio_dummy_gated(simple_dataset)
+    r.Go.set()
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(seconds=0), block=False)
+    wait_some_time(lambda: cache_empty.get_listing(simple_dataset.Name) is None)
+    sleep(0.05)
+    status, _ = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(seconds=0), block=False)
+    assert DatasetQueryStatus.results_valid == status
+
+def test_dataset_query_nonblocking_error(cache_empty, simple_dataset):
+    class rucio_broken:
+        def get_file_listing(self, ds_name, log_func = None):
+            raise Exception('Something is really wrong')
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_broken())
+    dm.get_ds_contents(simple_dataset.Name, block=False)
+    wait_some_time(lambda: not dm._queries[simple_dataset.Name].done())
+    with pytest.raises(Exception):
+        dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert (DatasetQueryStatus.query_queued, None) == dm.get_ds_contents(simple_dataset.Name, block=False)
+    wait_some_time(lambda: not dm._queries[simple_dataset.Name].done())
+
+def test_dataset_query_nonblocking_tries(cache_empty, simple_dataset):
+    'A background query gives up after background_tries, and the error is only raised once'
+    class rucio_broken:
+        def __init__(self):
+            self.CountCalled = 0
+
+        def get_file_listing(self, ds_name, log_func = None):
+            self.CountCalled += 1
+            raise RucioException('rucio is down')
+    r = rucio_broken()
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r, seconds_between_retries=0.01, background_tries=2)
+    dm.get_ds_contents(simple_dataset.Name, block=False)
+    wait_some_time(lambda: not dm._queries[simple_dataset.Name].done())
+    assert 2 == r.CountCalled
+    with pytest.raises(RucioException):
+        dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert (DatasetQueryStatus.query_queued, None) == dm.get_ds_contents(simple_dataset.Name, block=False)
+    wait_some_time(lambda: not dm._queries[simple_dataset.Name].done())
+    assert 4 == r.CountCalled
+
+def test_dataset_query_nonblocking_cached(rucio_2file_dataset, cache_empty, simple_dataset):
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset)
+    dm.get_ds_contents(simple_dataset.Name)
+    status, _ = dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == rucio_2file_dataset.CountCalled
+
+def test_dataset_download_shared(simple_dataset, tmp_path):
+    'Two threads downloading the same dataset share one download'
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_slow_files(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    dm.get_ds_contents(simple_dataset.Name)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(dm.download_ds(simple_dataset.Name))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    wait_some_time(lambda: not dm._flights.in_flight(('download', simple_dataset.Name)))
+    for _ in simple_dataset.FileList:
+        r.Go.release()
+    for t in threads:
+        t.join()
+    assert 2 == len(results)
+    assert all(DatasetQueryStatus.results_valid == s and 2 == len(f) for s, f in results)
+    assert 1 == r.DatasetDownloads
+
+def test_dataset_download_timeout(simple_dataset, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_slow_files(simple_dataset)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    with pytest.raises(CallTimedOut):
+        dm.download_ds(simple_dataset.Name, timeout=0.1)
+
+    # It kept going in the background
+    for _ in simple_dataset.FileList:
+        r.Go.release()
+    wait_some_time(lambda: cache.get_ds_contents(simple_dataset.Name) is None)
+
+def test_dataset_query_cancel(simple_dataset, cache_empty):
+    r = rucio_dummy_gated(simple_dataset)
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(CallCancelled):
+        dm.get_ds_contents(simple_dataset.Name, cancel=cancel)
+    r.Go.set()
+    wait_some_time(lambda: dm._flights.in_flight(('query', simple_dataset.Name)))
+
+class rucio_dummy_counting(rucio_dummy_resume):
+    'Counts the listing queries'
+    def __init__(self, ds):
+        rucio_dummy_resume.__init__(self, ds)
+        self.Queries = 0
+
+    def get_file_listing(self, ds_name, log_func = None):
+        self.Queries += 1
+        return rucio_dummy_resume.get_file_listing(self, ds_name, log_func)
+
+def hold_lock_then(cache, ds_name, func, delay=0.2):
+    'On another thread, take the download lock, and call func after a delay then release the lock'
+    locked = threading.Event()
+    def hold():
+        with cache.get_dataset_downloading_lock(ds_name):
+            locked.set()
+            sleep(delay)
+            func()
+    t = threading.Thread(target=hold)
+    t.start()
+    assert locked.wait(5)
+    return t
+
+def test_dataset_download_waits_for_lock(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    cache.save_listing(ds)
+    r = rucio_dummy_resume(ds)
+    def other_process_download():
+        r.download_files(ds.Name, cache.get_download_directory())
+        cache.mark_dataset_done(ds.Name)
+    t = hold_lock_then(cache, ds.Name, other_process_download)
+
+    dm = rucio_cache_interface(cache, rucio_mgr=rucio_dummy_resume(ds), lock_wait=5)
+    lines = []
+    status, files = dm.download_ds(ds.Name, log_func=lambda l: lines.append(l))
+    t.join()
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 0 == dm._rucio.DatasetDownloads
+    assert any('Waiting' in l for l in lines)
+
+def test_dataset_download_waits_for_lock_holder_failed(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    cache.save_listing(ds)
+    t = hold_lock_then(cache, ds.Name, lambda: None)
+
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r, lock_wait=5)
+    status, files = dm.download_ds(ds.Name)
+    t.join()
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 1 == r.DatasetDownloads
+
+def test_dataset_query_waits_for_lock(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1), RucioFile('f2.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    t = hold_lock_then(cache, ds.Name, lambda: cache.save_listing(dataset_listing_info(ds.Name, ds.FileList)))
+
+    r = rucio_dummy_counting(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r, lock_wait=5)
+    status, files = dm.get_ds_contents(ds.Name)
+    t.join()
+    assert DatasetQueryStatus.results_valid == status
+    assert 2 == len(files)
+    assert 0 == r.Queries
+
+def test_dataset_query_wait_gives_up(tmp_path):
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_counting(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r, lock_wait=0.1)
+    with cache.get_dataset_downloading_lock(ds.Name):
+        with pytest.raises(RucioAlreadyBeingDownloaded):
+            dm.get_ds_contents(ds.Name)
+    assert 0 == r.Queries
+
+class rucio_dummy_many(rucio_dummy_resume):
+    'Knows about several datasets, and counts the batched and single listings'
+    def __init__(self, datasets):
+        rucio_dummy_resume.__init__(self, None)
+        self._datasets = {ds.Name: ds for ds in datasets}
+        self.Batches = []
+        self.Queries = []
+
+    def get_file_listing(self, ds_name, log_func = None):
+        self.Queries.append(ds_name)
+        return self._datasets[ds_name].FileList if ds_name in self._datasets else None
+
+    def get_file_listings(self, ds_names, log_func = None):
+        self.Batches.append(list(ds_names))
+        return {ds_name: self._datasets[ds_name].FileList if ds_name in self._datasets else None
+                for ds_name in ds_names}
+
+    def download_files(self, ds_name, data_dir, log_func = None):
+        self.DatasetDownloads += 1
+        for f in self._datasets[ds_name].FileList:
+            self._write(os.path.join(data_dir, ds_name), f.filename)
+        return [f.filename for f in self._datasets[ds_name].FileList]
+
+@pytest.fixture()
+def many_datasets():
+    return [dataset_listing_info(f'ds{i}', [RucioFile(f'f{i}_1.root', 100, 1), RucioFile(f'f{i}_2.root', 100, 1)])
+            for i in range(5)]
+
+def test_many_contents_batched(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    futures = dm.get_many_ds_contents([ds.Name for ds in many_datasets] + ['bogus'], batch_size=4)
+    assert 6 == len(futures)
+    for ds in many_datasets:
+        status, files = futures[ds.Name].result(5)
+        assert DatasetQueryStatus.results_valid == status
+        assert 2 == len(files)
+    assert (DatasetQueryStatus.does_not_exist, None) == futures['bogus'].result(5)
+    assert [2, 4] == sorted(len(b) for b in r.Batches)
+    assert 0 == len(r.Queries)
+
+def test_many_contents_cache_hits(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    cache.save_listing(many_datasets[0])
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    futures = dm.get_many_ds_contents([ds.Name for ds in many_datasets[0:2]])
+    assert futures['ds0'].done()
+    assert DatasetQueryStatus.results_valid == futures['ds1'].result(5)[0]
+    assert [['ds1']] == r.Batches
+
+def test_many_contents_locked_dataset(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    with cache.get_dataset_downloading_lock('ds1'):
+        futures = dm.get_many_ds_contents([ds.Name for ds in many_datasets[0:2]])
+        assert DatasetQueryStatus.results_valid == futures['ds0'].result(5)[0]
+        with pytest.raises(RucioAlreadyBeingDownloaded):
+            futures['ds1'].result(5)
+    assert [['ds0']] == r.Batches
+
+def test_many_contents_batch_fails(many_datasets, tmp_path):
+    class rucio_batch_broken(rucio_dummy_many):
+        def get_file_listings(self, ds_names, log_func = None):
+            raise RucioException('batch broke')
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_batch_broken(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    futures = dm.get_many_ds_contents(['ds0', 'ds1'])
+    assert all(DatasetQueryStatus.results_valid == f.result(5)[0] for f in futures.values())
+    assert ['ds0', 'ds1'] == sorted(r.Queries)
+
+def test_many_contents_while_querying(many_datasets, tmp_path):
+    'A dataset already being queried is not batched, and neither caller sees the lock'
+    class rucio_single_gated(rucio_dummy_many):
+        def __init__(self, datasets):
+            rucio_dummy_many.__init__(self, datasets)
+            self.Go = threading.Event()
+
+        def get_file_listing(self, ds_name, log_func = None):
+            self.Go.wait()
+            return rucio_dummy_many.get_file_listing(self, ds_name, log_func)
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_single_gated(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    results = []
+    t = threading.Thread(target=lambda: results.append(dm.get_ds_contents('ds1')))
+    t.start()
+    wait_some_time(lambda: not dm._flights.in_flight(('query', 'ds1')))
+
+    futures = dm.get_many_ds_contents(['ds0', 'ds1'])
+    assert DatasetQueryStatus.results_valid == futures['ds0'].result(5)[0]
+    r.Go.set()
+    assert DatasetQueryStatus.results_valid == futures['ds1'].result(5)[0]
+    t.join(5)
+    assert DatasetQueryStatus.results_valid == results[0][0]
+    assert [['ds0']] == r.Batches
+    assert ['ds1'] == r.Queries
+
+class rucio_batch_gated(rucio_dummy_many):
+    'Batched listings wait until they are told to go'
+    def __init__(self, datasets):
+        rucio_dummy_many.__init__(self, datasets)
+        self.Go = threading.Event()
+
+    def get_file_listings(self, ds_names, log_func = None):
+        self.Go.wait()
+        return rucio_dummy_many.get_file_listings(self, ds_names, log_func)
+
+def test_query_while_batched(many_datasets, tmp_path):
+    'Asking for a dataset while a batch holds its lock waits for the batch'
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_batch_gated(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    futures = dm.get_many_ds_contents(['ds0', 'ds1'])
+    wait_some_time(lambda: 'ds1' not in dm._batched)
+
+    results = []
+    t = threading.Thread(target=lambda: results.append(dm.get_ds_contents('ds1')))
+    t.start()
+    sleep(0.05)
+    r.Go.set()
+    t.join(5)
+    assert DatasetQueryStatus.results_valid == results[0][0]
+    assert all(DatasetQueryStatus.results_valid == f.result(5)[0] for f in futures.values())
+    assert [['ds0', 'ds1']] == r.Batches
+
+def test_batch_registered_before_locking(many_datasets, tmp_path, monkeypatch):
+    'Nobody can find a dataset locked by a batch without knowing the batch has it'
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    registered = []
+    lock = cache.get_dataset_downloading_lock
+
+    def lock_and_check(ds_name):
+        registered.append(ds_name in dm._batched)
+        return lock(ds_name)
+    monkeypatch.setattr(cache, 'get_dataset_downloading_lock', lock_and_check)
+    futures = dm.get_many_ds_contents(['ds0', 'ds1'])
+    assert all(DatasetQueryStatus.results_valid == f.result(5)[0] for f in futures.values())
+    assert [True, True] == registered
+    assert {} == dm._batched
+
+def test_close_cancels_queued(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_batch_gated(many_datasets)
+    with rucio_cache_interface(cache, rucio_mgr=r, query_workers=1) as dm:
+        futures = dm.get_many_ds_contents(['ds0', 'ds1'], batch_size=1)
+        wait_some_time(lambda: 'ds0' not in dm._batched)
+    assert futures['ds1'].cancelled()
+    with pytest.raises(RuntimeError):
+        dm.get_ds_contents('ds2', block=False)
+    with pytest.raises(RuntimeError):
+        dm.download_many_ds(['ds2'])
+
+    r.Go.set()
+    assert DatasetQueryStatus.results_valid == futures['ds0'].result(5)[0]
+    assert [['ds0']] == r.Batches
+
+def test_close_stops_running_query(cache_empty, simple_dataset):
+    class rucio_waits_to_be_stopped:
+        def __init__(self):
+            self.Started = threading.Event()
+            self.Stopped = threading.Event()
+
+        def get_file_listing(self, ds_name, log_func = None):
+            self.Started.set()
+            if log_func.cancelled.wait(5):
+                self.Stopped.set()
+            log_func('still here')
+    r = rucio_waits_to_be_stopped()
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    dm.get_ds_contents(simple_dataset.Name, block=False)
+    assert r.Started.wait(5)
+    dm.close()
+    assert r.Stopped.wait(5)
+    assert cache_empty.get_listing(simple_dataset.Name) is None
+
+def test_close_keeps_stale_listing(cache_empty, simple_dataset):
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=2))
+    r = rucio_dummy_gated(simple_dataset)
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    dm.close()
+    status, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+    assert 0 == r.CountCalled
+
+def test_many_download(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r, download_workers=2)
+    futures = dm.download_many_ds([ds.Name for ds in many_datasets] + ['bogus'])
+    for ds in many_datasets:
+        status, files = futures[ds.Name].result(5)
+        assert DatasetQueryStatus.results_valid == status
+        assert 2 == len(files)
+    assert (DatasetQueryStatus.does_not_exist, None) == futures['bogus'].result(5)
+    assert 5 == r.DatasetDownloads
+
+def test_many_download_already_there(many_datasets, tmp_path):
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_many(many_datasets)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    dm.download_ds('ds0')
+    futures = dm.download_many_ds(['ds0', 'ds1'], do_download=False)
+    assert DatasetQueryStatus.results_valid == futures['ds0'].result(5)[0]
+    assert (DatasetQueryStatus.does_not_exist, None) == futures['ds1'].result(5)
+    assert 1 == r.DatasetDownloads
+
+def test_age_too_old():
+    now = datetime.datetime.now()
+    assert not ds_age_too_old(now - datetime.timedelta(days=10), None)
+    assert ds_age_too_old(now, datetime.timedelta(seconds=0))
+    assert ds_age_too_old(now - datetime.timedelta(hours=2), datetime.timedelta(hours=1))
+    assert not ds_age_too_old(now - datetime.timedelta(minutes=30), datetime.timedelta(hours=1))
+    assert not ds_age_too_old(now - datetime.timedelta(hours=2), datetime.timedelta(days=1))
+
+def save_old_listing(cache, ds, age):
+    cache.save_listing(dataset_listing_info(ds.Name, ds.FileList[0:1], created_time=datetime.datetime.now() - age))
+
+def test_stale_listing_returned_and_refreshed(cache_empty, simple_dataset):
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=2))
+    r = rucio_dummy_gated(simple_dataset)
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    status, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+
+    r.Go.set()
+    wait_some_time(lambda: len(cache_empty.get_listing(simple_dataset.Name).FileList) == 1)
+    wait_some_time(lambda: len(dm._refreshes) > 0)
+    status, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    assert len(simple_dataset.FileList) == len(files)
+    assert 1 == r.CountCalled
+
+def test_stale_listing_one_refresh(cache_empty, simple_dataset):
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=2))
+    r = rucio_dummy_gated(simple_dataset)
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r)
+    for _ in range(3):
+        dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    wait_some_time(lambda: r.CountCalled == 0)
+    r.Go.set()
+    wait_some_time(lambda: len(dm._refreshes) > 0)
+    assert 1 == r.CountCalled
+
+def test_stale_listing_past_grace(rucio_2file_dataset, cache_empty, simple_dataset):
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=5))
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset)
+    status, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    assert DatasetQueryStatus.results_valid == status
+    assert len(simple_dataset.FileList) == len(files)
+    assert 1 == rucio_2file_dataset.CountCalled
+
+def test_stale_listing_no_grace(rucio_2file_dataset, cache_empty, simple_dataset):
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=2))
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=rucio_2file_dataset)
+    _, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1))
+    assert len(simple_dataset.FileList) == len(files)
+
+def test_stale_listing_refresh_fails(cache_empty, simple_dataset):
+    class rucio_broken:
+        def __init__(self):
+            self.CountCalled = 0
+
+        def get_file_listing(self, ds_name, log_func = None):
+            self.CountCalled += 1
+            raise RucioException('Something is really wrong')
+    save_old_listing(cache_empty, simple_dataset, datetime.timedelta(hours=2))
+    r = rucio_broken()
+    dm = rucio_cache_interface(cache_empty, rucio_mgr=r, seconds_between_retries=0.01)
+    lines = []
+    dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2),
+                       log_func=lambda l: lines.append(l))
+    wait_some_time(lambda: len(lines) == 0)
+    wait_some_time(lambda: len(dm._refreshes) > 0)
+    sleep(0.05)
+    assert 1 == r.CountCalled
+    status, files = dm.get_ds_contents(simple_dataset.Name, maxAge=datetime.timedelta(hours=1), staleGrace=datetime.timedelta(hours=2))
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+    assert 'keeping the old one' in lines[0]
+    assert 'Something is really wrong' in lines[0]
+    wait_some_time(lambda: len(dm._refreshes) > 0)
+
+def test_dataset_download_pinned_empty(tmp_path):
+    ds = dataset_listing_info('empty', [])
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    status, pin = dm.download_ds_pinned(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    with pin:
+        assert [] == pin.files
+
+def test_dataset_download_directory_removed(tmp_path):
+    'A downloaded dataset whose directory was removed is downloaded again'
+    ds = dataset_listing_info('dataset1', [RucioFile('f1.root', 100, 1)])
+    cache = dataset_local_cache(location=str(tmp_path))
+    r = rucio_dummy_resume(ds)
+    dm = rucio_cache_interface(cache, rucio_mgr=r)
+    dm.download_ds(ds.Name)
+    shutil.rmtree(cache.get_ds_directory(ds.Name))
+
+    status, files = dm.download_ds(ds.Name)
+    assert DatasetQueryStatus.results_valid == status
+    assert 1 == len(files)
+    assert 2 == r.DatasetDownloads
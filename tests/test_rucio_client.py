@@ -0,0 +1,115 @@
+# Test the in-process rucio client backend, using fake rucio clients.
+from ruciopylib.rucio_client import rucio_client_backend, split_did
+from ruciopylib.rucio import RucioException
+import pytest
+
+class DataIdentifierNotFound(Exception):
+    'Same name as the rucio exception'
+    pass
+
+class NoFilesDownloaded(Exception):
+    'Same name as the rucio exception'
+    pass
+
+class client_dummy:
+    def __init__(self, datasets, fail = False):
+        self._datasets = datasets
+        self._fail = fail
+        self.Calls = []
+
+    def list_files(self, scope, name):
+        self.Calls.append((scope, name))
+        if self._fail:
+            raise Exception('Cannot connect to the Rucio server.')
+        if name not in self._datasets:
+            raise DataIdentifierNotFound()
+        for f in self._datasets[name]:
+            yield f
+
+class download_client_dummy:
+    def __init__(self, results = None, exception = None):
+        self._results = results
+        self._exception = exception
+        self.Items = None
+
+    def download_dids(self, items, num_threads = 2):
+        self.Items = items
+        if self._exception is not None:
+            raise self._exception
+        return self._results
+
+@pytest.fixture()
+def good_client():
+    return client_dummy({'ds1': [
+        {'scope': 'mc16_13TeV', 'name': 'f1.root', 'bytes': 100, 'adler32': 'c14ee390', 'guid': '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4', 'events': 10},
+        {'scope': 'mc16_13TeV', 'name': 'f2.root', 'bytes': 200, 'adler32': 'f5da9a8c', 'guid': '46459733-8A1D-EA42-B037-D464BE3809AD', 'events': None},
+    ], 'empty': []})
+
+def test_split_did():
+    assert ('mc16_13TeV', 'ds1') == split_did('mc16_13TeV:ds1')
+    assert ('mc16_13TeV', 'mc16_13TeV.1234.ds') == split_did('mc16_13TeV.1234.ds')
+    assert ('user.gwatts', 'user.gwatts.ds') == split_did('user.gwatts.ds')
+
+def test_listing(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy())
+    files = r.get_file_listing('mc16_13TeV:ds1')
+    assert 2 == len(files)
+    assert 'mc16_13TeV:f1.root' == files[0].filename
+    assert 100 == files[0].size
+    assert 10 == files[0].events
+    assert 0 == files[1].events
+    assert 'c14ee390' == files[0].adler32
+    assert '1DCBECFA-EDC0-5840-A25A-8277CA9A31D4' == files[0].guid
+    assert [('mc16_13TeV', 'ds1')] == good_client.Calls
+    assert r.exact_sizes
+
+def test_listing_empty(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy())
+    assert [] == r.get_file_listing('mc16_13TeV:empty')
+
+def test_listing_not_there(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy())
+    lines = []
+    assert None is r.get_file_listing('mc16_13TeV:bogus', log_func=lambda l: lines.append(l))
+    assert len(lines) > 0
+
+def test_listing_no_internet():
+    r = rucio_client_backend(client=client_dummy({}, fail=True), download_client=download_client_dummy())
+    with pytest.raises(RucioException):
+        r.get_file_listing('mc16_13TeV:ds1')
+
+def test_download(good_client):
+    dl = download_client_dummy(results=[{'did': 'mc16_13TeV:f1.root', 'clientState': 'DONE'},
+                                        {'did': 'mc16_13TeV:f2.root', 'clientState': 'ALREADY_DONE'}])
+    r = rucio_client_backend(client=good_client, download_client=dl)
+    lines = []
+    files = r.download_files('mc16_13TeV.1234.ds', '/data', log_func=lambda l: lines.append(l))
+    assert ['mc16_13TeV:f1.root'] == files
+    assert [{'did': 'mc16_13TeV:mc16_13TeV.1234.ds', 'base_dir': '/data'}] == dl.Items
+    assert any('successfully downloaded' in l for l in lines)
+
+def test_download_not_there(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy(exception=DataIdentifierNotFound()))
+    assert None is r.download_files('mc16_13TeV:bogus', '/data')
+
+def test_download_no_files(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy(results=[]))
+    assert None is r.download_files('mc16_13TeV:bogus', '/data')
+
+def test_download_failed(good_client):
+    r = rucio_client_backend(client=good_client, download_client=download_client_dummy(exception=NoFilesDownloaded()))
+    with pytest.raises(RucioException):
+        r.download_files('mc16_13TeV:ds1', '/data')
+
+def test_download_one_failed(good_client):
+    dl = download_client_dummy(results=[{'did': 'mc16_13TeV:f1.root', 'clientState': 'DONE'},
+                                        {'did': 'mc16_13TeV:f2.root', 'clientState': 'FAILED'}])
+    r = rucio_client_backend(client=good_client, download_client=dl)
+    with pytest.raises(RucioException):
+        r.download_files('mc16_13TeV:ds1', '/data')
+
+def test_download_file_list(good_client):
+    dl = download_client_dummy(results=[{'did': 'mc16_13TeV:f1.root', 'clientState': 'DONE'}])
+    r = rucio_client_backend(client=good_client, download_client=dl)
+    assert ['mc16_13TeV:f1.root'] == r.download_file_list(['mc16_13TeV:f1.root'], '/data/ds')
+    assert [{'did': 'mc16_13TeV:f1.root', 'base_dir': '/data/ds', 'no_subdir': True}] == dl.Items
@@ -1,6 +1,11 @@
 # Test the runner
 
-from ruciopylib.runner import runner
+from ruciopylib.runner import runner, async_runner, exe_result, stream_command, CommandCancelled
+from tests.utils_for_tests import process_gone, wait_for_process_gone
+import asyncio
+import os
+import threading
+import time
 import pytest
 
 def test_good_command():
@@ -23,3 +28,130 @@ def test_bad_command():
     run = runner()
     result = run.shell_execute("dudewhereismysoda")
     assert False == result.shell_status
+
+def test_async_good_command():
+    run = async_runner()
+    result = run.shell_execute("echo hi")
+    assert True == result.shell_status
+    assert 0 == result.shell_result
+    assert ['hi'] == result.shell_output
+
+def test_async_bad_command():
+    run = async_runner()
+    result = run.shell_execute("dudewhereismysoda")
+    assert False == result.shell_status
+
+def test_async_log_as_we_go():
+    run = async_runner()
+    lines = []
+    result = run.shell_execute("echo hi && echo there", log_func=lambda l: lines.append(l))
+    assert ['hi', 'there'] == lines
+    assert lines == result.shell_output
+
+def test_async_many_at_once():
+    run = async_runner()
+
+    async def do_many():
+        return await asyncio.gather(*[run.shell_execute_async("echo {0}".format(i)) for i in range(20)])
+
+    results = asyncio.run(do_many())
+    assert [str(i) for i in range(20)] == [r.shell_output[0] for r in results]
+
+def test_async_on_running_loop():
+    loop = asyncio.new_event_loop()
+    t = threading.Thread(target=loop.run_forever, daemon=True)
+    t.start()
+    try:
+        run = async_runner(loop=loop)
+        result = run.shell_execute("echo hi")
+        assert ['hi'] == result.shell_output
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        t.join()
+        loop.close()
+
+def test_stream_lines():
+    run = runner()
+    s = run.shell_stream("echo hi && echo there")
+    assert None is s.result
+    lines = [l for l in s]
+    assert ['hi', 'there'] == lines
+    assert s.result.shell_status
+    assert lines == s.result.shell_output
+
+def test_stream_keeps_last_lines():
+    run = runner()
+    s = run.shell_stream("for i in 1 2 3 4 5; do echo $i; done", keep_lines=2)
+    assert 5 == len([l for l in s])
+    assert ['4', '5'] == s.result.shell_output
+
+def test_stream_log_func():
+    run = runner()
+    lines = []
+    s = run.shell_stream("echo hi", log_func=lambda l: lines.append(l))
+    for _ in s:
+        pass
+    assert ['hi'] == lines
+
+def test_stream_bad_command():
+    run = runner()
+    s = run.shell_stream("dudewhereismysoda")
+    for _ in s:
+        pass
+    assert False == s.result.shell_status
+
+def test_stream_abandon():
+    run = runner()
+    start = time.time()
+    s = run.shell_stream("echo hi && sleep 10 && echo there")
+    for l in s:
+        assert 'hi' == l
+        break
+    s.close()
+    assert time.time() - start < 5
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='Needs /proc to look at processes')
+def test_stream_abandon_kills_command():
+    'Not just the shell - what it started too'
+    s = runner().shell_stream('sleep 30 & echo $!; wait')
+    lines = iter(s)
+    pid = int(next(lines))
+    assert not process_gone(pid)
+    lines.close()
+    assert wait_for_process_gone(pid)
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='Needs /proc to look at processes')
+def test_log_func_fails_kills_command():
+    seen = []
+    def log(l):
+        seen.append(l)
+        raise Exception('parser broke')
+    with pytest.raises(Exception):
+        runner().shell_execute('sleep 30 & echo $!; wait', log_func=log)
+    assert wait_for_process_gone(int(seen[0]))
+
+def test_cancel_quiet_command():
+    lines = []
+    def log(l):
+        lines.append(l)
+    log.cancelled = threading.Event()
+    threading.Timer(0.2, log.cancelled.set).start()
+    start = time.time()
+    with pytest.raises(CommandCancelled):
+        runner().shell_execute("echo hi; sleep 10; echo there", log_func=log)
+    assert time.time() - start < 5
+    assert ['hi'] == lines
+
+def test_not_cancelled():
+    def log(l):
+        pass
+    log.cancelled = threading.Event()
+    assert runner().shell_execute("echo hi", log_func=log).shell_status
+
+def test_stream_from_executor_without_streaming():
+    class run_only_execute:
+        def shell_execute(self, cmd, log_func = None):
+            return exe_result(0, True, ['hi'])
+    s = stream_command(run_only_execute(), 'bogus')
+    assert ['hi'] == [l for l in s]
+    assert s.result.shell_status
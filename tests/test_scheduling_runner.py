@@ -0,0 +1,111 @@
+# Test the scheduling runner
+from ruciopylib.scheduling_runner import scheduling_runner, classify_rucio_command, CommandPriority
+from ruciopylib.runner import exe_result, exe_stream
+from time import sleep
+import threading
+import pytest
+
+class run_dummy_slow:
+    'Takes some time to run each command, and tracks how many are running at once'
+    def __init__(self, delay = 0.05):
+        self._delay = delay
+        self._lock = threading.Lock()
+        self.Running = {}
+        self.MaxRunning = {}
+        self.Order = []
+
+    def shell_execute(self, cmd, log_func = None):
+        kind, _ = classify_rucio_command(cmd)
+        with self._lock:
+            self.Order.append(cmd)
+            self.Running[kind] = self.Running.get(kind, 0) + 1
+            self.MaxRunning[kind] = max(self.MaxRunning.get(kind, 0), self.Running[kind])
+            self.MaxRunning['total'] = max(self.MaxRunning.get('total', 0), sum(self.Running.values()))
+        sleep(self._delay)
+        with self._lock:
+            self.Running[kind] -= 1
+        if log_func is not None:
+            log_func(cmd)
+        return exe_result(0, True, [cmd])
+
+def run_all(r, cmds):
+    'Run all the commands at once on their own threads'
+    threads = [threading.Thread(target=lambda c=c: r.shell_execute(c)) for c in cmds]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def test_classify():
+    assert ('listing', CommandPriority.interactive) == classify_rucio_command('rucio list-files ds')
+    assert ('download', CommandPriority.bulk) == classify_rucio_command('cd /data; rucio download ds')
+    assert 'other' == classify_rucio_command('voms-proxy-init')[0]
+
+def test_run_one():
+    dummy = run_dummy_slow(delay=0)
+    r = scheduling_runner(executor=dummy)
+    lines = []
+    result = r.shell_execute('rucio list-files ds', log_func=lambda l: lines.append(l))
+    assert result.shell_status
+    assert ['rucio list-files ds'] == lines
+    assert 1 == r.stats().completed
+    assert 0 == r.queue_depth
+
+def test_total_limit():
+    dummy = run_dummy_slow()
+    r = scheduling_runner(executor=dummy, max_workers=2)
+    run_all(r, ['rucio list-files ds{0}'.format(i) for i in range(6)])
+    assert 2 == dummy.MaxRunning['total']
+    assert 6 == r.stats().completed
+    assert r.stats().max_wait > 0
+
+def test_download_limit():
+    dummy = run_dummy_slow()
+    r = scheduling_runner(executor=dummy, max_workers=4, kind_limits={'download': 1})
+    run_all(r, ['rucio download ds{0}'.format(i) for i in range(3)] + ['rucio list-files ds{0}'.format(i) for i in range(3)])
+    assert 1 == dummy.MaxRunning['download']
+    assert 3 == dummy.MaxRunning['listing']
+
+def test_listing_skips_ahead():
+    dummy = run_dummy_slow()
+    r = scheduling_runner(executor=dummy, max_workers=1)
+
+    # Fill the only slot, and then queue up downloads before the listing.
+    first = threading.Thread(target=lambda: r.shell_execute('rucio download first'))
+    first.start()
+    sleep(0.01)
+    threads = [threading.Thread(target=lambda c=c: r.shell_execute(c)) for c in ['rucio download ds1', 'rucio download ds2']]
+    for t in threads:
+        t.start()
+    sleep(0.01)
+    assert 2 == r.queue_depth
+    listing = threading.Thread(target=lambda: r.shell_execute('rucio list-files ds'))
+    listing.start()
+    for t in [first, listing] + threads:
+        t.join()
+
+    assert 'rucio list-files ds' == dummy.Order[1]
+
+def test_failure_releases_slot():
+    class run_dummy_bad:
+        def shell_execute(self, cmd, log_func = None):
+            raise Exception("bad")
+
+    r = scheduling_runner(executor=run_dummy_bad(), max_workers=1)
+    with pytest.raises(Exception):
+        r.shell_execute('rucio list-files ds')
+    assert 0 == r.stats().running
+
+def test_stream_holds_slot():
+    class run_dummy_stream:
+        def shell_stream(self, cmd, log_func = None, keep_lines = 100):
+            return exe_stream.from_result(exe_result(0, True, ['hi', 'there']))
+
+    r = scheduling_runner(executor=run_dummy_stream(), max_workers=1)
+    s = r.shell_stream('rucio list-files ds')
+    it = iter(s)
+    assert 'hi' == next(it)
+    assert 1 == r.stats().running
+    assert ['there'] == [l for l in it]
+    assert s.result.shell_status
+    assert 0 == r.stats().running
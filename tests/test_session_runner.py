@@ -0,0 +1,128 @@
+# Test the long lived shell session runner
+from ruciopylib.runner import CommandCancelled
+from ruciopylib.session_runner import SessionSetupFailed, shell_session, session_pool
+from tests.utils_for_tests import process_gone, wait_for_process_gone
+import os
+import threading
+import time
+import pytest
+
+@pytest.fixture()
+def session():
+    s = shell_session()
+    yield s
+    s.close()
+
+def test_good_command(session):
+    r = session.shell_execute('echo hi')
+    assert r.shell_status
+    assert 0 == r.shell_result
+    assert ['hi'] == r.shell_output
+
+def test_bad_command(session):
+    r = session.shell_execute('dudewhereismysoda')
+    assert not r.shell_status
+    assert 127 == r.shell_result
+
+def test_exit_code(session):
+    r = session.shell_execute('exit 12')
+    assert 12 == r.shell_result
+    assert session.shell_execute('echo hi').shell_status
+
+def test_commands_are_split(session):
+    assert ['hi'] == session.shell_execute('echo hi').shell_output
+    assert ['there'] == session.shell_execute('echo there').shell_output
+
+def test_no_trailing_newline(session):
+    assert ['hi'] == session.shell_execute('printf hi').shell_output
+    assert ['there'] == session.shell_execute('echo there').shell_output
+
+def test_stderr(session):
+    assert ['hi'] == session.shell_execute('echo hi 1>&2').shell_output
+
+def test_same_shell(session):
+    pid1 = session.shell_execute('echo $PPID').shell_output
+    pid2 = session.shell_execute('echo $PPID').shell_output
+    assert pid1 == pid2
+
+def test_cd_does_not_stick(session):
+    here = session.shell_execute('pwd').shell_output
+    session.shell_execute('cd /')
+    assert here == session.shell_execute('pwd').shell_output
+
+def test_setup_commands():
+    with shell_session(setup_commands=['export RUCIO_TEST_VAR=hi']) as s:
+        assert ['hi'] == s.shell_execute('echo $RUCIO_TEST_VAR').shell_output
+
+def test_setup_command_fails():
+    with shell_session(setup_commands=['echo oops && false']) as s:
+        with pytest.raises(SessionSetupFailed):
+            s.shell_execute('echo hi')
+
+def test_setup_command_no_stdin():
+    # If the setup command could read stdin it would eat the command that follows it.
+    with shell_session(setup_commands=['cat']) as s:
+        assert ['hi'] == s.shell_execute('echo hi').shell_output
+
+def test_cancelled_command(session):
+    def log(l):
+        pass
+    log.cancelled = threading.Event()
+    threading.Timer(0.2, log.cancelled.set).start()
+    start = time.time()
+    with pytest.raises(CommandCancelled):
+        session.shell_execute('sleep 30', log_func=log)
+    assert time.time() - start < 5
+    assert ['there'] == session.shell_execute('echo there').shell_output
+
+def test_cancelled_before_start(session):
+    def log(l):
+        pass
+    log.cancelled = threading.Event()
+    log.cancelled.set()
+    with pytest.raises(CommandCancelled):
+        session.shell_execute('echo hi', log_func=log)
+
+def test_log_func(session):
+    lines = []
+    session.shell_execute('echo hi && echo there', log_func=lambda l: lines.append(l))
+    assert ['hi', 'there'] == lines
+
+def test_stream(session):
+    s = session.shell_stream('for i in 1 2 3; do echo $i; done', keep_lines=1)
+    assert ['1', '2', '3'] == [l for l in s]
+    assert ['3'] == s.result.shell_output
+
+def test_stream_abandoned_restarts(session):
+    s = session.shell_stream('echo hi && sleep 10')
+    for _ in s:
+        break
+    s.close()
+    assert ['there'] == session.shell_execute('echo there').shell_output
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='Needs /proc to look at processes')
+def test_stream_abandoned_kills_command(session):
+    s = session.shell_stream('sleep 30 & echo $!; wait')
+    lines = iter(s)
+    pid = int(next(lines))
+    assert not process_gone(pid)
+    lines.close()
+    assert wait_for_process_gone(pid)
+
+def test_pool_runs_in_parallel():
+    with session_pool(size=3) as pool:
+        start = time.time()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.shell_execute('sleep 0.5 && echo hi'))) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert time.time() - start < 1.4
+        assert all(r.shell_output == ['hi'] for r in results)
+
+def test_pool_stream():
+    with session_pool(size=1) as pool:
+        s = pool.shell_stream('echo hi')
+        assert ['hi'] == [l for l in s]
+        assert ['there'] == pool.shell_execute('echo there').shell_output
@@ -0,0 +1,182 @@
+# Tests for sharing a call between threads
+from ruciopylib.single_flight import single_flight, CallTimedOut, CallCancelled
+import threading
+import time
+import pytest
+
+def run_in_thread(func):
+    'Run func on a thread, return something that waits and gives back the result (or exception)'
+    result = {}
+    def run():
+        try:
+            result['value'] = func()
+        except BaseException as e:
+            result['error'] = e
+    t = threading.Thread(target=run)
+    t.start()
+    def wait():
+        t.join(5)
+        assert not t.is_alive()
+        return result
+    return wait
+
+def wait_for(check, timeout=5):
+    'Wait (sleeping, not spinning) for check to be true'
+    for _ in range(int(timeout / 0.01)):
+        if check():
+            return True
+        time.sleep(0.01)
+    return check()
+
+def test_single_call():
+    assert 5 == single_flight().do('a', lambda log: 5)
+
+def test_exception():
+    def fail(log):
+        raise Exception('bad')
+    with pytest.raises(Exception):
+        single_flight().do('a', fail)
+
+def test_shared():
+    sf = single_flight()
+    go = threading.Event()
+    calls = []
+    started = threading.Event()
+    def slow(log):
+        calls.append(1)
+        started.set()
+        go.wait()
+        return 10
+
+    waits = [run_in_thread(lambda: sf.do('a', slow)) for _ in range(3)]
+    assert started.wait(5)
+    go.set()
+    assert [{'value': 10}] * 3 == [w() for w in waits]
+    assert 1 == len(calls)
+    assert not sf.in_flight('a')
+
+def test_different_keys():
+    sf = single_flight()
+    assert 1 == sf.do('a', lambda log: 1)
+    assert 2 == sf.do('b', lambda log: 2)
+
+def test_log_to_everyone():
+    sf = single_flight()
+    go = threading.Event()
+    started = threading.Event()
+    def slow(log):
+        started.set()
+        go.wait()
+        log('hi')
+        return 1
+
+    lines1, lines2 = [], []
+    w1 = run_in_thread(lambda: sf.do('a', slow, log_func=lambda l: lines1.append(l)))
+    started.wait()
+    w2 = run_in_thread(lambda: sf.do('a', slow, log_func=lambda l: lines2.append(l)))
+    assert wait_for(lambda: len(sf._flights['a'].waiters) == 2)
+    go.set()
+    w1()
+    w2()
+    assert ['hi'] == lines1 == lines2
+
+def test_timeout():
+    sf = single_flight()
+    go = threading.Event()
+    def slow(log):
+        go.wait()
+        return 1
+    with pytest.raises(CallTimedOut):
+        sf.do('a', slow, timeout=0.05)
+    assert sf.in_flight('a')
+    go.set()
+
+def test_cancel():
+    sf = single_flight(poll_interval=0.01)
+    go = threading.Event()
+    cancel = threading.Event()
+    def slow(log):
+        go.wait()
+        return 1
+    w = run_in_thread(lambda: sf.do('a', slow, cancel=cancel))
+    cancel.set()
+    assert isinstance(w()['error'], CallCancelled)
+    go.set()
+
+def test_nobody_waiting_stops_call():
+    sf = single_flight()
+    cancel = threading.Event()
+    stopped = threading.Event()
+    def chatty(log):
+        try:
+            while True:
+                log('line')
+        except CallCancelled:
+            stopped.set()
+            raise
+    def cancel_on_log(l):
+        raise CallCancelled('I have seen enough')
+    with pytest.raises(CallCancelled):
+        sf.do('a', chatty, log_func=cancel_on_log)
+    assert stopped.wait(1)
+
+def test_timeout_keeps_running():
+    sf = single_flight()
+    go = threading.Event()
+    done = threading.Event()
+    def slow(log):
+        go.wait()
+        log('still here')
+        done.set()
+        return 1
+    with pytest.raises(CallTimedOut):
+        sf.do('a', slow, timeout=0.05)
+    go.set()
+    assert done.wait(1)
+
+def test_quiet_call_told_to_stop():
+    sf = single_flight(poll_interval=0.01)
+    cancel = threading.Event()
+    stopped = threading.Event()
+    def quiet(log):
+        # Never logs anything, so it can only find out by looking at `cancelled`
+        assert log.cancelled.wait(5)
+        stopped.set()
+        return 1
+    w = run_in_thread(lambda: sf.do('a', quiet, cancel=cancel))
+    cancel.set()
+    assert isinstance(w()['error'], CallCancelled)
+    assert stopped.wait(1)
+
+def test_timeout_then_cancel():
+    'Someone who times out lets the call run on - but not after someone else joins and cancels'
+    sf = single_flight(poll_interval=0.01)
+    started = threading.Event()
+    def quiet(log):
+        started.set()
+        assert log.cancelled.wait(5)
+        return 1
+    with pytest.raises(CallTimedOut):
+        sf.do('a', quiet, timeout=0.05)
+    assert started.wait(5)
+    assert not sf._flights['a'].cancelled.is_set()
+    cancel = threading.Event()
+    cancel.set()
+    flight = sf._flights['a']
+    with pytest.raises(CallCancelled):
+        sf.do('a', quiet, cancel=cancel)
+    assert flight.cancelled.is_set()
+
+def test_cancelled_call_not_joined():
+    'A new caller does not join a call that has been told to stop'
+    sf = single_flight(poll_interval=0.01)
+    go = threading.Event()
+    def stubborn(log):
+        go.wait()
+        return 1
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(CallCancelled):
+        sf.do('a', stubborn, cancel=cancel)
+    assert 2 == sf.do('a', lambda log: 2)
+    go.set()
@@ -1,12 +1,13 @@
 # Some common utilities for using in tess.
 
 from ruciopylib.cert import cert
-from ruciopylib.runner import exe_result
+from ruciopylib.runner import exe_result, exe_stream
 from ruciopylib.rucio import RucioFile
 from ruciopylib.dataset_local_cache import dataset_listing_info
 import pytest
 from datetime import timedelta
 from time import sleep
+import time
 
 @pytest.fixture()
 def gcert():
@@ -58,6 +59,22 @@ class run_dummy_multiple:
         self.ExecutionCount += 1
         return exe_result(self._responses[cmd]['shell_result'], self._responses[cmd]['shell_result']==0, lines)
 
+    async def shell_execute_async(self, cmd, log_func = None):
+        return self.shell_execute(cmd, log_func=log_func)
+
+class run_dummy_streaming(run_dummy_multiple):
+    'Same as run_dummy_multiple, but the lines can be streamed back'
+    def __init__(self, responses):
+        run_dummy_multiple.__init__(self, responses)
+        self.StreamCount = 0
+        self.KeepLines = None
+
+    def shell_stream(self, cmd, log_func = None, keep_lines = 100):
+        self.StreamCount += 1
+        self.KeepLines = keep_lines
+        r = self.shell_execute(cmd, log_func=log_func)
+        return exe_stream.from_result(exe_result(r.shell_result, r.shell_status, r.shell_output[-keep_lines:]))
+
 ### For help with certificate grabbing
 @pytest.fixture()
 def cert_good_runner():
@@ -89,3 +106,19 @@ def empty_dataset():
 def nonexistant_dataset():
     'Create a simple dataset with 2 files in it'
     return dataset_listing_info('dataset1', None)
+
+def process_gone(pid):
+    'True if the process has exited (a zombie nobody has reaped yet counts as gone)'
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().split(')')[-1].split()[0] == 'Z'
+    except FileNotFoundError:
+        return True
+
+def wait_for_process_gone(pid):
+    'Wait up to a couple of seconds for the process to go away'
+    for _ in range(100):
+        if process_gone(pid):
+            return True
+        time.sleep(0.02)
+    return process_gone(pid)